@@ -0,0 +1,78 @@
+"""
+In-process stand-ins for boto Cloudformation connections, so cfn data sources can be benchmarked offline
+"""
+
+
+class FakeItem(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeResultSet(list):
+    next_token = None
+
+
+class FakeStack(object):
+    def __init__(self, stack_name, outputs, resources, parameters):
+        """
+        :param outputs: dictionary of output key to value
+        :param resources: dictionary of logical resource id to physical resource id
+        :param parameters: dictionary of parameter key to value
+        """
+
+        self.stack_name = stack_name
+        self.stack_status = 'CREATE_COMPLETE'
+        self.tags = []
+        self.outputs = [FakeItem(key=key, value=value) for key, value in outputs.iteritems()]
+        self.parameters = [FakeItem(key=key, value=value) for key, value in parameters.iteritems()]
+        self.resources = [FakeItem(logical_resource_id=key, physical_resource_id=value)
+                          for key, value in sorted(resources.iteritems())]
+
+
+class FakeCloudformationConnection(object):
+    # number of resources per ListStackResources page
+    page_size = 100
+
+    def __init__(self, stacks):
+        """
+        :param stacks: dictionary of stack name to FakeStack
+        :type stacks: dict
+        """
+
+        self.stacks = stacks
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        if stack_name_or_id:
+            return [self.stacks[stack_name_or_id]]
+        return self.stacks.values()
+
+    def list_stack_resources(self, stack_name_or_id, next_token=None):
+        resources = self.stacks[stack_name_or_id].resources
+
+        start = int(next_token or 0)
+        page = FakeResultSet(resources[start:start + self.page_size])
+        if start + self.page_size < len(resources):
+            page.next_token = str(start + self.page_size)
+
+        return page
+
+
+class FakeConnectionPool(object):
+    """
+    Drop-in replacement for Cloudformation.connection_pool serving FakeCloudformationConnection's
+    """
+
+    def __init__(self, stacks):
+        """
+        :param stacks: dictionary of region to a dictionary of stack name to FakeStack
+        :type stacks: dict
+        """
+
+        self._connections = {region: FakeCloudformationConnection(region_stacks)
+                             for region, region_stacks in stacks.iteritems()}
+
+    def get_connection(self, region, **kw_params):
+        return self._connections[region]
+
+    def clear(self):
+        pass
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Run the synthetic benchmark suite and compare it against a stored baseline.
+
+Every workload/size runs in a process of its own, so the reported peak memory is that of a single case. Nothing
+talks to AWS: cfn data sources are served by an in-process fake connection.
+
+Absolute timings depend on the machine, so every case also times a calibration workload that doesn't involve rainbow,
+and cases are compared against the baseline by their time relative to it. This evens out CPU speed and load, not every
+difference between machines (caches, Python builds), hence the --tolerance. If --check keeps failing on a machine,
+regenerate the baseline on it.
+
+Usage (from the repository root):
+    python -m benchmarks.run                          # full suite, compared against benchmarks/baseline.json
+    python -m benchmarks.run --quick load_templates   # small sizes of the given workloads only
+    python -m benchmarks.run --save-baseline          # store the results as the new baseline
+    python -m benchmarks.run --check                  # exit with a non-zero exit code on regressions
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import traceback
+import resource
+import tempfile
+import multiprocessing
+from benchmarks.workloads import WORKLOADS, CALIBRATION_SIZE, calibration
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+# times the calibration workload runs before and after each case
+CALIBRATION_ITERATIONS = 3
+
+
+class BenchmarkException(Exception):
+    pass
+
+
+def timed(run):
+    start = time.time()
+    run()
+    return time.time() - start
+
+
+def measure(name, size, min_seconds):
+    """
+    Run a single workload/size until at least `min_seconds` have passed (and at least 3 times). The calibration
+    workload runs right before and after it, in the same process, so that both are timed under the same conditions
+
+    :return: dictionary of seconds per iteration (best of all iterations), seconds relative to the calibration
+             workload, items per second and peak RSS
+    :rtype: dict
+    """
+
+    workload, _, _, _ = WORKLOADS[name]
+    directory = tempfile.mkdtemp(prefix='rainbow-benchmark-')
+    try:
+        run, items = workload(size, directory)
+        calibrate, _ = calibration(CALIBRATION_SIZE, directory)
+
+        # warm up
+        run()
+        calibrate()
+
+        calibration_timings = [timed(calibrate) for _ in xrange(CALIBRATION_ITERATIONS)]
+
+        timings = []
+        started = time.time()
+        while len(timings) < 3 or time.time() - started < min_seconds:
+            timings.append(timed(run))
+
+        calibration_timings.extend(timed(calibrate) for _ in xrange(CALIBRATION_ITERATIONS))
+    finally:
+        shutil.rmtree(directory)
+
+    seconds = min(timings)
+    calibration_seconds = min(calibration_timings)
+    return {
+        'seconds': seconds,
+        'calibration_seconds': calibration_seconds,
+        'relative': seconds / calibration_seconds,
+        'items_per_second': items / seconds if seconds else None,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        'iterations': len(timings)
+    }
+
+
+def _measure_in_child(queue, name, size, min_seconds):
+    try:
+        queue.put(measure(name, size, min_seconds))
+    except Exception:
+        queue.put({'error': traceback.format_exc()})
+
+
+def measure_isolated(name, size, min_seconds):
+    """
+    measure() in a new process
+    """
+
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_in_child, args=(queue, name, size, min_seconds))
+    process.start()
+    result = queue.get()
+    process.join()
+
+    if 'error' in result:
+        raise BenchmarkException('%s/%d failed:\n%s' % (name, size, result['error']))
+
+    return result
+
+
+def slowdown(result, baseline_result):
+    """
+    :return: how many times slower `result` is than `baseline_result`, relative to the calibration workload of their
+             runs. Baselines saved without calibration are compared by absolute timings
+    :rtype: float
+    """
+
+    if 'relative' in result and 'relative' in baseline_result:
+        return result['relative'] / baseline_result['relative']
+    else:
+        return result['seconds'] / baseline_result['seconds']
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of (case, slowdown) of cases slower than their baseline by more than `tolerance`
+    :rtype: list
+    """
+
+    regressions = []
+    for case, result in results.iteritems():
+        if case in baseline:
+            case_slowdown = slowdown(result, baseline[case])
+            if case_slowdown > 1 + tolerance:
+                regressions.append((case, case_slowdown))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run rainbow benchmarks')
+    parser.add_argument('workloads', metavar='WORKLOAD', nargs='*',
+                        help='Workloads to run (default: all of %s)' % (', '.join(WORKLOADS),))
+    parser.add_argument('--quick', action='store_true', help='Run the small sizes only')
+    parser.add_argument('--min-seconds', metavar='SECONDS', type=float, default=1,
+                        help='Repeat each case for at least SECONDS (default: %(default)s)')
+    parser.add_argument('--baseline', metavar='FILE', default=DEFAULT_BASELINE,
+                        help='Baseline results to compare against (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the results in --baseline, merged with the cases that were not run')
+    parser.add_argument('--tolerance', metavar='RATIO', type=float, default=0.5,
+                        help='Report cases slower than the baseline by more than RATIO (default: %(default)s)')
+    parser.add_argument('--check', action='store_true', help='Exit with a non-zero exit code on regressions')
+    parser.add_argument('--json', metavar='FILE', help='Write the results to FILE')
+
+    args = parser.parse_args()
+
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error('unknown workload %s' % (name,))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    if any('relative' not in result for result in baseline.itervalues()):
+        print 'WARNING: %s has no calibration, comparing absolute timings. Regenerate it with --save-baseline' % (
+            args.baseline,)
+
+    results = {}
+    print '%-40s %12s %16s %10s %10s' % ('case', 'ms/iter', 'items/s', 'peak MB', 'baseline')
+
+    for name in args.workloads or WORKLOADS.keys():
+        _, sizes, quick_sizes, unit = WORKLOADS[name]
+        for size in quick_sizes if args.quick else sizes:
+            case = '%s/%d' % (name, size)
+            result = results[case] = measure_isolated(name, size, args.min_seconds)
+
+            relative = ''
+            if case in baseline:
+                relative = '%.2fx' % (slowdown(result, baseline[case]),)
+
+            print '%-40s %12.3f %16s %10.1f %10s' % (case, result['seconds'] * 1000,
+                                                     '%.0f %s' % (result['items_per_second'], unit),
+                                                     result['peak_rss_mb'], relative)
+            sys.stdout.flush()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print 'Baseline saved to %s' % (args.baseline,)
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for case, case_slowdown in regressions:
+        print 'REGRESSION: %s is %.2fx slower than the baseline' % (case, case_slowdown)
+
+    if regressions and args.check:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
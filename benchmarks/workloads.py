@@ -0,0 +1,205 @@
+"""
+Synthetic workloads for benchmarks.run.
+
+Each workload is a function taking a size and a scratch directory, and returning (run, items): `run` is a callable
+performing one iteration of the benchmarked stage, `items` is the number of items (resources, lookups, etc) an
+iteration processes, used to report throughput.
+"""
+import os
+import copy
+import json
+import yaml
+from collections import OrderedDict
+from rainbow.cloudformation import Cloudformation
+from rainbow.datasources import DataSourceCollection
+from rainbow.datasources.cfn_datasource import CfnDataSourceBase
+from rainbow.preprocessor import Preprocessor
+from rainbow.templates import TemplateLoader, cfn_deep_merge_all
+from rainbow.yaml_loader import RainbowYamlLoader, IncludeCache
+from benchmarks.fake_cloudformation import FakeStack, FakeConnectionPool
+
+# number of resources in each layer of the cfn_deep_merge workload
+MERGE_LAYER_RESOURCES = 200
+
+# number of independent pointer chains running through the data sources of the pointer_chains workload
+POINTER_CHAINS = 20
+
+# number of outputs, resources and parameters of each stack of the cfn_datasources workload
+STACK_ITEMS = 100
+
+
+def generate_resource(i, layer=0):
+    return {
+        'Type': 'AWS::EC2::Instance',
+        'Properties': {
+            'InstanceType': {'Rb::InstanceChooser': ['c3.large', '$InstanceType']},
+            'ImageId': {'Ref': 'ImageId'},
+            'Tags': [{'Key': 'Name', 'Value': 'instance-%d' % (i,)}, {'Key': 'Layer', 'Value': str(layer)}],
+            'BlockDeviceMappings': [{'DeviceName': '/dev/sd%s' % (c,),
+                                     'Ebs': {'VolumeSize': 100 + layer, 'DeleteOnTermination': True}}
+                                    for c in 'bcdef'],
+            'UserData': {'Fn::Base64': {'Fn::Join': ['', ['#!/bin/bash\n', {'Ref': 'AWS::StackName'}] * 10]}}
+        },
+        'Metadata': {'Layer%d' % (layer,): {'Generated': True}}
+    }
+
+
+def generate_template(resources, layer=0, parameters=0):
+    template = {
+        'Parameters': {'ImageId': {'Type': 'String'}},
+        'Resources': {'Instance%d' % (i,): generate_resource(i, layer) for i in xrange(resources)},
+        'Outputs': {'Instance%d' % (i,): {'Value': {'Ref': 'Instance%d' % (i,)}} for i in xrange(0, resources, 10)}
+    }
+
+    for i in xrange(parameters):
+        template['Parameters']['Parameter%d' % (i,)] = {'Type': 'String'}
+
+    return template
+
+
+def write_yaml(directory, name, data):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as f:
+        yaml.safe_dump(data, f, default_flow_style=False)
+    return path
+
+
+def load_templates(size, directory):
+    path = write_yaml(directory, 'template.yaml', generate_template(size))
+
+    def run():
+        RainbowYamlLoader.include_cache = IncludeCache()
+        TemplateLoader.load_templates([path])
+
+    return run, size
+
+
+def cfn_deep_merge(size, directory):
+    layers = [generate_template(MERGE_LAYER_RESOURCES, layer) for layer in xrange(size)]
+
+    def run():
+        cfn_deep_merge_all([{}] + layers)
+
+    return run, size * MERGE_LAYER_RESOURCES
+
+
+def preprocess(size, directory):
+    datasources = [write_yaml(directory, 'instances.yaml', {'InstanceType': 'c1.medium'})]
+    datasource_collection = DataSourceCollection(['yaml:%s' % (path,) for path in datasources])
+
+    # '$InstanceType' is a pointer only when loaded by the rainbow YAML loader
+    path = write_yaml(directory, 'template.yaml', generate_template(size))
+    template = TemplateLoader.load_templates([path])
+    preprocessor = Preprocessor(datasource_collection=datasource_collection, region='us-east-1')
+
+    def run():
+        preprocessor.process(template)
+
+    return run, size
+
+
+def pointer_chains(size, directory):
+    """
+    `size` YAML data sources. Source i holds the i-th link of every chain, pointing to a key of source i + 1
+    """
+
+    datasources = []
+    for i in xrange(size):
+        data = {}
+        for chain in xrange(POINTER_CHAINS):
+            if i == size - 1:
+                data['Chain%d_%d' % (chain, i)] = 'value-%d' % (chain,)
+            else:
+                data['Chain%d_%d' % (chain, i)] = '$Chain%d_%d' % (chain, i + 1)
+        datasources.append('yaml:%s' % (write_yaml(directory, 'datasource%d.yaml' % (i,), data),))
+
+    heads = ['Chain%d_0' % (chain,) for chain in xrange(POINTER_CHAINS)]
+
+    def run():
+        RainbowYamlLoader.include_cache = IncludeCache()
+        datasource_collection = DataSourceCollection(datasources)
+        for head in heads:
+            datasource_collection.get_parameter_recursive(head)
+
+    return run, size * POINTER_CHAINS
+
+
+def cfn_datasources(size, directory):
+    """
+    cfn_outputs, cfn_resources and cfn_parameters data sources of `size` stacks, served by a fake connection
+    """
+
+    stacks = {}
+    for i in xrange(size):
+        name = 'stack%d' % (i,)
+        stacks[name] = FakeStack(name,
+                                 outputs={'Output%d' % (j,): 'output-%d-%d' % (i, j) for j in xrange(STACK_ITEMS)},
+                                 resources={'Resource%d' % (j,): '%s-Resource%d-ABCDEFGH' % (name, j)
+                                            for j in xrange(STACK_ITEMS)},
+                                 parameters={'Parameter%d' % (j,): 'parameter-%d-%d' % (i, j)
+                                             for j in xrange(STACK_ITEMS)})
+
+    Cloudformation.default_region = 'us-east-1'
+    Cloudformation.connection_pool = FakeConnectionPool({'us-east-1': stacks})
+
+    datasources = ['%s:%s' % (kind, name) for name in sorted(stacks)
+                   for kind in ('cfn_outputs', 'cfn_resources', 'cfn_parameters')]
+
+    def run():
+        CfnDataSourceBase.stack_cache.clear()
+        datasource_collection = DataSourceCollection(datasources)
+        datasource_collection.get_parameter_recursive('Output0')
+
+    return run, len(datasources)
+
+
+def resolve_template_parameters(size, directory):
+    template = generate_template(10, parameters=size)
+    parameters = {'Parameter%d' % (i,): 'value-%d' % (i,) for i in xrange(size)}
+    parameters['ImageId'] = 'ami-12345678'
+    path = write_yaml(directory, 'parameters.yaml', parameters)
+    datasource_collection = DataSourceCollection(['yaml:%s' % (path,)])
+
+    def run():
+        Cloudformation.resolve_template_parameters(template, datasource_collection)
+
+    return run, size
+
+
+def serialize_template(size, directory):
+    template = generate_template(size)
+
+    def run():
+        Cloudformation.serialize_template(template)
+
+    return run, size
+
+
+def calibration(size, directory):
+    """
+    Fixed pure Python work that doesn't involve rainbow. benchmarks.run times it along with every case and compares
+    cases by their time relative to it, so that results of different machines can be compared
+    """
+
+    template = generate_template(50)
+
+    def run():
+        for _ in xrange(size):
+            json.loads(json.dumps(copy.deepcopy(template), sort_keys=True))
+
+    return run, size
+
+
+# size of the calibration workload
+CALIBRATION_SIZE = 2
+
+# workload name -> (workload, sizes, quick sizes, item unit)
+WORKLOADS = OrderedDict([
+    ('load_templates', (load_templates, [10, 100, 500, 2000], [10, 100], 'resources')),
+    ('cfn_deep_merge', (cfn_deep_merge, [1, 5, 20], [1, 5], 'resources')),
+    ('preprocess', (preprocess, [10, 100, 500, 2000], [10, 100], 'resources')),
+    ('pointer_chains', (pointer_chains, [10, 50, 200], [10], 'lookups')),
+    ('cfn_datasources', (cfn_datasources, [10, 100], [10], 'datasources')),
+    ('resolve_template_parameters', (resolve_template_parameters, [50, 500], [50], 'parameters')),
+    ('serialize_template', (serialize_template, [100, 2000], [100], 'resources')),
+])
@@ -1,9 +1,18 @@
+import sys
 import time
 import json
+import random
+import logging
+import hashlib
+import heapq
 import itertools
+import socket
+import threading
 import boto.cloudformation
 import boto.exception
+from rainbow.profiler import phase, instrument_connection
 
+logger = logging.getLogger('rainbow')
 
 def boto_all(func, *args, **kwargs):
     """
@@ -32,10 +41,365 @@ class StackFailStatus(StackStatus):
     pass
 
 
+class StackTimeoutStatus(StackFailStatus):
+    pass
+
+
 class CloudformationException(Exception):
     pass
 
 
+class PollingPolicy(object):
+    """
+    Controls how often tail_stack_events() polls Cloudformation.
+    The polling interval starts at `initial_interval` and grows exponentially by `multiplier` up to `max_interval`
+    while nothing happens. Whenever new events arrive, it's reset back to `initial_interval`.
+    """
+
+    def __init__(self, initial_interval=2, max_interval=20, multiplier=1.5, jitter=0.25, timeout=None,
+                 fail_fast=False):
+        """
+        :param initial_interval: seconds to wait between polls when the stack is changing
+        :type initial_interval: float
+        :param max_interval: maximal number of seconds to wait between polls
+        :type max_interval: float
+        :param multiplier: interval growth factor when no new events arrive
+        :type multiplier: float
+        :param jitter: randomize every interval by up to +/- this fraction of it
+        :type jitter: float
+        :param timeout: give up tailing after this many seconds, yielding StackTimeoutStatus. None means never
+        :type timeout: float or None
+        :param fail_fast: yield StackFailStatus as soon as any resource reports a *_FAILED status, rather than waiting
+                          for the stack to reach a final status
+        :type fail_fast: bool
+        """
+
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.multiplier = multiplier
+        self.jitter = jitter
+        self.timeout = timeout
+        self.fail_fast = fail_fast
+
+    def next_interval(self, interval, new_events):
+        """
+        :param interval: the previous interval (without jitter), None on the first poll
+        :type interval: float or None
+        :param new_events: whether the last poll returned new events
+        :type new_events: bool
+        :return: the next interval (without jitter)
+        :rtype: float
+        """
+
+        if interval is None or new_events:
+            return self.initial_interval
+        else:
+            return min(interval * self.multiplier, self.max_interval)
+
+    def jittered(self, interval):
+        """
+        :return: `interval`, randomized by up to +/- `jitter` of it
+        :rtype: float
+        """
+
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def sleep(self, interval):
+        """
+        Sleep for `interval` seconds, with jitter
+        """
+
+        time.sleep(self.jittered(interval))
+
+
+class RetryPolicy(object):
+    """
+    Controls how Cloudformation API calls are retried.
+    Throttling errors are always retried: the request has been rejected before doing anything. Other transient errors
+    (5xx responses, socket errors) are retried only for calls that are safe to repeat.
+    Retries wait a random time between 0 and `base_delay` * 2 ^ attempt, capped at `max_delay` ("full jitter"), so
+    many throttled clients don't retry in lockstep.
+    """
+
+    throttling_error_codes = ('Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException')
+
+    def __init__(self, max_attempts=8, base_delay=0.5, max_delay=20):
+        """
+        :param max_attempts: maximal number of attempts per call, including the first one
+        :type max_attempts: int
+        :param base_delay: delay cap of the first retry, in seconds
+        :type base_delay: float
+        :param max_delay: maximal delay between attempts, in seconds
+        :type max_delay: float
+        """
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def is_throttling(self, ex):
+        return isinstance(ex, boto.exception.BotoServerError) and ex.error_code in self.throttling_error_codes
+
+    def should_retry(self, ex, attempt, idempotent=True):
+        """
+        :param ex: the error the call failed with
+        :type ex: Exception
+        :param attempt: number of attempts made so far
+        :type attempt: int
+        :param idempotent: whether the call is safe to repeat after an unknown outcome
+        :type idempotent: bool
+        :rtype: bool
+        """
+
+        if attempt >= self.max_attempts:
+            return False
+        elif self.is_throttling(ex):
+            return True
+        elif not idempotent:
+            return False
+        elif isinstance(ex, boto.exception.BotoServerError):
+            return ex.status >= 500
+        else:
+            return isinstance(ex, socket.error)
+
+    def delay(self, attempt):
+        """
+        :param attempt: number of attempts made so far
+        :type attempt: int
+        :return: seconds to wait before the next attempt
+        :rtype: float
+        """
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, allowing `rate` acquisitions per second on average, in bursts of up to `burst`
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: tokens added per second
+        :type rate: float
+        :param burst: bucket capacity. None means max(1, rate)
+        :type burst: float
+        """
+
+        self.rate = float(rate)
+        self.capacity = burst or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, waiting for one if the bucket is empty.
+        Waiting threads reserve their tokens up front, so they're served in the order they arrived.
+        """
+
+        with self._lock:
+            now = time.time()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait:
+            time.sleep(wait)
+
+
+class RateLimiter(object):
+    """
+    Process wide limit on the rate of Cloudformation API calls, with a token bucket per region.
+    Cloudformation throttles per account and region, so every thread calling the same region shares its bucket.
+    """
+
+    def __init__(self, rate=None, burst=None, region_rates=None):
+        """
+        :param rate: calls per second allowed on each region. None means unlimited
+        :type rate: float or None
+        :param burst: maximal burst of calls, see TokenBucket
+        :type burst: float or None
+        :param region_rates: dictionary of region to its calls per second, overriding `rate`
+        :type region_rates: dict
+        """
+
+        self.rate = rate
+        self.burst = burst
+        self.region_rates = dict(region_rates or {})
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, region):
+        """
+        Wait until a call to `region` is allowed
+
+        :type region: str
+        """
+
+        with self._lock:
+            if region not in self._buckets:
+                rate = self.region_rates.get(region, self.rate)
+                self._buckets[region] = TokenBucket(rate, self.burst) if rate else None
+
+            bucket = self._buckets[region]
+
+        if bucket:
+            bucket.acquire()
+
+
+class CloudformationConnectionPool(object):
+    """
+    Process wide, thread safe registry of boto Cloudformation connections, keyed by region and connection parameters
+    (credentials, profile name, etc).
+    boto connections keep their underlying HTTP connections alive, so sharing them saves the connection setup and TLS
+    handshake of every Cloudformation object created during the run.
+    """
+
+    def __init__(self):
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get_connection(self, region, **kw_params):
+        """
+        Get a boto Cloudformation connection to `region`, creating it if needed
+
+        :param region: AWS region
+        :type region: str
+        :param kw_params: additional parameters to boto.cloudformation.connect_to_region (aws_access_key_id, etc)
+        :return: boto Cloudformation connection
+        :rtype: boto.cloudformation.connection.CloudFormationConnection
+        """
+
+        key = (region, tuple(sorted(kw_params.items())))
+
+        with self._lock:
+            if key not in self._connections:
+                self._connections[key] = instrument_connection(self._connect(region, **kw_params))
+
+            return self._connections[key]
+
+    def _connect(self, region, **kw_params):
+        """
+        Create a new connection. Subclasses may override it to provide connections of their own
+        (see rainbow.replay)
+        """
+
+        connection = boto.cloudformation.connect_to_region(region, **kw_params)
+
+        if not connection:
+            raise CloudformationException('Invalid region %s' % (region,))
+
+        return connection
+
+    def clear(self):
+        """
+        Forget all pooled connections
+        """
+
+        with self._lock:
+            self._connections.clear()
+
+
+class StackRegistry(object):
+    """
+    Run scoped, thread safe registry of stack statuses, keyed by (region, stack name).
+    Stacks are looked up by name with a single DescribeStacks call and cached. When many stacks of a region are going to
+    be checked, snapshot() indexes all of the region's stacks with a single (paginated) ListStacks listing instead.
+    """
+
+    def __init__(self):
+        self._statuses = {}
+        self._snapshots = set()
+        self._stale = set()
+        self._lock = threading.Lock()
+
+    def stack_status(self, cloudformation, name):
+        """
+        :param cloudformation: Cloudformation object of the stack region
+        :type cloudformation: Cloudformation
+        :param name: stack name
+        :type name: str
+        :return: stack status, None if the stack doesn't exist
+        :rtype: str or None
+        """
+
+        key = (cloudformation.region, name)
+
+        with self._lock:
+            if key in self._statuses:
+                return self._statuses[key]
+            elif cloudformation.region in self._snapshots and key not in self._stale:
+                # the snapshot has all the stacks of the region
+                return None
+
+        try:
+            status = cloudformation.describe_stack(name).stack_status
+        except boto.exception.BotoServerError, ex:
+            if ex.status == 400 and 'does not exist' in (ex.message or ''):
+                status = None
+            else:
+                raise
+
+        with self._lock:
+            self._statuses[key] = status
+            self._stale.discard(key)
+
+        return status
+
+    def stack_exists(self, cloudformation, name):
+        """
+        :param cloudformation: Cloudformation object of the stack region
+        :type cloudformation: Cloudformation
+        :param name: stack name
+        :type name: str
+        :rtype: bool
+        """
+
+        return self.stack_status(cloudformation, name) not in (None, 'DELETE_COMPLETE')
+
+    def snapshot(self, cloudformation):
+        """
+        Index all the (non deleted) stacks of a region
+
+        :param cloudformation: Cloudformation object of the region
+        :type cloudformation: Cloudformation
+        """
+
+        # conserve bandwidth (and API calls) by not listing any stacks in DELETE_COMPLETE state
+        stacks = boto_all(cloudformation.call, cloudformation.connection.list_stacks,
+                          [state for state in Cloudformation.VALID_STACK_STATUSES if state != 'DELETE_COMPLETE'])
+
+        with self._lock:
+            for stack in stacks:
+                key = (cloudformation.region, stack.stack_name)
+                self._statuses[key] = stack.stack_status
+                self._stale.discard(key)
+
+            self._snapshots.add(cloudformation.region)
+
+    def invalidate(self, region, name):
+        """
+        Forget the status of a stack, i.e. after creating or updating it
+
+        :param region: AWS region
+        :type region: str
+        :param name: stack name
+        :type name: str
+        """
+
+        with self._lock:
+            self._statuses.pop((region, name), None)
+            self._stale.add((region, name))
+
+    def clear(self):
+        with self._lock:
+            self._statuses.clear()
+            self._snapshots.clear()
+            self._stale.clear()
+
+
 class Cloudformation(object):
     # this is from http://docs.aws.amazon.com/AWSCloudFormation/latest/APIReference/API_Stack.html
     # boto.cloudformation.stack.StackEvent.valid_states doesn't have the full list.
@@ -45,18 +409,77 @@ class Cloudformation(object):
                             'UPDATE_COMPLETE', 'UPDATE_ROLLBACK_IN_PROGRESS', 'UPDATE_ROLLBACK_FAILED',
                             'UPDATE_ROLLBACK_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_ROLLBACK_COMPLETE']
 
+    # statuses of stacks whose last create/update succeeded
+    SUCCESSFUL_STACK_STATUSES = ('CREATE_COMPLETE', 'UPDATE_COMPLETE')
+
     default_region = 'us-east-1'
 
-    def __init__(self, region=None):
+    default_polling_policy = PollingPolicy()
+
+    retry_policy = RetryPolicy()
+
+    # shared by all Cloudformation objects (and threads) of the process
+    rate_limiter = RateLimiter()
+
+    # maximal TemplateBody size
+    # see http://docs.aws.amazon.com/AWSCloudFormation/latest/UserGuide/cloudformation-limits.html
+    max_template_body_size = 51200
+
+    # optional rainbow.template_uploader.TemplateUploader, for templates bigger than max_template_body_size
+    template_uploader = None
+
+    # stack tag holding the hash of the template and parameters the stack was last created/updated with
+    content_hash_tag = 'rainbow:content-hash'
+
+    connection_pool = CloudformationConnectionPool()
+
+    stack_registry = StackRegistry()
+
+    def __init__(self, region=None, **kw_params):
         """
         :param region: AWS region
         :type region: str
+        :param kw_params: additional parameters to boto.cloudformation.connect_to_region (aws_access_key_id, etc)
+        """
+
+        self.region = region or Cloudformation.default_region
+        self.connection = Cloudformation.connection_pool.get_connection(self.region, **kw_params)
+
+    def call(self, func, *args, **kwargs):
         """
+        Call a boto connection method under the rate limiter, retrying throttling and transient errors according to
+        the retry policy. Use it only for calls that are safe to repeat, see call_once()
+
+        :param func: bound boto connection method, i.e. self.connection.describe_stacks
+        :return: whatever `func` returns
+        """
+
+        return self._call(func, args, kwargs, True)
+
+    def call_once(self, func, *args, **kwargs):
+        """
+        Like call(), for calls that must not be repeated if their outcome is unknown (i.e. create_stack()). Only
+        throttled calls, which were rejected before taking effect, are retried
+        """
+
+        return self._call(func, args, kwargs, False)
+
+    def _call(self, func, args, kwargs, idempotent):
+        attempt = 0
+
+        while True:
+            Cloudformation.rate_limiter.acquire(self.region)
+            attempt += 1
 
-        self.connection = boto.cloudformation.connect_to_region(region or Cloudformation.default_region)
+            try:
+                return func(*args, **kwargs)
+            except (boto.exception.BotoServerError, socket.error), ex:
+                if not self.retry_policy.should_retry(ex, attempt, idempotent):
+                    raise
 
-        if not self.connection:
-            raise CloudformationException('Invalid region %s' % (region or Cloudformation.default_region,))
+                delay = self.retry_policy.delay(attempt)
+                logger.debug('%s failed (%s), retrying in %.2f seconds', getattr(func, '__name__', func), ex, delay)
+                time.sleep(delay)
 
     @staticmethod
     def resolve_template_parameters(template, datasource_collection):
@@ -70,15 +493,21 @@ class Cloudformation(object):
         :return: parameters parameter for update_stack() or create_stack()
         """
 
+        parameter_definitions = template.get('Parameters', {})
+        resolved_parameters = datasource_collection.get_parameters_recursive(parameter_definitions.keys())
+
         parameters = {}
-        for parameter, parameter_definition in template.get('Parameters', {}).iteritems():
-            if 'Default' in parameter_definition and not parameter in datasource_collection:
-                parameter_value = parameter_definition['Default']
-            else:
-                parameter_value = datasource_collection.get_parameter_recursive(parameter)
+        for parameter, parameter_definition in parameter_definitions.iteritems():
+            if parameter in resolved_parameters:
+                parameter_value = resolved_parameters[parameter]
 
                 if hasattr(parameter_value, '__iter__'):
                     parameter_value = ','.join(map(str, parameter_value))
+            elif 'Default' in parameter_definition:
+                parameter_value = parameter_definition['Default']
+            else:
+                # raises InvalidParameterException
+                parameter_value = datasource_collection.get_parameter_recursive(parameter)
 
             parameters[parameter] = parameter_value
 
@@ -93,12 +522,112 @@ class Cloudformation(object):
         :rtype: bool
         """
 
-        # conserve bandwidth (and API calls) by not listing any stacks in DELETE_COMPLETE state
-        active_stacks = boto_all(self.connection.list_stacks, [state for state in Cloudformation.VALID_STACK_STATUSES
-                                                               if state != 'DELETE_COMPLETE'])
-        return name in [stack.stack_name for stack in active_stacks if stack.stack_status]
+        return Cloudformation.stack_registry.stack_exists(self, name)
+
+    @staticmethod
+    def serialize_template(template):
+        """
+        Serialize a template as compact JSON, with sorted keys so the same template always serializes the same
+
+        :param template: JSON encodeable object
+        :type template: dict
+        :rtype: str
+        """
+
+        return json.dumps(template, separators=(',', ':'), sort_keys=True)
+
+    def template_arguments(self, template):
+        """
+        Serialize a template, uploading it with `template_uploader` if it's too big to be sent as is
+
+        :param template: JSON encodeable object
+        :type template: dict
+        :return: template_body or template_url keyword argument for boto's create_stack()/update_stack()
+        :rtype: dict
+        """
+
+        with phase('serialize_template'):
+            body = self.serialize_template(template)
+
+        if len(body) <= self.max_template_body_size:
+            logger.debug('Template size is %d bytes', len(body))
+            return {'template_body': body}
+
+        if not self.template_uploader:
+            raise CloudformationException('Template size (%d bytes) exceeds the %d bytes limit, a template uploader '
+                                          'is required' % (len(body), self.max_template_body_size))
+
+        with phase('upload_template'):
+            template_url = self.template_uploader.for_region(self.region).upload(body)
+        logger.info('Template size is %d bytes, uploaded to %s', len(body), template_url)
+
+        return {'template_url': template_url}
+
+    @classmethod
+    def content_hash(cls, template, parameters):
+        """
+        :param template: JSON encodeable object
+        :type template: dict
+        :param parameters: dictionary containing key value pairs as CFN parameters
+        :type parameters: dict
+        :return: canonical hash of the rendered template and its parameters
+        :rtype: str
+        """
+
+        return hashlib.sha1(cls.serialize_template({'Template': template, 'Parameters': parameters})).hexdigest()
+
+    def content_hash_tags(self, name, template, parameters, update):
+        """
+        Build the stack tags recording the content hash of `template` and `parameters`, and check whether the
+        deployed stack was already created/updated successfully with the same content
+
+        :param name: stack name
+        :type name: str
+        :param template: JSON encodeable object
+        :type template: dict
+        :param parameters: dictionary containing key value pairs as CFN parameters
+        :type parameters: dict
+        :param update: whether the stack is about to be updated (rather than created)
+        :type update: bool
+        :return: (tags to pass to create_stack()/update_stack(), True if the deployed stack has the same content and
+                  is in a successful status)
+        :rtype: tuple
+        """
+
+        content_hash = self.content_hash(template, parameters)
 
-    def update_stack(self, name, template, parameters):
+        if not update:
+            return {self.content_hash_tag: content_hash}, False
+
+        # tags given to update_stack() replace all of the stack tags, keep the others
+        stack = self.describe_stack(name)
+        tags = dict(stack.tags or {})
+
+        # a failed stack may carry the hash of the content it failed to deploy
+        unchanged = tags.get(self.content_hash_tag) == content_hash and \
+            stack.stack_status in Cloudformation.SUCCESSFUL_STACK_STATUSES
+        tags[self.content_hash_tag] = content_hash
+
+        return tags, unchanged
+
+    def current_status(self, name):
+        """
+        Final status of a stack that isn't being created/updated, i.e. after update_stack() had nothing to update
+
+        :param name: stack name
+        :type name: str
+        :return: StackSuccessStatus if the stack's last create/update succeeded, StackFailStatus otherwise
+        :rtype: StackStatus
+        """
+
+        stack_status = self.describe_stack(name).stack_status
+
+        if stack_status in Cloudformation.SUCCESSFUL_STACK_STATUSES:
+            return StackSuccessStatus(stack_status)
+        else:
+            return StackFailStatus(stack_status)
+
+    def update_stack(self, name, template, parameters, tags=None):
         """
         Update CFN stack
 
@@ -108,13 +637,17 @@ class Cloudformation(object):
         :type template: str
         :param parameters: dictionary containing key value pairs as CFN parameters
         :type parameters: dict
+        :param tags: stack tags. None means leaving the stack tags as they are
+        :type tags: dict
         :rtype: bool
         :return: False if there aren't any updates to be performed, True if no exception has been thrown.
         """
 
+        Cloudformation.stack_registry.invalidate(self.region, name)
+
         try:
-            self.connection.update_stack(name, json.dumps(template), disable_rollback=True,
-                                         parameters=parameters.items(), capabilities=['CAPABILITY_IAM'])
+            self.call_once(self.connection.update_stack, name, disable_rollback=True, parameters=parameters.items(),
+                           capabilities=['CAPABILITY_IAM'], tags=tags, **self.template_arguments(template))
         except boto.exception.BotoServerError, ex:
             if ex.message == 'No updates are to be performed.':
                 # this is not really an error, but there aren't any updates.
@@ -124,7 +657,7 @@ class Cloudformation(object):
         else:
             return True
 
-    def create_stack(self, name, template, parameters):
+    def create_stack(self, name, template, parameters, tags=None):
         """
         Create CFN stack
 
@@ -134,11 +667,15 @@ class Cloudformation(object):
         :type template: str
         :param parameters: dictionary containing key value pairs as CFN parameters
         :type parameters: dict
+        :param tags: stack tags
+        :type tags: dict
         """
 
+        Cloudformation.stack_registry.invalidate(self.region, name)
+
         try:
-            self.connection.create_stack(name, json.dumps(template), disable_rollback=True,
-                                         parameters=parameters.items(), capabilities=['CAPABILITY_IAM'])
+            self.call_once(self.connection.create_stack, name, disable_rollback=True, parameters=parameters.items(),
+                           capabilities=['CAPABILITY_IAM'], tags=tags, **self.template_arguments(template))
         except boto.exception.BotoServerError, ex:
             raise CloudformationException('error occured while creating stack %s: %s' % (name, ex.message))
 
@@ -152,7 +689,40 @@ class Cloudformation(object):
         :rtype: list of boto.cloudformation.stack.StackEvent
         """
 
-        return boto_all(self.connection.describe_stack_events, name)
+        return boto_all(self.call, self.connection.describe_stack_events, name)
+
+    def describe_stack_events_since(self, name, event_id=None, limit=None):
+        """
+        Describe CFN stack events newer than `event_id`, paging only until `event_id` is reached
+
+        :param name: stack name
+        :type name: str
+        :param event_id: id of the last seen event (exclusive). None means all events
+        :type event_id: str or None
+        :param limit: stop after this many events. None means no limit
+        :type limit: int or None
+        :return: stack events, sorted from newest to oldest
+        :rtype: list of boto.cloudformation.stack.StackEvent
+        """
+
+        events = []
+        next_token = None
+
+        while True:
+            page = self.call(self.connection.describe_stack_events, name, next_token=next_token)
+
+            for event in page:
+                if event_id is not None and event.event_id == event_id:
+                    return events
+
+                events.append(event)
+
+                if limit is not None and len(events) >= limit:
+                    return events
+
+            next_token = page.next_token
+            if not next_token:
+                return events
 
     def describe_stack(self, name):
         """
@@ -163,68 +733,351 @@ class Cloudformation(object):
         :rtype: boto.cloudformation.stack.Stack
         """
 
-        return self.connection.describe_stacks(name)[0]
+        return self.call(self.connection.describe_stacks, name)[0]
+
+    def iter_stack_resources(self, name):
+        """
+        Page through the resources of stack `name` with ListStackResources, which (unlike DescribeStackResources)
+        isn't limited to the first 100 resources. Only the logical and physical ids of the resources are kept
 
-    def tail_stack_events(self, name, initial_entry=None):
+        :param name: stack name or id
+        :return: generator of pages, each a list of (logical resource id, physical resource id) tuples
+        :rtype: generator
+        """
+
+        next_token = None
+
+        while True:
+            page = self.call(self.connection.list_stack_resources, name, next_token)
+            yield [(resource.logical_resource_id, resource.physical_resource_id) for resource in page]
+
+            next_token = page.next_token
+            if not next_token:
+                return
+
+    def tail_stack_events(self, name, initial_entry=None, cursor=None, polling_policy=None):
         """
         This function is a wrapper around _tail_stack_events(), because a generator function doesn't run any code
         before the first iterator item is accessed (aka .next() is called).
         This function can be called without an `inital_entry` and tail the stack events from the bottom.
 
         Each iteration returns either:
-        1. StackFailStatus object which indicates the stack creation/update failed (last iteration)
+        1. StackFailStatus object which indicates the stack creation/update failed (last iteration). A
+           StackTimeoutStatus (a StackFailStatus subclass) is returned if the polling policy timeout has expired
         2. StackSuccessStatus object which indicates the stack creation/update succeeded (last iteration)
-        3. dictionary describing the stack event, containing the following keys: resource_type, logical_resource_id,
-           physical_resource_id, resource_status, resource_status_reason
+        3. dictionary describing the stack event, containing the following keys: event_id, resource_type,
+           logical_resource_id, physical_resource_id, resource_status, resource_status_reason, timestamp
 
         A common usage pattern would be to call tail_stack_events('stack') prior to running update_stack() on it,
         thus creating the iterator prior to the actual beginning of the update. Then, after initiating the update
         process, for loop through the iterator receiving the generated events and status updates.
 
+        The event_id of the last received event can be persisted and passed back as `cursor`, in order to reattach to
+        the stack without replaying events that were already seen.
+
         :param name: stack name
         :type name: str
         :param initial_entry: where to start tailing from. None means to start from the last item (exclusive)
         :type initial_entry: None or int
+        :param cursor: event id to start tailing after (exclusive). Overrides `initial_entry`
+        :type cursor: None or str
+        :param polling_policy: polling policy. None means Cloudformation.default_polling_policy
+        :type polling_policy: PollingPolicy
         :return: generator object yielding stack events
         :rtype: generator
         """
 
-        if initial_entry is None:
-            return self._tail_stack_events(name, len(self.describe_stack_events(name)))
-        elif initial_entry < 0:
-            return self._tail_stack_events(name, len(self.describe_stack_events(name)) + initial_entry)
+        polling_policy = polling_policy or Cloudformation.default_polling_policy
+
+        if cursor is None:
+            if initial_entry is None:
+                # only the newest event is needed, it's on the first page
+                events = self.describe_stack_events_since(name, limit=1)
+                cursor = events[0].event_id if events else None
+            elif initial_entry < 0:
+                events = self.describe_stack_events_since(name, limit=-initial_entry + 1)
+                cursor = events[-initial_entry].event_id if len(events) > -initial_entry else None
+            elif initial_entry > 0:
+                # counting from the oldest event requires the entire history
+                events = self.describe_stack_events(name)
+                if len(events) >= initial_entry:
+                    cursor = events[-initial_entry].event_id
+                else:
+                    cursor = events[0].event_id if events else None
+
+        return self._tail_stack_events(name, cursor, polling_policy)
+
+    def poll_stack_events(self, name, cursor, fail_fast=False):
+        """
+        Poll a stack once for its status and the events newer than `cursor`
+
+        :param name: stack name
+        :type name: str
+        :param cursor: id of the last seen event (exclusive). None means all events
+        :type cursor: str or None
+        :param fail_fast: consider the stack failed if any resource reports a *_FAILED status
+        :type fail_fast: bool
+        :return: (list of event dictionaries (see tail_stack_events()) from oldest to newest, the new cursor,
+                  StackSuccessStatus/StackFailStatus if the stack reached a final status or the stack status string)
+        :rtype: tuple
+        """
+
+        stack = self.describe_stack(name)
+        stack_events = self.describe_stack_events_since(name, cursor)
+
+        # the list is sorted from newest to oldest
+        events = [{'event_id': event.event_id,
+                   'resource_type': event.resource_type,
+                   'logical_resource_id': event.logical_resource_id,
+                   'physical_resource_id': event.physical_resource_id,
+                   'resource_status': event.resource_status,
+                   'resource_status_reason': event.resource_status_reason,
+                   'timestamp': event.timestamp} for event in stack_events[::-1]]
+
+        if stack_events:
+            cursor = stack_events[0].event_id
+
+        failed_events = [event for event in events if event['resource_status'].endswith('_FAILED')]
+
+        if fail_fast and failed_events:
+            status = StackFailStatus(failed_events[0]['resource_status'])
+        elif stack.stack_status.endswith('_FAILED') or \
+                stack.stack_status in ('ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE'):
+            status = StackFailStatus(stack.stack_status)
+        elif stack.stack_status.endswith('_COMPLETE'):
+            status = StackSuccessStatus(stack.stack_status)
         else:
-            return self._tail_stack_events(name, initial_entry)
+            status = stack.stack_status
+
+        return events, cursor, status
 
-    def _tail_stack_events(self, name, initial_entry):
+    def _tail_stack_events(self, name, cursor, polling_policy):
         """
         See tail_stack_events()
         """
 
-        previous_stack_events = initial_entry
+        deadline = time.time() + polling_policy.timeout if polling_policy.timeout is not None else None
+        interval = None
 
         while True:
-            stack = self.describe_stack(name)
-            stack_events = self.describe_stack_events(name)
-
-            if len(stack_events) > previous_stack_events:
-                # iterate on all new events, at reversed order (the list is sorted from newest to oldest)
-                for event in stack_events[:-previous_stack_events or None][::-1]:
-                    yield {'resource_type': event.resource_type,
-                           'logical_resource_id': event.logical_resource_id,
-                           'physical_resource_id': event.physical_resource_id,
-                           'resource_status': event.resource_status,
-                           'resource_status_reason': event.resource_status_reason,
-                           'timestamp': event.timestamp}
-
-                previous_stack_events = len(stack_events)
-
-            if stack.stack_status.endswith('_FAILED') or \
-                    stack.stack_status in ('ROLLBACK_COMPLETE', 'UPDATE_ROLLBACK_COMPLETE'):
-                yield StackFailStatus(stack.stack_status)
+            events, cursor, status = self.poll_stack_events(name, cursor, polling_policy.fail_fast)
+
+            for event in events:
+                yield event
+
+            if isinstance(status, StackStatus):
+                yield status
                 break
-            elif stack.stack_status.endswith('_COMPLETE'):
-                yield StackSuccessStatus(stack.stack_status)
+
+            if deadline is not None and time.time() >= deadline:
+                yield StackTimeoutStatus(status)
                 break
 
-            time.sleep(2)
+            interval = polling_policy.next_interval(interval, bool(events))
+
+            # don't sleep past the deadline, poll one last time when it arrives
+            seconds = polling_policy.jittered(interval)
+            if deadline is not None:
+                seconds = min(seconds, deadline - time.time())
+
+            time.sleep(seconds)
+
+
+class MultiStackTailer(object):
+    """
+    Tail the events of many stacks at once, under a single shared request budget.
+    Every stack is polled according to the polling policy, so stacks that keep changing are polled more often than
+    idle ones, but polls are spaced out so that no more than `polls_per_second` polls are made in total.
+
+    With `follow`, more stacks can be added by other threads while tail() is running, and those threads can wait()
+    for the final status of their stacks. tail() then keeps running until close() is called and all stacks are done.
+    """
+
+    def __init__(self, stacks=(), polls_per_second=1, polling_policy=None, cursors=None, follow=False):
+        """
+        :param stacks: list of (region, stack name)
+        :type stacks: list
+        :param polls_per_second: total polling rate, shared by all stacks. Every poll makes at least two requests
+        :type polls_per_second: float
+        :param polling_policy: per stack polling policy. None means Cloudformation.default_polling_policy. The policy
+                               timeout applies to each stack, from the time it started being tailed
+        :type polling_policy: PollingPolicy
+        :param cursors: dictionary of (region, stack name) to the event id to start tailing after (exclusive), see
+                        Cloudformation.tail_stack_events(). Stacks missing from the dictionary are tailed from their
+                        newest event
+        :type cursors: dict
+        :param follow: keep waiting for add()ed stacks until close() is called, rather than ending once all stacks
+                       are done
+        :type follow: bool
+        """
+
+        self.stacks = list(stacks)
+        self.polls_per_second = polls_per_second
+        self.polling_policy = polling_policy or Cloudformation.default_polling_policy
+        self.cursors = dict(cursors or {})
+        self.follow = follow
+
+        self._condition = threading.Condition()
+        self._closed = False
+        self._cloudformations = {}
+        self._cursors = {}
+        self._deadlines = {}
+        # heap of (next poll time, stack, current interval)
+        self._schedule = []
+        # (region, stack name) -> (final status, exc_info of a failed poll), for wait()
+        self._final_statuses = {}
+
+    def _cloudformation(self, region):
+        if region not in self._cloudformations:
+            self._cloudformations[region] = Cloudformation(region)
+        return self._cloudformations[region]
+
+    def _start(self, stack, cursor):
+        # must be called with self._condition held
+        now = time.time()
+        self._cursors[stack] = cursor
+        self._deadlines[stack] = now + self.polling_policy.timeout if self.polling_policy.timeout is not None else None
+        self._final_statuses.pop(stack, None)
+        heapq.heappush(self._schedule, (now, stack, None))
+        self._condition.notify_all()
+
+    def _finish(self, stack, status, exc_info=None):
+        with self._condition:
+            self._final_statuses[stack] = (status, exc_info)
+            self._condition.notify_all()
+
+    def add(self, stack, cursor=None):
+        """
+        Start tailing another stack. Meant for tailers created with `follow`, whose tail() is running on another thread
+
+        :param stack: (region, stack name)
+        :type stack: tuple
+        :param cursor: event id to start tailing after (exclusive). None means all events
+        :type cursor: str or None
+        """
+
+        with self._condition:
+            self._start(stack, cursor)
+
+    def wait(self, stack):
+        """
+        Wait for a stack to reach a final status. A failure to poll the stack is raised
+
+        :param stack: (region, stack name)
+        :type stack: tuple
+        :return: final status of the stack
+        :rtype: StackStatus
+        """
+
+        with self._condition:
+            while stack not in self._final_statuses:
+                self._condition.wait()
+            status, exc_info = self._final_statuses.pop(stack)
+
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        return status
+
+    def close(self):
+        """
+        Let tail() end once all the stacks it's tailing are done
+        """
+
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def _next(self, last_poll, min_gap):
+        """
+        Wait for the next poll of a stack to be due
+
+        :return: (poll time, stack, current interval), None once there's nothing left to poll
+        :rtype: tuple
+        """
+
+        while True:
+            with self._condition:
+                while not self._schedule and self.follow and not self._closed:
+                    self._condition.wait()
+
+                if not self._schedule:
+                    return None
+
+                poll_time, stack, interval = self._schedule[0]
+                if last_poll is not None:
+                    poll_time = max(poll_time, last_poll + min_gap)
+
+                now = time.time()
+                if poll_time <= now:
+                    heapq.heappop(self._schedule)
+                    return poll_time, stack, interval
+
+            # when following, sleep no longer than a poll gap at a time, so stacks added meanwhile are picked up soon
+            time.sleep(min(poll_time - now, min_gap) if self.follow else poll_time - now)
+
+    def tail(self):
+        """
+        :return: generator yielding ((region, stack name), event) tuples, where event is either a stack event
+                 dictionary or the final StackSuccessStatus/StackFailStatus of the stack (see
+                 Cloudformation.tail_stack_events()). The generator ends once all stacks have reached a final status
+                 (and close() was called, if following)
+        :rtype: generator
+        """
+
+        for stack in self.stacks:
+            if stack in self.cursors:
+                cursor = self.cursors[stack]
+            else:
+                region, name = stack
+                events = self._cloudformation(region).describe_stack_events_since(name, limit=1)
+                cursor = events[0].event_id if events else None
+
+            with self._condition:
+                self._start(stack, cursor)
+
+        min_gap = 1.0 / self.polls_per_second
+        last_poll = None
+
+        while True:
+            next_poll = self._next(last_poll, min_gap)
+            if next_poll is None:
+                return
+
+            _, stack, interval = next_poll
+            deadline = self._deadlines[stack]
+
+            region, name = stack
+            last_poll = time.time()
+            try:
+                events, self._cursors[stack], status = self._cloudformation(region).poll_stack_events(
+                    name, self._cursors[stack], self.polling_policy.fail_fast)
+            except Exception:
+                if not self.follow:
+                    raise
+
+                # don't let one stack stop the tailing of the others, its waiter gets the exception
+                status = StackFailStatus('RAINBOW_ERROR')
+                self._finish(stack, status, sys.exc_info())
+                yield stack, status
+                continue
+
+            for event in events:
+                yield stack, event
+
+            if not isinstance(status, StackStatus) and deadline is not None and last_poll >= deadline:
+                status = StackTimeoutStatus(status)
+
+            if isinstance(status, StackStatus):
+                self._finish(stack, status)
+                yield stack, status
+            else:
+                interval = self.polling_policy.next_interval(interval, bool(events))
+
+                # don't wait past the deadline, poll one last time when it arrives
+                next_poll_time = last_poll + self.polling_policy.jittered(interval)
+                if deadline is not None:
+                    next_poll_time = min(next_poll_time, deadline)
+
+                with self._condition:
+                    heapq.heappush(self._schedule, (next_poll_time, stack, interval))
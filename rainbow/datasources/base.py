@@ -1,3 +1,5 @@
+import sys
+from multiprocessing.pool import ThreadPool
 from datasource_exceptions import *
 
 
@@ -18,14 +20,58 @@ class DataSourceBaseMeta(type):
 
 
 class DataSourceBase(object):
+    """
+    A data source only parses its argument when constructed. Its data is fetched by load() on first access, or is set
+    by the constructor of data sources that predate load()
+
+    Incremental data sources fetch their data in parts, as lookups (`in`, []) need them. The data source collection
+    looks parameters up in them directly rather than indexing all their keys
+    """
+
     __metaclass__ = DataSourceBaseMeta
 
     # will be initialized to argparse.ArgumentParser command line args
     region = 'us-east-1'
 
+    incremental = False
+
     def __init__(self, data_source):
         self.data_source = data_source
-        self.data = None
+        self._data = None
+        self._loaded = False
+
+    def load(self):
+        """
+        Fetch the data of this data source
+
+        :return: dictionary of parameter to value
+        :rtype: dict
+        """
+
+        raise NotImplementedError()
+
+    def prefetch(self):
+        """
+        Fetch what an eagerly constructed data source collection should fetch up front: everything, unless the data
+        source is incremental
+        """
+
+        self.data
+
+    @property
+    def data(self):
+        if not self._loaded:
+            self.data = self.load()
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._loaded = True
+
+    @property
+    def loaded(self):
+        return self._loaded
 
     def __getitem__(self, item):
         return self.data[item]
@@ -33,15 +79,36 @@ class DataSourceBase(object):
     def __contains__(self, item):
         return item in self.data
 
+    def keys(self):
+        """
+        :return: all the keys of this data source, used for indexing the data source collection
+        :rtype: list
+        """
+
+        return self.data.keys()
+
     def __repr__(self):
-        return '<%s data_source=%r data=%r>' % (self.__class__.__name__, self.data_source, self.data)
+        return '<%s data_source=%r data=%s>' % (self.__class__.__name__, self.data_source,
+                                                repr(self._data) if self._loaded else '(not loaded)')
 
 
 class DataSourceCollection(list):
-    def __init__(self, datasources):
+    # defaults of the `concurrency` and `lazy` constructor arguments, set by main() from --datasource-concurrency and
+    # --lazy-datasources
+    concurrency = 1
+    lazy = False
+
+    def __init__(self, datasources, concurrency=None, lazy=None):
         """
         :param datasources: list of strings containing data sources. i.e.: yaml:path/to/yaml.yaml
         :type datasources: list
+        :param concurrency: maximum number of data sources to load at the same time. 1 loads them serially. Lookup
+                            order is always the order of `datasources`. None means DataSourceCollection.concurrency
+        :type concurrency: int
+        :param lazy: don't load the data sources up front. A data source is loaded the first time a lookup isn't
+                     satisfied by the data sources before it, so data sources no lookup reaches are never loaded.
+                     None means DataSourceCollection.lazy
+        :type lazy: bool
         """
 
         l = []
@@ -62,30 +129,179 @@ class DataSourceCollection(list):
 
         super(DataSourceCollection, self).__init__(l)
 
+        self._index = None
+        self._resolved = {}
+
+        if not (DataSourceCollection.lazy if lazy is None else lazy):
+            self.load(DataSourceCollection.concurrency if concurrency is None else concurrency, complete=False)
+
+    def load(self, concurrency=1, complete=True):
+        """
+        Load all the data sources that aren't loaded yet, i.e. for dumping them.
+        Data sources that failed to load are reported together in a single DataSourceConstructionException.
+
+        :param concurrency: maximum number of data sources to load at the same time, using a thread pool
+        :type concurrency: int
+        :param complete: load incremental data sources completely, rather than only prefetch them
+        :type complete: bool
+        """
+
+        def fetch(datasource):
+            if complete:
+                datasource.data
+            else:
+                datasource.prefetch()
+
+        datasources = [datasource for datasource in self if not datasource.loaded]
+
+        if concurrency <= 1 or len(datasources) <= 1:
+            # serially, the first error is raised as is
+            for datasource in datasources:
+                fetch(datasource)
+            return
+
+        def load(datasource):
+            try:
+                fetch(datasource)
+                return None
+            except Exception:
+                return sys.exc_info()
+
+        pool = ThreadPool(min(concurrency, len(datasources)))
+        try:
+            results = pool.map(load, datasources)
+        finally:
+            pool.close()
+            pool.join()
+
+        errors = [(datasource.datasource_name + ':' + datasource.data_source, exc_info)
+                  for datasource, exc_info in zip(datasources, results) if exc_info]
+        if errors:
+            raise DataSourceConstructionException(
+                "Unable to construct data sources:\n%s" % (
+                    "\n".join("  %s: %s: %s" % (datasource, exc_info[0].__name__, exc_info[1])
+                              for datasource, exc_info in errors),),
+                errors)
+
+    def _check_index(self):
+        """
+        Reset the index if data sources were added or removed since it was built (the collection is a list)
+        """
+
+        if self._index is None or self._index_length != len(self):
+            self._index = {}
+            self._incremental = []
+            self._indexed = 0
+            self._index_length = len(self)
+            self._resolved = {}
+
+    def _lookup(self, parameter):
+        """
+        The index maps every parameter of the first `_indexed` data sources to the position and data source of the
+        first of them containing it, except for incremental data sources, which are asked directly.
+        When `parameter` isn't there, the next data sources are loaded and indexed, one at a time, until one contains
+        it, so lazy data sources past the first match are never loaded.
+
+        :return: the first data source containing `parameter`, None if none does
+        :rtype: DataSourceBase
+        """
+
+        self._check_index()
+
+        index = self._index
+        while True:
+            position, data_source = index.get(parameter, (None, None))
+
+            # incremental data sources before the match (if any) come first
+            for incremental_position, incremental_data_source in self._incremental:
+                if position is not None and incremental_position > position:
+                    break
+                if parameter in incremental_data_source:
+                    return incremental_data_source
+
+            if data_source is not None or self._indexed == len(self):
+                return data_source
+
+            data_source = self[self._indexed]
+            if data_source.incremental:
+                self._incremental.append((self._indexed, data_source))
+            else:
+                for key in data_source.keys():
+                    index.setdefault(key, (self._indexed, data_source))
+            self._indexed += 1
+
     def get_parameter_recursive(self, parameter):
         """
         See `get_parameter()` doc.
         The difference between the two functions is that this function follows pointers.
+        Resolved parameters are memoized.
 
         :param parameter: parameter to look up
         :type parameter: str
         :return: `parameter` resolved (recursively)
         """
 
-        parameter = self.get_parameter(parameter)
+        value = self._resolve(parameter, ())
 
-        if isinstance(parameter, DataCollectionPointer):
+        # don't let callers modify the memoized list
+        return list(value) if isinstance(value, list) else value
+
+    def _resolve(self, parameter, pointer_chain):
+        """
+        See `get_parameter_recursive()`
+
+        :param pointer_chain: pointers followed so far, used for detecting cycles
+        :type pointer_chain: tuple
+        """
+
+        self._check_index()
+
+        if parameter in self._resolved:
+            return self._resolved[parameter]
+
+        if parameter in pointer_chain:
+            raise PointerCycleException("Pointer cycle detected: %s" %
+                                        (" -> ".join(str(p) for p in pointer_chain + (parameter,)),))
+
+        pointer_chain += (parameter,)
+        value = self.get_parameter(parameter)
+
+        if isinstance(value, DataCollectionPointer):
             # pointer, resolve it
 
-            return self.get_parameter_recursive(parameter)
-        elif hasattr(parameter, '__iter__'):
+            value = self._resolve(value, pointer_chain)
+        elif hasattr(value, '__iter__'):
             # resolve iterables and convert to a list
 
-            return [self.get_parameter_recursive(i) if isinstance(i, DataCollectionPointer) else i for i in parameter]
-        else:
-            # regular parameter, return as is.
+            value = [self._resolve(i, pointer_chain) if isinstance(i, DataCollectionPointer) else i for i in value]
+
+        # else it's a regular parameter, use it as is.
+
+        self._resolved[parameter] = value
+        return value
 
-            return parameter
+    def get_parameters_recursive(self, parameters):
+        """
+        Resolve many parameters at once, following pointers. Parameters that can't be found, or that point to a
+        parameter that can't be found, are left out (like `parameter in collection`)
+
+        :param parameters: parameters to look up
+        :type parameters: list
+        :return: dictionary of the parameters found to their resolved value
+        :rtype: dict
+        """
+
+        resolved = {}
+        for parameter in parameters:
+            if self._lookup(parameter) is None:
+                continue
+
+            try:
+                resolved[parameter] = self.get_parameter_recursive(parameter)
+            except InvalidParameterException:
+                pass
+
+        return resolved
 
     def get_parameter(self, parameter):
         """
@@ -97,9 +313,10 @@ class DataSourceCollection(list):
         :return: `parameter` resolved
         """
 
-        for data_source in self:
-            if parameter in data_source:
-                return data_source[parameter]
+        data_source = self._lookup(parameter)
+
+        if data_source is not None:
+            return data_source[parameter]
         else:
             raise InvalidParameterException(
                 "Unable to find parameter %s in any of the data sources %r" % (parameter, self))
@@ -1,10 +1,89 @@
+import threading
 from rainbow.cloudformation import Cloudformation
-from base import DataSourceBase
+from base import DataSourceBase, DataSourceBaseMeta
 
-__all__ = ['CfnOutputsDataSource', 'CfnResourcesDataSource', 'CfnParametersDataSource']
+__all__ = ['CfnOutputsDataSource', 'CfnResourcesDataSource', 'CfnParametersDataSource', 'StackDescriptionCache']
+
+
+class StackDescriptionCache(object):
+    """
+    Run scoped cache of described stacks, keyed by (region, stack name), so cfn_outputs, cfn_resources and
+    cfn_parameters data sources of the same stack describe it only once.
+    Thread safe; concurrent lookups of the same stack wait for a single describe_stack() call.
+    """
+
+    def __init__(self):
+        self._stacks = {}
+        self._stack_locks = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_stack(self, region, stack_name):
+        """
+        Describe stack `stack_name` on `region`, or return the cached description
+
+        :param region: AWS region
+        :type region: str
+        :param stack_name: stack name
+        :type stack_name: str
+        :return: stack object
+        :rtype: boto.cloudformation.stack.Stack
+        """
+
+        key = (region, stack_name)
+
+        with self._lock:
+            stack_lock = self._stack_locks.setdefault(key, threading.Lock())
+
+        with stack_lock:
+            with self._lock:
+                if key in self._stacks:
+                    self.hits += 1
+                    return self._stacks[key]
+
+            stack = Cloudformation(region).describe_stack(stack_name)
+
+            with self._lock:
+                self.misses += 1
+                self._stacks[key] = stack
+
+            return stack
+
+    def invalidate(self, region, stack_name):
+        """
+        Forget the cached description of a single stack, i.e. after it has been updated
+
+        :param region: AWS region
+        :type region: str
+        :param stack_name: stack name
+        :type stack_name: str
+        """
+
+        with self._lock:
+            self._stacks.pop((region, stack_name), None)
+
+    def clear(self):
+        """
+        Forget all cached stacks and reset the hit/miss counters
+        """
+
+        with self._lock:
+            self._stacks.clear()
+            self._stack_locks.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __repr__(self):
+        return '<%s hits=%d misses=%d>' % (self.__class__.__name__, self.hits, self.misses)
 
 
 class CfnDataSourceBase(DataSourceBase):
+    stack_cache = StackDescriptionCache()
+
+    # optional rainbow.datasources.datasource_cache.DataSourceCache, set by main() when --datasource-cache-dir is given
+    cache = None
+
     def __init__(self, data_source):
         super(CfnDataSourceBase, self).__init__(data_source)
 
@@ -14,36 +93,169 @@ class CfnDataSourceBase(DataSourceBase):
         if ':' in data_source:
             region, stack_name = data_source.split(':', 1)
 
-        cfn_connection = Cloudformation(region)
-        if not cfn_connection:
-            raise Exception('Invalid region %r' % (region,))
+        self.region = region
+        self.stack_name = stack_name
+
+    def load(self):
+        data = None
+        if CfnDataSourceBase.cache:
+            data = CfnDataSourceBase.cache.get(self.region, self.stack_name, self.datasource_name)
+
+        if data is None:
+            data = self.fetch_data(self.region, self.stack_name)
+
+            if CfnDataSourceBase.cache:
+                CfnDataSourceBase.cache.set(self.region, self.stack_name, self.datasource_name, data)
+
+        return data
+
+    @classmethod
+    def fetch_data(cls, region, stack_name, stack=None):
+        """
+        Fetch the data source data of a stack from AWS
+
+        :param region: AWS region
+        :type region: str
+        :param stack_name: stack name
+        :type stack_name: str
+        :param stack: the stack, if it has already been described
+        :type stack: boto.cloudformation.stack.Stack
+        :rtype: dict
+        """
+
+        return cls.get_stack_data(stack or CfnDataSourceBase.stack_cache.get_stack(region, stack_name))
+
+    @staticmethod
+    def get_stack_data(stack):
+        """
+        Build the data source data out of a described stack
 
-        self.stack = cfn_connection.describe_stack(stack_name)
+        :param stack: stack object
+        :type stack: boto.cloudformation.stack.Stack
+        :rtype: dict
+        """
+
+        raise NotImplementedError()
+
+    @classmethod
+    def refresh_cache(cls, region, stack_name):
+        """
+        Describe `stack_name` and rewrite its entries in the on-disk cache for every cfn data source kind.
+        Used after a stack has been created/updated, so subsequent runs read its fresh outputs.
+
+        :param region: AWS region
+        :type region: str
+        :param stack_name: stack name
+        :type stack_name: str
+        """
+
+        if not cls.cache:
+            return
+
+        stack = Cloudformation(region).describe_stack(stack_name)
+
+        for datasource_class in DataSourceBaseMeta.datasources.itervalues():
+            if issubclass(datasource_class, CfnDataSourceBase):
+                cls.cache.set(region, stack_name, datasource_class.datasource_name,
+                              datasource_class.fetch_data(region, stack_name, stack))
 
 
 class CfnOutputsDataSource(CfnDataSourceBase):
     datasource_name = 'cfn_outputs'
 
-    def __init__(self, data_source):
-        super(CfnOutputsDataSource, self).__init__(data_source)
-
-        self.data = {i.key: i.value for i in self.stack.outputs}
+    @staticmethod
+    def get_stack_data(stack):
+        return {i.key: i.value for i in stack.outputs}
 
 
 class CfnResourcesDataSource(CfnDataSourceBase):
+    """
+    Pages through the stack's resources with ListStackResources as lookups need them: a lookup stops listing as soon
+    as the logical resource id is found. Only the logical to physical resource id map is kept
+    """
+
     datasource_name = 'cfn_resources'
+    incremental = True
 
     def __init__(self, data_source):
         super(CfnResourcesDataSource, self).__init__(data_source)
 
-        self.data = {r.logical_resource_id: r.physical_resource_id for r in self.stack.describe_resources()}
+        # logical resource id -> physical resource id, of the resources listed so far
+        self._resources = {}
+        # generator of the remaining pages, None before prefetch() and once all resources are listed
+        self._pages = None
+
+    @classmethod
+    def fetch_data(cls, region, stack_name, stack=None):
+        resources = {}
+        for page in Cloudformation(region).iter_stack_resources(stack_name):
+            resources.update(page)
+        return resources
+
+    def prefetch(self):
+        """
+        Read the resources from the on-disk cache, or list the first page of them
+        """
+
+        if self._loaded or self._pages is not None:
+            return
+
+        data = None
+        if CfnDataSourceBase.cache:
+            data = CfnDataSourceBase.cache.get(self.region, self.stack_name, self.datasource_name)
+
+        if data is not None:
+            self._resources = self.data = data
+        else:
+            self._pages = Cloudformation(self.region).iter_stack_resources(self.stack_name)
+            self._next_page()
+
+    def _next_page(self):
+        try:
+            page = next(self._pages)
+        except StopIteration:
+            self._pages = None
+            self.data = self._resources
+
+            if CfnDataSourceBase.cache:
+                CfnDataSourceBase.cache.set(self.region, self.stack_name, self.datasource_name, self._resources)
+            return
+        except Exception:
+            # the generator is done for once it raises, list the resources from the start on the next lookup
+            self._pages = None
+            self._resources = {}
+            raise
+
+        self._resources.update(page)
+
+    def _find(self, logical_resource_id):
+        self.prefetch()
+
+        while logical_resource_id not in self._resources and self._pages is not None:
+            self._next_page()
+
+        return logical_resource_id in self._resources
+
+    def load(self):
+        self.prefetch()
+
+        while self._pages is not None:
+            self._next_page()
+
+        return self._resources
+
+    def __contains__(self, item):
+        return self._find(item)
+
+    def __getitem__(self, item):
+        if not self._find(item):
+            raise KeyError(item)
+        return self._resources[item]
 
 
 class CfnParametersDataSource(CfnDataSourceBase):
     datasource_name = 'cfn_parameters'
 
-    def __init__(self, data_source):
-        super(CfnParametersDataSource, self).__init__(data_source)
-        
-        self.data = {p.key: p.value for p in self.stack.parameters}
-        
+    @staticmethod
+    def get_stack_data(stack):
+        return {p.key: p.value for p in stack.parameters}
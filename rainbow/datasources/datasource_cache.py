@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import tempfile
+
+__all__ = ['DataSourceCache']
+
+
+class DataSourceCache(object):
+    """
+    On-disk cache of resolved data source data, keyed by region, stack name and data source kind
+    (cfn_outputs, cfn_resources, cfn_parameters).
+    Entries are JSON files under `cache_dir`/region/, written atomically so concurrent rainbow processes never read a
+    partially written entry.
+    """
+
+    def __init__(self, cache_dir, ttl=300):
+        """
+        :param cache_dir: directory holding the cache entries. Created if it doesn't exist
+        :type cache_dir: str
+        :param ttl: number of seconds an entry is valid for. None means entries never expire
+        :type ttl: int or None
+        """
+
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, region, stack_name, kind):
+        return os.path.join(self.cache_dir, region, '%s.%s.json' % (stack_name, kind))
+
+    def get(self, region, stack_name, kind):
+        """
+        Get a cache entry
+
+        :param region: AWS region
+        :type region: str
+        :param stack_name: stack name
+        :type stack_name: str
+        :param kind: data source name (i.e. cfn_outputs)
+        :type kind: str
+        :return: cached data, or None if there's no valid entry
+        :rtype: dict or None
+        """
+
+        path = self._path(region, stack_name, kind)
+
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            # missing, unreadable or corrupted entry
+            return None
+
+    def set(self, region, stack_name, kind, data):
+        """
+        Atomically write a cache entry
+
+        :param region: AWS region
+        :type region: str
+        :param stack_name: stack name
+        :type stack_name: str
+        :param kind: data source name (i.e. cfn_outputs)
+        :type kind: str
+        :param data: data to cache
+        :type data: dict
+        """
+
+        path = self._path(region, stack_name, kind)
+        directory = os.path.dirname(path)
+
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # created by someone else in the meantime
+                if not os.path.isdir(directory):
+                    raise
+
+        # write to a temporary file on the same directory, then rename it over the entry (atomic on POSIX)
+        fd, temp_path = tempfile.mkstemp(prefix='.%s.' % (os.path.basename(path),), dir=directory)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(data, f)
+            os.rename(temp_path, path)
+        except:
+            os.unlink(temp_path)
+            raise
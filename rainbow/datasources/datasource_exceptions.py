@@ -12,3 +12,20 @@ class UnknownDataSourceException(DataSourceBaseException):
 
 class InvalidParameterException(DataSourceBaseException):
     pass
+
+
+class PointerCycleException(DataSourceBaseException):
+    pass
+
+
+class DataSourceConstructionException(DataSourceBaseException):
+    def __init__(self, message, errors):
+        """
+        :param message: exception message
+        :type message: str
+        :param errors: list of (data source, sys.exc_info() tuple) of every data source that failed to construct
+        :type errors: list
+        """
+
+        super(DataSourceConstructionException, self).__init__(message)
+        self.errors = errors
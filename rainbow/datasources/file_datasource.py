@@ -13,10 +13,11 @@ class FileDataSource(DataSourceBase):
         if not ':' in data_source:
             raise InvalidDataSourceFormatException("FileDataSource must be in name:path_to_file format")
 
-        name, path = data_source.split(':', 1)
+        self.name, self.path = data_source.split(':', 1)
 
-        with open(path) as f:
-            self.data = {name: f.read(-1)}
+    def load(self):
+        with open(self.path) as f:
+            return {self.name: f.read(-1)}
 
 
 class File64DataSource(DataSourceBase):
@@ -28,7 +29,8 @@ class File64DataSource(DataSourceBase):
         if not ':' in data_source:
             raise InvalidDataSourceFormatException("File64DataSource must be in name:path_to_file format")
 
-        name, path = data_source.split(':', 1)
+        self.name, self.path = data_source.split(':', 1)
 
-        with open(path) as f:
-            self.data = {name: f.read(-1).encode('base64')}
+    def load(self):
+        with open(self.path) as f:
+            return {self.name: f.read(-1).encode('base64')}
@@ -11,15 +11,17 @@ class YamlDataSource(DataSourceBase):
         # data_source can be path/to/file.yaml or Key:path/to/file.yaml
         # this lets you use one yaml file for multiple purposes
         if ':' in data_source:
-            key, yaml_file = data_source.split(':', 1)
+            self.key, self.yaml_file = data_source.split(':', 1)
         else:
-            yaml_file = data_source
-            key = None
+            self.yaml_file = data_source
+            self.key = None
 
         super(YamlDataSource, self).__init__(data_source)
 
-        with open(yaml_file) as f:
-            self.data = RainbowYamlLoader(f).get_data()
+    def load(self):
+        data = RainbowYamlLoader.load_file(self.yaml_file)
 
-        if key:
-            self.data = self.data[key]
+        if self.key:
+            data = data[self.key]
+
+        return data
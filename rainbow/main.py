@@ -1,13 +1,182 @@
 #!/usr/bin/env python
+import os
+import atexit
 import argparse
 import pprint
 import sys
 import yaml
 import logging
 from rainbow.datasources import DataSourceCollection
+from rainbow.datasources.cfn_datasource import CfnDataSourceBase
+from rainbow.datasources.datasource_cache import DataSourceCache
 from rainbow.preprocessor import Preprocessor
+from rainbow.preprocessor.instance_catalog import InstanceCatalog
 from rainbow.templates import TemplateLoader
-from rainbow.cloudformation import Cloudformation, StackFailStatus, StackSuccessStatus
+from rainbow.yaml_loader import RainbowYamlLoader, IncludeCache
+from rainbow.yaml_cache import RainbowYamlCache
+from rainbow.template_uploader import S3TemplateUploader
+from rainbow.orchestrator import Orchestrator, load_stack_definitions
+from rainbow.profiler import Profiler, phase
+from rainbow.replay import Cassette, RecordingConnectionPool, ReplayConnectionPool
+from rainbow.cloudformation import Cloudformation, PollingPolicy, RetryPolicy, RateLimiter, StackFailStatus, \
+    StackSuccessStatus, StackTimeoutStatus
+
+
+def region_value(value_type, value_name):
+    """
+    :param value_type: converts VALUE
+    :type value_type: callable
+    :param value_name: VALUE as shown in errors, i.e. the metavar's (BUCKET for REGION=BUCKET)
+    :type value_name: str
+    :return: argparse type of REGION=VALUE arguments, converting VALUE with `value_type`
+    :rtype: callable
+    """
+
+    def parse(value):
+        try:
+            region, region_value = value.split('=', 1)
+            return region, value_type(region_value)
+        except ValueError:
+            raise argparse.ArgumentTypeError('expected REGION=%s, got %r' % (value_name, value))
+
+    return parse
+
+
+def common_arguments():
+    """
+    :return: parser of the options shared by rainbow and rainbow-orchestrate, to be used as a parent parser
+    :rtype: argparse.ArgumentParser
+    """
+
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('-r', '--region', default='us-east-1',
+                        help='AWS region (for rainbow-orchestrate, of stacks that don\'t specify one)')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('--datasource-concurrency', metavar='N', type=int, default=1,
+                        help='Load up to N data sources concurrently. Lookup order is kept as given')
+    parser.add_argument('--lazy-datasources', action='store_true',
+                        help="Load each data source only when a lookup isn't satisfied by the data sources before it, "
+                             "so data sources no lookup reaches make no AWS calls")
+    parser.add_argument('--datasource-cache-dir', metavar='DIR',
+                        help='Cache cfn_outputs/cfn_resources/cfn_parameters data sources on DIR')
+    parser.add_argument('--datasource-cache-ttl', metavar='SECONDS', type=int, default=300,
+                        help='Number of seconds data source cache entries are valid for (default: %(default)s)')
+    parser.add_argument('--template-cache-dir', metavar='DIR',
+                        help='Cache parsed templates and YAML data sources on DIR')
+    parser.add_argument('--skip-unchanged', action='store_true',
+                        help='Tag stacks with a hash of their template and parameters, and skip updating them when '
+                             'they are unchanged')
+    parser.add_argument('--template-bucket', metavar='BUCKET',
+                        help='Upload templates too big to be sent to Cloudformation directly to the S3 bucket BUCKET '
+                             '(must be on the same region as the stack)')
+    parser.add_argument('--template-region-bucket', metavar='REGION=BUCKET', type=region_value(str, 'BUCKET'),
+                        action='append', default=[],
+                        help='Override --template-bucket for stacks on REGION. Can be given multiple times')
+    parser.add_argument('--template-prefix', metavar='PREFIX', default='rainbow/',
+                        help='S3 key prefix for --template-bucket (default: %(default)s)')
+    parser.add_argument('--poll-interval', metavar='SECONDS', type=float, default=2,
+                        help='Initial stack polling interval (default: %(default)s)')
+    parser.add_argument('--poll-max-interval', metavar='SECONDS', type=float, default=20,
+                        help='Stack polling interval grows up to SECONDS while the stack is idle '
+                             '(default: %(default)s)')
+    parser.add_argument('--block-timeout', metavar='SECONDS', type=float,
+                        help='Give up waiting for a stack after SECONDS, considering it failed')
+    parser.add_argument('--fail-fast', action='store_true',
+                        help='Consider a stack failed as soon as any of its resources fails, without waiting for the '
+                             'stack')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Write a JSON report of the time spent in each phase and of the AWS API calls made '
+                             'to FILE')
+    parser.add_argument('--profile-prometheus', metavar='FILE',
+                        help='Write the --profile report to FILE in the Prometheus text format')
+    parser.add_argument('--api-rate', metavar='CALLS_PER_SECOND', type=float,
+                        help='Limit Cloudformation API calls to CALLS_PER_SECOND per region, shared by all threads')
+    parser.add_argument('--api-region-rate', metavar='REGION=RATE', type=region_value(float, 'RATE'),
+                        action='append', default=[], help='Override --api-rate for REGION. Can be given multiple times')
+    parser.add_argument('--api-max-attempts', metavar='N', type=int, default=8,
+                        help='Give up Cloudformation API calls failing with throttling or transient errors after N '
+                             'attempts (default: %(default)s)')
+    parser.add_argument('--record-cassette', metavar='FILE',
+                        help='Record all Cloudformation API requests and responses to FILE')
+    parser.add_argument('--replay-cassette', metavar='FILE',
+                        help='Answer Cloudformation API requests with the responses recorded in FILE, offline')
+    parser.add_argument('--instance-catalog', metavar='FILE',
+                        help='Read the instance types known to Rb::InstanceChooser, and the regions they are '
+                             'available on, from FILE rather than the bundled catalog')
+
+    return parser
+
+
+def configure(args):  # pragma: no cover
+    """
+    Apply the options of common_arguments() to the rainbow modules
+
+    :param args: parsed command line arguments
+    :type args: argparse.Namespace
+    """
+
+    if args.verbose:
+        logging.getLogger('rainbow').setLevel(logging.DEBUG)
+
+    if args.profile or args.profile_prometheus:
+        # written at exit, so runs ending with sys.exit() are reported as well
+        atexit.register(Profiler().install().write, args.profile, args.profile_prometheus)
+
+    if args.record_cassette:
+        cassette = Cassette()
+        Cloudformation.connection_pool = RecordingConnectionPool(cassette)
+        atexit.register(cassette.save, args.record_cassette)
+    elif args.replay_cassette:
+        Cloudformation.connection_pool = ReplayConnectionPool(Cassette.load(args.replay_cassette))
+
+    Cloudformation.default_region = args.region
+    Cloudformation.retry_policy = RetryPolicy(max_attempts=args.api_max_attempts)
+    Cloudformation.rate_limiter = RateLimiter(args.api_rate, region_rates=dict(args.api_region_rate))
+    Cloudformation.default_polling_policy = PollingPolicy(initial_interval=args.poll_interval,
+                                                          max_interval=max(args.poll_interval, args.poll_max_interval),
+                                                          timeout=args.block_timeout, fail_fast=args.fail_fast)
+    if args.template_bucket or args.template_region_bucket:
+        Cloudformation.template_uploader = S3TemplateUploader(args.template_bucket, args.template_prefix, args.region,
+                                                              region_buckets=dict(args.template_region_bucket))
+
+    DataSourceCollection.concurrency = args.datasource_concurrency
+    DataSourceCollection.lazy = args.lazy_datasources
+    if args.datasource_cache_dir:
+        CfnDataSourceBase.cache = DataSourceCache(args.datasource_cache_dir, args.datasource_cache_ttl)
+    if args.template_cache_dir:
+        RainbowYamlLoader.cache = RainbowYamlCache(args.template_cache_dir)
+    RainbowYamlLoader.include_cache = IncludeCache()
+    if args.instance_catalog:
+        Preprocessor.instance_catalog = InstanceCatalog(args.instance_catalog)
+
+
+def track_stack_events(stack_events_iterator, events_cursor=None):  # pragma: no cover
+    """
+    Log stack events until the stack reaches a final status, exiting with a non-zero exit code on failure
+
+    :param stack_events_iterator: Cloudformation.tail_stack_events() generator
+    :param events_cursor: optional path to persist the id of the last seen event in
+    :type events_cursor: str
+    """
+
+    logger = logging.getLogger('rainbow')
+
+    for event in stack_events_iterator:
+        if isinstance(event, StackTimeoutStatus):
+            logger.warn('Timed out waiting for the stack, last status: %s', event)
+            sys.exit(1)
+        elif isinstance(event, StackFailStatus):
+            logger.warn('Stack creation failed: %s', event)
+            sys.exit(1)
+        elif isinstance(event, StackSuccessStatus):
+            logger.info('Stack creation succeeded: %s', event)
+        else:
+            logger.info('%(resource_type)s %(logical_resource_id)s %(physical_resource_id)s %(resource_status)s '
+                        '%(resource_status_reason)s', event)
+
+            if events_cursor:
+                with open(events_cursor, 'w') as f:
+                    f.write(event['event_id'])
 
 
 def main():  # pragma: no cover
@@ -19,15 +188,14 @@ def main():  # pragma: no cover
 
     logger = logging.getLogger('rainbow')
 
-    parser = argparse.ArgumentParser(description='Load cloudformation templates with cool data sources as arguments')
+    parser = argparse.ArgumentParser(description='Load cloudformation templates with cool data sources as arguments',
+                                     parents=[common_arguments()])
     parser.add_argument('-d', '--data-source', metavar='DATASOURCE', dest='datasources', action='append', default=[],
                         help='Data source. Format is data_sourcetype:data_sourceargument. For example, ' +
                              'cfn_outputs:[region:]stackname, cfn_resources:[region:]stackname, or ' +
                              'yaml:yamlfile. First match is used')
-    parser.add_argument('-r', '--region', default='us-east-1', help='AWS region')
     parser.add_argument('-n', '--noop', action='store_true',
                         help="Don't actually call aws; just show what would be done.")
-    parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('--dump-datasources', action='store_true',
                         help='Simply output all datasources and their values')
     parser.add_argument('--update-stack', action='store_true',
@@ -36,28 +204,55 @@ def main():  # pragma: no cover
                         help='Create a new stack if it doesn\'t exist, update if it does')
     parser.add_argument('--block', action='store_true',
                         help='Track stack creation, if the stack creation failed, exits with a non-zero exit code')
+    parser.add_argument('--events-cursor', metavar='FILE',
+                        help='Keep the id of the last stack event seen by --block in FILE, so --attach can resume '
+                             'from it')
+    parser.add_argument('--attach', action='store_true',
+                        help="Don't create/update the stack, only track its in-progress creation/update like --block. "
+                             "Resumes from --events-cursor if given")
 
     parser.add_argument('stack_name')
-    parser.add_argument('templates', metavar='template', type=str, nargs='+')
+    parser.add_argument('templates', metavar='template', type=str, nargs='*')
 
     args = parser.parse_args()
-    if args.verbose:
-        logger.setLevel(logging.DEBUG)
 
-    Cloudformation.default_region = args.region
-    datasource_collection = DataSourceCollection(args.datasources)
+    if not args.templates and not args.attach:
+        parser.error('at least one template is required')
+
+    configure(args)
+
+    if args.attach:
+        cursor = None
+        if args.events_cursor and os.path.exists(args.events_cursor):
+            with open(args.events_cursor) as f:
+                cursor = f.read().strip() or None
+
+        cloudformation = Cloudformation(args.region)
+        with phase('tail_stack_events'):
+            track_stack_events(cloudformation.tail_stack_events(args.stack_name, cursor=cursor), args.events_cursor)
+        CfnDataSourceBase.refresh_cache(args.region, args.stack_name)
+        return
+
+    with phase('datasources'):
+        datasource_collection = DataSourceCollection(args.datasources)
+    logger.debug('Stack description cache: %d hits, %d misses', CfnDataSourceBase.stack_cache.hits,
+                 CfnDataSourceBase.stack_cache.misses)
 
     # load and merge templates
-    template = TemplateLoader.load_templates(args.templates)
+    with phase('load_templates'):
+        template = TemplateLoader.load_templates(args.templates)
 
     # preprocess computed values
-    preprocessor = Preprocessor(datasource_collection=datasource_collection, region=args.region)
-    template = preprocessor.process(template)
+    with phase('preprocess'):
+        preprocessor = Preprocessor(datasource_collection=datasource_collection, region=args.region)
+        template = preprocessor.process(template)
 
     # build list of parameters for stack creation/update from datasources
-    parameters = Cloudformation.resolve_template_parameters(template, datasource_collection)
+    with phase('resolve_template_parameters'):
+        parameters = Cloudformation.resolve_template_parameters(template, datasource_collection)
 
     if args.dump_datasources:
+        datasource_collection.load(args.datasource_concurrency)
         pprint.pprint(datasource_collection)
         return
 
@@ -71,33 +266,92 @@ def main():  # pragma: no cover
     cloudformation = Cloudformation(args.region)
 
     if args.update_stack_if_exists:
-        if cloudformation.stack_exists(args.stack_name):
-            args.update_stack = True
-        else:
-            args.update_stack = False
+        with phase('stack_exists'):
+            if cloudformation.stack_exists(args.stack_name):
+                args.update_stack = True
+            else:
+                args.update_stack = False
+
+    tags = None
+    if args.skip_unchanged:
+        with phase('content_hash_tags'):
+            tags, unchanged = cloudformation.content_hash_tags(args.stack_name, template, parameters,
+                                                               args.update_stack)
+        if unchanged:
+            logger.info('No updates to be performed (template and parameters are unchanged)')
+            return
 
     if args.block:
         # set the iterator prior to updating the stack, so it'll begin from the current bottom
         stack_events_iterator = cloudformation.tail_stack_events(args.stack_name, None if args.update_stack else 0)
 
     if args.update_stack:
-        stack_modified = cloudformation.update_stack(args.stack_name, template, parameters)
+        with phase('update_stack'):
+            stack_modified = cloudformation.update_stack(args.stack_name, template, parameters, tags)
         if not stack_modified:
             logger.info('No updates to be performed')
+
+            if args.block:
+                status = cloudformation.current_status(args.stack_name)
+                if isinstance(status, StackFailStatus):
+                    logger.warn('Stack is in a failed status: %s', status)
+                    sys.exit(1)
     else:
-        cloudformation.create_stack(args.stack_name, template, parameters)
+        with phase('create_stack'):
+            cloudformation.create_stack(args.stack_name, template, parameters, tags)
         stack_modified = True
 
     if args.block and stack_modified:
-        for event in stack_events_iterator:
-            if isinstance(event, StackFailStatus):
-                logger.warn('Stack creation failed: %s', event)
-                sys.exit(1)
-            elif isinstance(event, StackSuccessStatus):
-                logger.info('Stack creation succeeded: %s', event)
-            else:
-                logger.info('%(resource_type)s %(logical_resource_id)s %(physical_resource_id)s %(resource_status)s '
-                            '%(resource_status_reason)s', event)
+        with phase('tail_stack_events'):
+            track_stack_events(stack_events_iterator, args.events_cursor)
+
+        # the stack's outputs/resources/parameters might have changed, write them through to the cache
+        CfnDataSourceBase.refresh_cache(args.region, args.stack_name)
+
+
+def orchestrate():  # pragma: no cover
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger('boto').setLevel(logging.CRITICAL)
+
+    logger = logging.getLogger('rainbow')
+
+    parser = argparse.ArgumentParser(description='Deploy multiple stacks, ordered by the cfn data sources they '
+                                                 'reference each other with',
+                                     parents=[common_arguments()])
+    parser.add_argument('-p', '--parallelism', metavar='N', type=int, default=4,
+                        help='Deploy up to N stacks at the same time (default: %(default)s)')
+    parser.add_argument('--poll-rate', metavar='POLLS_PER_SECOND', type=float, default=1,
+                        help='Total polling rate shared by the stacks being deployed (default: %(default)s)')
+    parser.add_argument('--render-processes', metavar='N', type=int,
+                        help='Load and merge all templates up front using N processes (default: number of CPUs)')
+    parser.add_argument('-n', '--noop', action='store_true',
+                        help="Don't actually call aws; just show the deploy order.")
+    parser.add_argument('stacks', metavar='STACKS_YAML',
+                        help='YAML file containing a list of stack definitions (name, templates, datasources and '
+                             'optionally region)')
+
+    args = parser.parse_args()
+    configure(args)
+
+    orchestrator = Orchestrator(load_stack_definitions(args.stacks), parallelism=args.parallelism,
+                                skip_unchanged=args.skip_unchanged, polls_per_second=args.poll_rate)
+
+    if args.noop:
+        for stack_definition in orchestrator.deploy_order():
+            logger.info('%s:%s depends on %s', stack_definition.region, stack_definition.name,
+                        ', '.join('%s:%s' % key for key in
+                                  sorted(orchestrator.dependencies[(stack_definition.region,
+                                                                    stack_definition.name)])) or 'nothing')
+        logger.info('NOOP mode. exiting')
+        return
+
+    with phase('load_templates'):
+        orchestrator.load_templates(args.render_processes)
+    with phase('deploy'):
+        statuses = orchestrator.deploy()
+
+    if not all(isinstance(status, StackSuccessStatus) for status in statuses.itervalues()):
+        sys.exit(1)
 
 if __name__ == '__main__':  # pragma: no cover
     main()
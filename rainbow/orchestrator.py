@@ -0,0 +1,375 @@
+import logging
+import threading
+import multiprocessing
+import yaml
+from multiprocessing.pool import ThreadPool
+from rainbow.datasources import DataSourceCollection
+from rainbow.datasources.cfn_datasource import CfnDataSourceBase
+from rainbow.preprocessor import Preprocessor
+from rainbow.templates import TemplateLoader
+from rainbow.cloudformation import Cloudformation, MultiStackTailer, StackFailStatus, StackSuccessStatus
+
+__all__ = ['StackDefinition', 'Orchestrator', 'OrchestratorException', 'StackSkippedStatus', 'load_stack_definitions']
+
+logger = logging.getLogger('rainbow')
+
+
+class OrchestratorException(Exception):
+    pass
+
+
+class StackSkippedStatus(StackFailStatus):
+    """
+    The stack wasn't deployed because one of the stacks it depends on failed
+    """
+
+    pass
+
+
+def _log_event(name, event):
+    logger.info('%s: %s %s %s %s %s', name, event['resource_type'], event['logical_resource_id'],
+                event['physical_resource_id'], event['resource_status'], event['resource_status_reason'])
+
+
+class StackDefinition(object):
+    # data sources that reference other stacks
+    cfn_datasources = ('cfn_outputs', 'cfn_resources', 'cfn_parameters')
+
+    def __init__(self, name, templates, datasources=(), region=None):
+        """
+        :param name: stack name
+        :type name: str
+        :param templates: list of template paths
+        :type templates: list
+        :param datasources: list of data sources, in the same format as the rainbow --data-source argument
+        :type datasources: list
+        :param region: AWS region. None means Cloudformation.default_region
+        :type region: str
+        """
+
+        self.name = name
+        self.templates = list(templates)
+        self.region = region or Cloudformation.default_region
+
+        # loaded and merged templates, see Orchestrator.load_templates()
+        self.template = None
+
+        # cfn data sources without an explicit region refer to the stack's region, not the default one
+        self.datasources = [self._explicit_region(datasource) for datasource in datasources]
+
+    @classmethod
+    def from_dict(cls, d):
+        """
+        :param d: dictionary with name, templates and optionally datasources and region keys
+        :type d: dict
+        :rtype: StackDefinition
+        """
+
+        try:
+            return cls(d['name'], d['templates'], d.get('datasources', []), d.get('region'))
+        except (KeyError, TypeError):
+            raise OrchestratorException('Invalid stack definition %r, name and templates are required' % (d,))
+
+    def _explicit_region(self, datasource):
+        source, _, data = datasource.partition(':')
+        if source in self.cfn_datasources and ':' not in data:
+            return '%s:%s:%s' % (source, self.region, data)
+        else:
+            return datasource
+
+    def referenced_stacks(self):
+        """
+        :return: set of (region, stack name) of all the stacks referenced by cfn data sources
+        :rtype: set
+        """
+
+        referenced = set()
+
+        for datasource in self.datasources:
+            source, _, data = datasource.partition(':')
+            if source in self.cfn_datasources:
+                region, stack_name = data.split(':', 1)
+                referenced.add((region, stack_name))
+
+        return referenced
+
+    def render(self):
+        """
+        Build the data sources, load, merge and preprocess the templates and resolve the template parameters
+
+        :return: (template, parameters)
+        :rtype: tuple
+        """
+
+        datasource_collection = DataSourceCollection(self.datasources)
+        template = self.template if self.template is not None else TemplateLoader.load_templates(self.templates)
+        template = Preprocessor(datasource_collection=datasource_collection, region=self.region).process(template)
+        parameters = Cloudformation.resolve_template_parameters(template, datasource_collection)
+
+        return template, parameters
+
+    def deploy(self, polling_policy=None, skip_unchanged=False, tailer=None):
+        """
+        Create the stack, or update it if it already exists, and wait for it to reach a final status
+
+        :param polling_policy: see Cloudformation.tail_stack_events()
+        :type polling_policy: rainbow.cloudformation.PollingPolicy
+        :param skip_unchanged: see Cloudformation.content_hash_tags()
+        :type skip_unchanged: bool
+        :param tailer: following MultiStackTailer to wait for the stack through, rather than polling it separately.
+                       Its polling policy overrides `polling_policy`, and whoever runs its tail() logs the events
+        :type tailer: rainbow.cloudformation.MultiStackTailer
+        :return: final stack status
+        :rtype: rainbow.cloudformation.StackStatus
+        """
+
+        template, parameters = self.render()
+
+        cloudformation = Cloudformation(self.region)
+        update = cloudformation.stack_exists(self.name)
+
+        tags = None
+        if skip_unchanged:
+            tags, unchanged = cloudformation.content_hash_tags(self.name, template, parameters, update)
+            if unchanged:
+                logger.info('%s: No updates to be performed (template and parameters are unchanged)', self.name)
+                return cloudformation.current_status(self.name)
+
+        # set the iterator (or cursor) prior to updating the stack, so it'll begin from the current bottom
+        if tailer is None:
+            stack_events_iterator = cloudformation.tail_stack_events(self.name, None if update else 0,
+                                                                     polling_policy=polling_policy)
+        else:
+            events = cloudformation.describe_stack_events_since(self.name, limit=1) if update else []
+            cursor = events[0].event_id if events else None
+
+        if update:
+            if not cloudformation.update_stack(self.name, template, parameters, tags):
+                logger.info('%s: No updates to be performed', self.name)
+                return cloudformation.current_status(self.name)
+        else:
+            cloudformation.create_stack(self.name, template, parameters, tags)
+
+        status = None
+        if tailer is None:
+            for event in stack_events_iterator:
+                if isinstance(event, StackFailStatus) or isinstance(event, StackSuccessStatus):
+                    status = event
+                else:
+                    _log_event(self.name, event)
+        else:
+            tailer.add((self.region, self.name), cursor)
+            status = tailer.wait((self.region, self.name))
+
+        # the stack has changed, make sure the stacks that depend on it read its new outputs/resources/parameters
+        CfnDataSourceBase.stack_cache.invalidate(self.region, self.name)
+        if isinstance(status, StackSuccessStatus):
+            CfnDataSourceBase.refresh_cache(self.region, self.name)
+
+        return status
+
+    def __repr__(self):
+        return '<%s name=%r region=%r>' % (self.__class__.__name__, self.name, self.region)
+
+
+def _load_templates(templates):
+    # multiprocessing can't pickle TemplateLoader.load_templates, as it's a static method
+    return TemplateLoader.load_templates(templates)
+
+
+def load_stack_definitions(path):
+    """
+    Load stack definitions from a YAML file containing a list of stack definitions, i.e.:
+        - name: vpc
+          templates: [templates/vpc.yaml]
+          datasources: [yaml:parameters/vpc.yaml]
+        - name: web
+          region: eu-west-1
+          templates: [templates/web.yaml]
+          datasources: ['cfn_outputs:us-east-1:vpc', 'yaml:parameters/web.yaml']
+
+    :param path: path to YAML file
+    :type path: str
+    :rtype: list of StackDefinition
+    """
+
+    with open(path) as f:
+        definitions = yaml.safe_load(f)
+
+    if not isinstance(definitions, list):
+        raise OrchestratorException('%s should contain a list of stack definitions' % (path,))
+
+    return [StackDefinition.from_dict(d) for d in definitions]
+
+
+class Orchestrator(object):
+    def __init__(self, stack_definitions, parallelism=4, polling_policy=None, skip_unchanged=False,
+                 polls_per_second=1):
+        """
+        :param stack_definitions: stacks to deploy
+        :type stack_definitions: list of StackDefinition
+        :param parallelism: maximal number of stacks to deploy at the same time
+        :type parallelism: int
+        :param polling_policy: see Cloudformation.tail_stack_events()
+        :type polling_policy: rainbow.cloudformation.PollingPolicy
+        :param skip_unchanged: see StackDefinition.deploy()
+        :type skip_unchanged: bool
+        :param polls_per_second: polling rate shared by all the stacks being deployed, see MultiStackTailer
+        :type polls_per_second: float
+        """
+
+        self.stack_definitions = stack_definitions
+        self.parallelism = parallelism
+        self.polling_policy = polling_policy
+        self.polls_per_second = polls_per_second
+        self.skip_unchanged = skip_unchanged
+        self.dependencies = self._build_dependencies()
+
+    def load_templates(self, processes=None):
+        """
+        Load and merge the templates of all stacks ahead of deploying them, using a pool of `processes` processes.
+        Preprocessing has to wait for the stack's data sources, which may depend on other stacks being deployed first.
+
+        :param processes: number of processes. None means the number of CPUs
+        :type processes: int
+        """
+
+        pool = multiprocessing.Pool(processes)
+        try:
+            templates = pool.map(_load_templates, [stack_definition.templates
+                                                   for stack_definition in self.stack_definitions])
+        finally:
+            pool.close()
+            pool.join()
+
+        for stack_definition, template in zip(self.stack_definitions, templates):
+            stack_definition.template = template
+
+    def _build_dependencies(self):
+        """
+        Infer the dependency graph from the cfn data sources referencing stacks within the set
+
+        :return: dictionary of (region, stack name) to a set of (region, stack name) it depends on
+        :rtype: dict
+        """
+
+        keys = set()
+        for stack_definition in self.stack_definitions:
+            key = (stack_definition.region, stack_definition.name)
+            if key in keys:
+                raise OrchestratorException('Stack %s:%s is defined more than once' % key)
+            keys.add(key)
+
+        dependencies = {(stack_definition.region, stack_definition.name):
+                        (stack_definition.referenced_stacks() & keys) - {(stack_definition.region,
+                                                                          stack_definition.name)}
+                        for stack_definition in self.stack_definitions}
+
+        # look for cycles, removing stacks without unresolved dependencies until nothing's left
+        remaining = {key: set(value) for key, value in dependencies.iteritems()}
+        while remaining:
+            ready = [key for key, value in remaining.iteritems() if not value]
+            if not ready:
+                raise OrchestratorException('Dependency cycle between stacks %s' %
+                                            (', '.join('%s:%s' % key for key in sorted(remaining)),))
+
+            for key in ready:
+                del remaining[key]
+            for value in remaining.itervalues():
+                value.difference_update(ready)
+
+        return dependencies
+
+    def deploy_order(self):
+        """
+        :return: list of stack definitions in an order that satisfies their dependencies
+        :rtype: list of StackDefinition
+        """
+
+        order = []
+        deployed = set()
+
+        while len(order) < len(self.stack_definitions):
+            for stack_definition in self.stack_definitions:
+                key = (stack_definition.region, stack_definition.name)
+                if key not in deployed and self.dependencies[key] <= deployed:
+                    order.append(stack_definition)
+                    deployed.add(key)
+
+        return order
+
+    def deploy(self):
+        """
+        Deploy all stacks, running up to `parallelism` independent stacks at the same time. Each stack starts as soon
+        as all the stacks it depends on succeeded. Stacks depending on a failed stack are skipped.
+        The stacks being deployed are polled by a single MultiStackTailer, so they share `polls_per_second`.
+
+        :return: dictionary of (region, stack name) to the final status of the stack
+        :rtype: dict
+        """
+
+        # one stack listing per region answers whether each of the stacks exists
+        for region in sorted(set(stack_definition.region for stack_definition in self.stack_definitions)):
+            Cloudformation.stack_registry.snapshot(Cloudformation(region))
+
+        statuses = {}
+        started = set()
+        condition = threading.Condition()
+
+        tailer = MultiStackTailer(polls_per_second=self.polls_per_second, polling_policy=self.polling_policy,
+                                  follow=True)
+
+        def log_events():
+            for (_, name), event in tailer.tail():
+                if isinstance(event, dict):
+                    _log_event(name, event)
+
+        tail_thread = threading.Thread(target=log_events, name='rainbow-tailer')
+        tail_thread.daemon = True
+        tail_thread.start()
+
+        def deploy_stack(stack_definition):
+            key = (stack_definition.region, stack_definition.name)
+
+            try:
+                status = stack_definition.deploy(self.polling_policy, self.skip_unchanged, tailer)
+            except Exception:
+                logger.exception('%s: deployment failed', stack_definition.name)
+                status = StackFailStatus('RAINBOW_ERROR')
+
+            logger.info('%s: %s', stack_definition.name, status)
+
+            with condition:
+                statuses[key] = status
+                condition.notify()
+
+        pool = ThreadPool(self.parallelism)
+        try:
+            with condition:
+                while len(statuses) < len(self.stack_definitions):
+                    for stack_definition in self.deploy_order():
+                        key = (stack_definition.region, stack_definition.name)
+                        if key in started:
+                            continue
+
+                        dependency_statuses = [statuses.get(dependency) for dependency in self.dependencies[key]]
+
+                        if any(status is not None and not isinstance(status, StackSuccessStatus)
+                               for status in dependency_statuses):
+                            logger.warn('%s: skipped, a stack it depends on has failed', stack_definition.name)
+                            statuses[key] = StackSkippedStatus('SKIPPED')
+                            started.add(key)
+                        elif all(isinstance(status, StackSuccessStatus) for status in dependency_statuses):
+                            started.add(key)
+                            pool.apply_async(deploy_stack, (stack_definition,))
+
+                    # wait for a running stack to finish, unless skipping stacks has completed the run
+                    if len(statuses) < len(self.stack_definitions) and len(started) > len(statuses):
+                        condition.wait()
+        finally:
+            pool.close()
+            pool.join()
+            tailer.close()
+            tail_thread.join()
+
+        return statuses
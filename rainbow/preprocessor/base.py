@@ -1,5 +1,6 @@
 import copy
 from preprocessor_exceptions import *
+from instance_catalog import InstanceCatalog
 
 
 class PreprocessorBase(object):
@@ -33,6 +34,9 @@ class PreprocessorBase(object):
 
 
 class Preprocessor(object):
+    # instance types served to Rb::InstanceChooser, shared by all preprocessors (the catalog is loaded on first use)
+    instance_catalog = InstanceCatalog()
+
     def __init__(self, datasource_collection, region):
         self.datasource_collection = datasource_collection
         self.region = region
@@ -47,7 +51,13 @@ class Preprocessor(object):
         :return: a copy of the template dictionary with all the Rb:: function calls processed
         """
 
-        template = copy.deepcopy(template)
+        # copy the template once, then process the copy in place
+        return self._process(copy.deepcopy(template))
+
+    def _process(self, template):
+        """
+        See process(). Modifies `template` in place.
+        """
 
         if isinstance(template, dict):
             if len(template) == 1 and type(template.keys()[0]) is str and template.keys()[0].startswith('Rb::'):
@@ -62,6 +72,6 @@ class Preprocessor(object):
                         return PreprocessorBase.functions[function](self, v)
             else:
                 for k, v in template.iteritems():
-                    template[k] = self.process(v)
+                    template[k] = self._process(v)
 
         return template
@@ -0,0 +1,162 @@
+import os
+import threading
+import yaml
+from collections import namedtuple
+from preprocessor_exceptions import PreprocessorBaseException
+
+DEFAULT_CATALOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance_types.yaml')
+
+
+class InvalidInstanceCatalogException(PreprocessorBaseException):
+    pass
+
+
+class InstanceType(namedtuple('InstanceType', ['name', 'family', 'size', 'vcpus', 'memory'])):
+    """
+    An instance type of the catalog. `memory` is in GiB
+    """
+
+    @classmethod
+    def from_catalog(cls, name, spec):
+        family, _, size = name.partition('.')
+        return cls(name, family, size, int(spec['vcpus']), float(spec['memory']))
+
+
+class InstanceCatalog(object):
+    """
+    Instance types and their availability on every region, read from a YAML file of the following form:
+        instance_types:
+          c3.large: {vcpus: 2, memory: 3.75}
+          ...
+        regions:
+          us-east-1: [c3.large, ...]
+          ...
+
+    The file is only read, and indexed, on first use. Lookups are dictionary/set lookups and constraint choices are
+    cached, so templates with many Rb::InstanceChooser calls cost (nearly) nothing per call.
+    """
+
+    def __init__(self, path=DEFAULT_CATALOG):
+        """
+        :param path: catalog YAML file
+        :type path: str
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._choices = {}
+
+        # instance type name -> InstanceType
+        self._instance_types = {}
+        # region -> frozenset of instance type names
+        self._regions = {}
+        # region -> family -> list of the family's InstanceType's available on the region, smallest first
+        self._region_families = {}
+
+    def _load(self):
+        with self._lock:
+            if self._loaded:
+                return
+
+            with open(self.path) as f:
+                catalog = yaml.safe_load(f)
+
+            try:
+                instance_types = {name: InstanceType.from_catalog(name, spec)
+                                  for name, spec in catalog['instance_types'].iteritems()}
+
+                regions = {}
+                region_families = {}
+                for region, names in catalog['regions'].iteritems():
+                    regions[region] = frozenset(names)
+
+                    families = region_families[region] = {}
+                    for name in names:
+                        instance_type = instance_types[name]
+                        families.setdefault(instance_type.family, []).append(instance_type)
+                    for family in families.itervalues():
+                        family.sort(key=lambda t: (t.vcpus, t.memory))
+            except (KeyError, TypeError, ValueError, AttributeError), ex:
+                raise InvalidInstanceCatalogException('Invalid instance catalog %s: %s %s' %
+                                                      (self.path, ex.__class__.__name__, ex))
+
+            self._instance_types = instance_types
+            self._regions = regions
+            self._region_families = region_families
+            self._loaded = True
+
+    def _region(self, region):
+        if not self._loaded:
+            self._load()
+
+        try:
+            return self._regions[region]
+        except KeyError:
+            raise InvalidInstanceCatalogException('Region %s is not in the instance catalog %s' % (region, self.path))
+
+    def regions(self):
+        if not self._loaded:
+            self._load()
+
+        return sorted(self._regions)
+
+    def instance_type(self, name):
+        """
+        :return: the InstanceType named `name`, None if it's not in the catalog
+        :rtype: InstanceType
+        """
+
+        if not self._loaded:
+            self._load()
+
+        return self._instance_types.get(name)
+
+    def available_instance_types(self, region):
+        """
+        :return: names of the instance types available on `region`
+        :rtype: frozenset
+        """
+
+        return self._region(region)
+
+    def is_available(self, region, name):
+        return name in self._region(region)
+
+    def choose(self, region, min_vcpus=0, min_memory=0, families=None):
+        """
+        Choose the smallest instance type available on `region` with at least `min_vcpus` vCPUs and `min_memory` GiB
+        of memory. Families are tried in the order of `families`, falling back to any family when none of them has a
+        large enough instance type on the region. Ties between families are broken by name.
+
+        :param families: preferred instance families (e.g. ['c3', 'm3'])
+        :type families: list
+        :return: instance type name, None if no instance type is large enough
+        :rtype: str
+        """
+
+        key = (region, min_vcpus, min_memory, tuple(families or ()))
+        try:
+            return self._choices[key]
+        except KeyError:
+            pass
+
+        self._region(region)
+        region_families = self._region_families[region]
+
+        def smallest(instance_types):
+            for instance_type in instance_types:
+                if instance_type.vcpus >= min_vcpus and instance_type.memory >= min_memory:
+                    return instance_type
+
+        choice = None
+        for family in families or ():
+            choice = smallest(region_families.get(family, ()))
+            if choice:
+                break
+        else:
+            candidates = filter(None, (smallest(family) for family in region_families.itervalues()))
+            if candidates:
+                choice = min(candidates, key=lambda t: (t.vcpus, t.memory, t.name))
+
+        return self._choices.setdefault(key, choice.name if choice else None)
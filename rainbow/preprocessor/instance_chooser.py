@@ -1,48 +1,45 @@
 from base import PreprocessorBase
 from preprocessor_exceptions import PreprocessorBaseException
+from instance_catalog import InvalidInstanceCatalogException
 from rainbow.datasources.base import DataCollectionPointer
 
-
-regions_instances = {
-    'us-east-1': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 'cg1.4xlarge', 't1.micro', 'cr1.8xlarge',
-                  'c3.2xlarge', 'c3.xlarge', 'm1.large', 'hs1.8xlarge', 'c3.8xlarge', 'c3.4xlarge', 'hi1.4xlarge',
-                  'i2.8xlarge', 'c1.xlarge', 'm2.2xlarge', 'g2.2xlarge', 'm2.xlarge', 'm1.medium', 'i2.xlarge',
-                  'm3.medium', 'cc2.8xlarge', 'i2.2xlarge', 'c3.large', 'i2.4xlarge', 'm1.xlarge', 'm2.4xlarge',
-                  'm3.xlarge'],
-    'ap-northeast-1': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 't1.micro', 'cr1.8xlarge', 'c3.2xlarge',
-                       'c3.xlarge', 'm1.large', 'hs1.8xlarge', 'c3.8xlarge', 'c3.4xlarge', 'hi1.4xlarge', 'i2.8xlarge',
-                       'c1.xlarge', 'm2.2xlarge', 'g2.2xlarge', 'm2.xlarge', 'm1.medium', 'i2.xlarge', 'm3.medium',
-                       'cc2.8xlarge', 'i2.2xlarge', 'c3.large', 'i2.4xlarge', 'm1.xlarge', 'm2.4xlarge', 'm3.xlarge'],
-    'eu-west-1': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 'cg1.4xlarge', 't1.micro', 'cr1.8xlarge',
-                  'c3.2xlarge', 'c3.xlarge', 'm1.large', 'hs1.8xlarge', 'c3.8xlarge', 'c3.4xlarge', 'hi1.4xlarge',
-                  'i2.8xlarge', 'c1.xlarge', 'm2.2xlarge', 'g2.2xlarge', 'm2.xlarge', 'm1.medium', 'i2.xlarge',
-                  'm3.medium', 'cc2.8xlarge', 'i2.2xlarge', 'c3.large', 'i2.4xlarge', 'm1.xlarge', 'm2.4xlarge',
-                  'm3.xlarge'],
-    'ap-southeast-1': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 't1.micro', 'c3.2xlarge', 'c3.xlarge',
-                       'm1.large', 'hs1.8xlarge', 'c3.8xlarge', 'c3.4xlarge', 'i2.8xlarge', 'c1.xlarge', 'm2.2xlarge',
-                       'm2.xlarge', 'm1.medium', 'i2.xlarge', 'm3.medium', 'i2.2xlarge', 'c3.large', 'i2.4xlarge',
-                       'm1.xlarge', 'm2.4xlarge', 'm3.xlarge'],
-    'ap-southeast-2': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 't1.micro', 'c3.2xlarge', 'c3.xlarge',
-                       'm1.large', 'hs1.8xlarge', 'c3.8xlarge', 'c3.4xlarge', 'i2.8xlarge', 'c1.xlarge', 'm2.2xlarge',
-                       'm2.xlarge', 'm1.medium', 'i2.xlarge', 'm3.medium', 'i2.2xlarge', 'c3.large', 'i2.4xlarge',
-                       'm1.xlarge', 'm2.4xlarge', 'm3.xlarge'],
-    'us-west-2': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 't1.micro', 'cr1.8xlarge', 'c3.2xlarge',
-                  'c3.xlarge', 'm1.large', 'hs1.8xlarge', 'c3.8xlarge', 'c3.4xlarge', 'hi1.4xlarge', 'i2.8xlarge',
-                  'c1.xlarge', 'm2.2xlarge', 'g2.2xlarge', 'm2.xlarge', 'm1.medium', 'i2.xlarge', 'm3.medium',
-                  'cc2.8xlarge', 'i2.2xlarge', 'c3.large', 'i2.4xlarge', 'm1.xlarge', 'm2.4xlarge', 'm3.xlarge'],
-    'us-west-1': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 't1.micro', 'c3.2xlarge', 'c3.xlarge', 'm1.large',
-                  'c3.8xlarge', 'c3.4xlarge', 'i2.8xlarge', 'c1.xlarge', 'm2.2xlarge', 'g2.2xlarge', 'm2.xlarge',
-                  'm1.medium', 'i2.xlarge', 'm3.medium', 'i2.2xlarge', 'c3.large', 'i2.4xlarge', 'm1.xlarge',
-                  'm2.4xlarge', 'm3.xlarge'],
-    'sa-east-1': ['m3.large', 'm3.2xlarge', 'm1.small', 'c1.medium', 't1.micro', 'm1.large', 'c1.xlarge', 'm2.2xlarge',
-                  'm2.xlarge', 'm1.medium', 'm3.medium', 'm1.xlarge', 'm2.4xlarge', 'm3.xlarge']
-}
+# keys of a constraints dictionary -> keyword argument of InstanceCatalog.choose()
+CONSTRAINTS = {'MinVcpus': 'min_vcpus', 'MinMemory': 'min_memory', 'Families': 'families'}
 
 
 class InvalidInstanceException(PreprocessorBaseException):
     pass
 
 
+def resolve(preprocessor, value):
+    if isinstance(value, DataCollectionPointer):
+        return preprocessor.datasource_collection.get_parameter_recursive(value)
+    return value
+
+
+def choose_by_constraints(preprocessor, constraints):
+    """
+    :param constraints: dictionary of MinVcpus, MinMemory (GiB) and Families (preferred instance families)
+    :type constraints: dict
+    :return: the smallest instance type of the region satisfying the constraints, None if there's none
+    :rtype: str
+    """
+
+    unknown = set(constraints) - set(CONSTRAINTS)
+    if unknown:
+        raise InvalidInstanceException('Unknown instance constraints %s (expected any of %s)' %
+                                       (', '.join(sorted(unknown)), ', '.join(sorted(CONSTRAINTS))))
+
+    kwargs = {CONSTRAINTS[k]: resolve(preprocessor, v) for k, v in constraints.iteritems()}
+    if 'families' in kwargs:
+        if not isinstance(kwargs['families'], list):
+            raise InvalidInstanceException('Families should be a list of instance families (e.g. [c3, m3]), got %r' %
+                                           (kwargs['families'],))
+        kwargs['families'] = [resolve(preprocessor, family) for family in kwargs['families']]
+
+    return preprocessor.instance_catalog.choose(preprocessor.region, **kwargs)
+
+
 @PreprocessorBase.expose('InstanceChooser')
 def instance_chooser(preprocessor, instance_types):
     """
@@ -50,35 +47,48 @@ def instance_chooser(preprocessor, instance_types):
         Choose the first valid instance (for the current region).
         For example, if a certain region doesn't support the c3 instances family, you can specify 'c3.large'
         with a fallback to 'c1.medium'. The function returns the first instance type that's available on that region.
+        Instead of an instance type, you can give a dictionary of constraints, choosing the smallest instance type
+        with at least MinVcpus vCPUs and MinMemory GiB of memory, from the first of Families (if given) that has one.
     Example usage:
         {'Rb::InstanceChooser': ['c3.large', 'c1.medium']}
     On a region that supports c3.large, 'c3.large' will be returned
     On a region that doesn't, 'c1.medium' will be returned
+        {'Rb::InstanceChooser': {'MinVcpus': 4, 'MinMemory': 15, 'Families': ['c3', 'm3']}}
+    Returns 'c3.2xlarge' on regions that have c3 instances, 'm3.xlarge' on regions that don't
 
     :param preprocessor: Preprocessor instance processing the function
     :type preprocessor: Preprocessor
-    :param instance_types: list of instance types to choose from
+    :param instance_types: list of instance types (or constraint dictionaries) to choose from, or a constraints
+                           dictionary
     :type instance_types: list
     :rtype: str
     """
 
-    if isinstance(instance_types, DataCollectionPointer):
-        instance_types = preprocessor.datasource_collection.get_parameter_recursive(instance_types)
+    instance_types = resolve(preprocessor, instance_types)
+
+    if isinstance(instance_types, dict):
+        instance_types = [instance_types]
 
     if not hasattr(instance_types, '__iter__'):
         raise InvalidInstanceException('Instance types should be an iterable (a list)')
 
-    # resolve pointers if relevant
-    for i, v in enumerate(instance_types):
-        if isinstance(v, DataCollectionPointer):
-            instance_types[i] = preprocessor.datasource_collection.get_parameter_recursive(str(v))
+    catalog = preprocessor.instance_catalog
+    try:
+        for i, instance_type in enumerate(instance_types):
+            # resolve pointers if relevant
+            instance_type = instance_types[i] = resolve(preprocessor, instance_type)
+
+            if isinstance(instance_type, dict):
+                instance_type = choose_by_constraints(preprocessor, instance_type)
+                if instance_type:
+                    return instance_type
+            elif catalog.is_available(preprocessor.region, instance_type):
+                return instance_type
 
-    available_instance_types = [instance_type for instance_type in instance_types
-                                if instance_type in regions_instances[preprocessor.region]]
+        available_instance_types = sorted(catalog.available_instance_types(preprocessor.region))
+    except InvalidInstanceCatalogException, ex:
+        raise InvalidInstanceException(str(ex))
 
-    if not available_instance_types:
-        raise InvalidInstanceException(
-            "Unable to find a suitable instance type for region %s out of %r. Available instances: %r" %
-            (preprocessor.region, instance_types, regions_instances[preprocessor.region]))
-    else:
-        return available_instance_types[0]
+    raise InvalidInstanceException(
+        "Unable to find a suitable instance type for region %s out of %r. Available instances: %r" %
+        (preprocessor.region, instance_types, available_instance_types))
@@ -0,0 +1,188 @@
+import time
+import json
+import threading
+import contextlib
+from collections import OrderedDict
+
+__all__ = ['Profiler', 'phase', 'instrument_connection']
+
+
+class Profiler(object):
+    """
+    Records the wall time of run phases and the count and latency of AWS API calls.
+
+    Library users install a profiler for the duration of a run:
+
+        profiler = Profiler()
+        profiler.install()
+        ... # load, preprocess and deploy templates
+        profiler.uninstall()
+        print profiler.to_json()
+
+    Only one profiler is active at a time. It's shared by all threads.
+    """
+
+    # the installed profiler, None when profiling is off
+    active = None
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.calls = OrderedDict()
+        self._started = time.time()
+        self._lock = threading.Lock()
+
+    def install(self):
+        Profiler.active = self
+        return self
+
+    def uninstall(self):
+        if Profiler.active is self:
+            Profiler.active = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Context manager adding the wall time of its block to phase `name`.
+        Phases may nest, i.e. the time spent in 'serialize_template' is also counted in 'create_stack'
+
+        :param name: phase name
+        :type name: str
+        """
+
+        # report phases in the order they started
+        with self._lock:
+            entry = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self._lock:
+                entry['count'] += 1
+                entry['seconds'] += elapsed
+
+    def record_call(self, operation, seconds, error=False):
+        """
+        :param operation: AWS API operation name (i.e. DescribeStacks)
+        :type operation: str
+        :param seconds: call latency
+        :type seconds: float
+        :param error: True if the call failed
+        :type error: bool
+        """
+
+        with self._lock:
+            entry = self.calls.setdefault(operation, {'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            entry['count'] += 1
+            entry['errors'] += int(error)
+            entry['seconds'] += seconds
+            entry['max_seconds'] = max(entry['max_seconds'], seconds)
+
+    def report(self):
+        """
+        :return: JSON encodeable report of the run so far
+        :rtype: dict
+        """
+
+        with self._lock:
+            return {
+                'wall_seconds': time.time() - self._started,
+                'phases': OrderedDict((name, dict(entry)) for name, entry in self.phases.iteritems()),
+                'aws_calls': OrderedDict((operation, dict(entry)) for operation, entry in self.calls.iteritems())
+            }
+
+    def to_json(self):
+        return json.dumps(self.report(), indent=2)
+
+    def to_prometheus(self):
+        """
+        :return: report in the Prometheus text exposition format
+        :rtype: str
+        """
+
+        report = self.report()
+        lines = ['# HELP rainbow_wall_seconds Wall time of the run',
+                 '# TYPE rainbow_wall_seconds gauge',
+                 'rainbow_wall_seconds %r' % (report['wall_seconds'],)]
+
+        for metric, help_text, table, label, field in (
+                ('rainbow_phase_seconds', 'Wall time spent in each phase', 'phases', 'phase', 'seconds'),
+                ('rainbow_phase_count', 'Number of times each phase ran', 'phases', 'phase', 'count'),
+                ('rainbow_aws_calls_total', 'Number of AWS API calls', 'aws_calls', 'operation', 'count'),
+                ('rainbow_aws_call_errors_total', 'Number of failed AWS API calls', 'aws_calls', 'operation',
+                 'errors'),
+                ('rainbow_aws_call_seconds_total', 'Total AWS API call latency', 'aws_calls', 'operation',
+                 'seconds'),
+                ('rainbow_aws_call_max_seconds', 'Maximal AWS API call latency', 'aws_calls', 'operation',
+                 'max_seconds')):
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s %s' % (metric, 'counter' if metric.endswith('_total') else 'gauge'))
+            for name, entry in report[table].iteritems():
+                lines.append('%s{%s="%s"} %r' % (metric, label, name.replace('\\', '\\\\').replace('"', '\\"'),
+                                                 entry[field]))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, json_path=None, prometheus_path=None):
+        """
+        Write the report to `json_path` and/or `prometheus_path`
+        """
+
+        if json_path:
+            with open(json_path, 'w') as f:
+                f.write(self.to_json())
+        if prometheus_path:
+            with open(prometheus_path, 'w') as f:
+                f.write(self.to_prometheus())
+
+
+@contextlib.contextmanager
+def _noop():
+    yield
+
+
+def phase(name):
+    """
+    Time a block as phase `name` of the active profiler, if any
+
+    :param name: phase name
+    :type name: str
+    """
+
+    if Profiler.active:
+        return Profiler.active.phase(name)
+    return _noop()
+
+
+def instrument_connection(connection, prefix=''):
+    """
+    Have the active profiler, if any, record every API request made by a boto connection.
+    The operation name is the first argument of the connection's make_request(): the action for query API connections
+    (i.e. DescribeStacks), the HTTP method for S3.
+
+    :param connection: boto connection
+    :param prefix: operation name prefix
+    :type prefix: str
+    :return: connection
+    """
+
+    make_request = connection.make_request
+
+    def instrumented_make_request(operation, *args, **kwargs):
+        profiler = Profiler.active
+        if profiler is None:
+            return make_request(operation, *args, **kwargs)
+
+        start = time.time()
+        error = True
+        try:
+            response = make_request(operation, *args, **kwargs)
+            # boto raises on error responses only after make_request() has returned them
+            error = getattr(response, 'status', 200) >= 400
+            return response
+        finally:
+            profiler.record_call(prefix + operation, time.time() - start, error)
+
+    connection.make_request = instrumented_make_request
+    return connection
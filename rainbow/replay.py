@@ -0,0 +1,577 @@
+import json
+import datetime
+import threading
+from collections import Counter, OrderedDict
+from xml.sax.saxutils import escape
+from boto.regioninfo import RegionInfo
+from boto.cloudformation.connection import CloudFormationConnection
+from rainbow.cloudformation import CloudformationConnectionPool
+
+__all__ = ['ReplayException', 'ReplayResponse', 'Cassette', 'StackSimulator', 'ReplayConnection', 'CallCounter',
+           'RecordingConnectionPool', 'ReplayConnectionPool']
+
+
+class ReplayException(Exception):
+    pass
+
+
+class ReplayResponse(object):
+    """
+    Stand-in for the httplib response boto connections read API responses from
+    """
+
+    def __init__(self, status, body, reason=None):
+        self.status = status
+        self.reason = reason or ('OK' if status == 200 else 'Bad Request')
+        self.body = body
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        return default
+
+
+class Cassette(object):
+    """
+    Recorded Cloudformation API requests and responses.
+
+    While replaying, a request is answered with the responses recorded for the same region, operation and parameters,
+    in the order they were recorded. Once they run out, the last one is repeated, so polling a stack more times than
+    the recording did keeps returning its final state.
+    """
+
+    def __init__(self, interactions=None):
+        """
+        :param interactions: list of dictionaries with region, operation, params, status, reason and body keys
+        :type interactions: list
+        """
+
+        self.interactions = []
+        self._index = {}
+        self._replayed = {}
+        self._lock = threading.Lock()
+
+        for interaction in interactions or []:
+            self._add(interaction)
+
+    def _add(self, interaction):
+        self.interactions.append(interaction)
+        key = self._key(interaction['region'], interaction['operation'], interaction['params'])
+        self._index.setdefault(key, []).append(interaction)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with self._lock:
+            with open(path, 'w') as f:
+                json.dump(self.interactions, f, indent=2, sort_keys=True)
+
+    @staticmethod
+    def _key(region, operation, params):
+        return json.dumps([region, operation, params or {}], sort_keys=True)
+
+    def record(self, region, operation, params, response):
+        """
+        :type region: str
+        :param operation: API operation name (i.e. DescribeStacks)
+        :type operation: str
+        :param params: request parameters
+        :type params: dict
+        :type response: ReplayResponse
+        """
+
+        with self._lock:
+            self._add({'region': region, 'operation': operation, 'params': params or {},
+                       'status': response.status, 'reason': response.reason, 'body': response.body.decode('utf-8')})
+
+    def respond(self, region, operation, params):
+        """
+        :return: the next recorded response to the request
+        :rtype: ReplayResponse
+        """
+
+        key = self._key(region, operation, params)
+
+        with self._lock:
+            matching = self._index.get(key)
+
+            if not matching:
+                raise ReplayException('No recorded response for %s %s %r' % (region, operation, params))
+
+            index = min(self._replayed.get(key, 0), len(matching) - 1)
+            self._replayed[key] = index + 1
+
+        interaction = matching[index]
+        return ReplayResponse(interaction['status'], interaction['body'].encode('utf-8'), interaction['reason'])
+
+
+class _SimulatedError(Exception):
+    def __init__(self, code, message):
+        super(_SimulatedError, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class SimulatedStack(object):
+    def __init__(self, region, name, stack_id):
+        self.region = region
+        self.name = name
+        self.stack_id = stack_id
+        self.template = {}
+        self.parameters = {}
+        self.tags = {}
+        self.disable_rollback = False
+
+        # oldest first, each event is a dictionary with a 'time' key
+        self.events = []
+
+    def visible_events(self, clock):
+        return [event for event in self.events if event['time'] <= clock]
+
+    def status(self, clock):
+        for event in reversed(self.visible_events(clock)):
+            if event['logical_resource_id'] == self.name:
+                return event['resource_status']
+
+    def resource_statuses(self, clock):
+        """
+        :return: dictionary of logical resource id to its latest visible event
+        :rtype: OrderedDict
+        """
+
+        statuses = OrderedDict()
+        for event in self.visible_events(clock):
+            if event['logical_resource_id'] != self.name:
+                statuses[event['logical_resource_id']] = event
+
+        return statuses
+
+
+class StackSimulator(object):
+    """
+    Offline model of the Cloudformation API, answering requests with the XML/JSON responses the real API would.
+
+    Stacks go through their real status transitions: creating or updating a stack creates/updates its resources one
+    after the other, each taking `resource_seconds` of simulated time, and then completes the stack. Resources listed
+    in `failing_resources` fail, failing the stack (CREATE_FAILED, or a rollback, as the real API does).
+    Simulated time only passes through advance(); patch time.sleep with it to run polling loops instantly.
+    """
+
+    # simulated time 0
+    epoch = datetime.datetime(2015, 1, 1)
+
+    def __init__(self, resource_seconds=5, page_size=100, failing_resources=()):
+        """
+        :param resource_seconds: simulated seconds it takes to create/update each resource
+        :type resource_seconds: float
+        :param page_size: number of items per DescribeStackEvents and ListStackResources page
+        :type page_size: int
+        :param failing_resources: logical ids of resources that fail to be created/updated
+        :type failing_resources: iterable
+        """
+
+        self.resource_seconds = resource_seconds
+        self.page_size = page_size
+        self.failing_resources = set(failing_resources)
+        self.clock = 0.0
+        self.stacks = OrderedDict()
+        self._ids = 0
+        self._lock = threading.RLock()
+
+    def advance(self, seconds):
+        """
+        Let `seconds` of simulated time pass
+        """
+
+        with self._lock:
+            self.clock += seconds
+
+    def _next_id(self, prefix):
+        self._ids += 1
+        return '%s-%08d' % (prefix, self._ids)
+
+    def _timestamp(self, seconds):
+        return (self.epoch + datetime.timedelta(seconds=seconds)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def respond(self, region, operation, params):
+        """
+        :return: the response to the request
+        :rtype: ReplayResponse
+        """
+
+        params = params or {}
+        handler = {'CreateStack': self._create_stack,
+                   'UpdateStack': self._update_stack,
+                   'DescribeStacks': self._describe_stacks,
+                   'ListStacks': self._list_stacks,
+                   'DescribeStackEvents': self._describe_stack_events,
+                   'DescribeStackResources': self._describe_stack_resources,
+                   'ListStackResources': self._list_stack_resources}.get(operation)
+
+        with self._lock:
+            if handler is None:
+                return self._error(operation, params, 'InvalidAction',
+                                   'Operation %s is not supported by the simulator' % (operation,))
+
+            try:
+                return handler(region, params)
+            except _SimulatedError, ex:
+                return self._error(operation, params, ex.code, ex.message)
+
+    # responses
+
+    def _error(self, operation, params, code, message):
+        if params.get('ContentType') == 'JSON':
+            body = json.dumps({'Error': {'Code': code, 'Message': message, 'Type': 'Sender'},
+                               'RequestId': self._next_id('request')})
+        else:
+            body = '<ErrorResponse><Error><Type>Sender</Type><Code>%s</Code><Message>%s</Message></Error>' \
+                   '<RequestId>%s</RequestId></ErrorResponse>' % (escape(code), escape(message),
+                                                                  self._next_id('request'))
+
+        return ReplayResponse(400, body.encode('utf-8'))
+
+    def _xml(self, operation, result):
+        body = '<%(operation)sResponse xmlns="http://cloudformation.amazonaws.com/doc/2010-05-15/">' \
+               '<%(operation)sResult>%(result)s</%(operation)sResult>' \
+               '<ResponseMetadata><RequestId>%(request_id)s</RequestId></ResponseMetadata>' \
+               '</%(operation)sResponse>' % {'operation': operation, 'result': result,
+                                             'request_id': self._next_id('request')}
+
+        return ReplayResponse(200, body.encode('utf-8'))
+
+    @staticmethod
+    def _elements(**elements):
+        return ''.join('<%s>%s</%s>' % (name, escape(unicode(value)), name)
+                       for name, value in sorted(elements.iteritems()) if value is not None)
+
+    @staticmethod
+    def _members(members):
+        return ''.join('<member>%s</member>' % (member,) for member in members)
+
+    # stacks
+
+    def _get_stack(self, region, name):
+        """
+        :param name: stack name or id
+        """
+
+        stack = self.stacks.get((region, name))
+        if stack is None:
+            stack = next((stack for stack in self.stacks.itervalues() if stack.stack_id == name), None)
+        if stack is None:
+            raise _SimulatedError('ValidationError', 'Stack with id %s does not exist' % (name,))
+        return stack
+
+    @staticmethod
+    def _list_params(params, prefix, fields):
+        """
+        Parse Prefix.member.N.Field request parameters to a list of field tuples
+        """
+
+        values = []
+        i = 1
+        while '%s.member.%d.%s' % (prefix, i, fields[0]) in params:
+            values.append(tuple(params.get('%s.member.%d.%s' % (prefix, i, field)) for field in fields))
+            i += 1
+
+        return values
+
+    def _add_event(self, stack, seconds, logical_resource_id, resource_type, physical_resource_id, resource_status,
+                   resource_status_reason=None):
+        stack.events.append({'time': seconds,
+                             'event_id': self._next_id('event'),
+                             'logical_resource_id': logical_resource_id,
+                             'resource_type': resource_type,
+                             'physical_resource_id': physical_resource_id,
+                             'resource_status': resource_status,
+                             'resource_status_reason': resource_status_reason})
+
+    def _deploy(self, stack, params, action):
+        """
+        Apply a CreateStack/UpdateStack request to `stack`, scheduling its events
+
+        :param action: CREATE or UPDATE
+        :type action: str
+        """
+
+        if 'TemplateBody' not in params:
+            raise ReplayException('The simulator supports templates given as TemplateBody only')
+
+        previous_resources = stack.template.get('Resources', {})
+        stack.template = json.loads(params['TemplateBody'])
+        stack.parameters = dict(self._list_params(params, 'Parameters', ('ParameterKey', 'ParameterValue')))
+        stack.tags = dict(self._list_params(params, 'Tags', ('Key', 'Value')))
+
+        start = self.clock
+        self._add_event(stack, start, stack.name, 'AWS::CloudFormation::Stack', stack.stack_id,
+                        action + '_IN_PROGRESS', 'User Initiated')
+
+        failed = None
+        end = start
+        for i, (logical_resource_id, resource) in enumerate(sorted(stack.template.get('Resources', {}).iteritems())):
+            resource_action = action if logical_resource_id in previous_resources else 'CREATE'
+            physical_resource_id = '%s-%s-%s' % (stack.name, logical_resource_id, stack.stack_id[-8:])
+            resource_type = resource.get('Type')
+
+            self._add_event(stack, start + i * self.resource_seconds, logical_resource_id, resource_type,
+                            physical_resource_id, resource_action + '_IN_PROGRESS')
+
+            end = start + (i + 1) * self.resource_seconds
+            if logical_resource_id in self.failing_resources:
+                self._add_event(stack, end, logical_resource_id, resource_type, physical_resource_id,
+                                resource_action + '_FAILED', 'Simulated failure')
+                failed = logical_resource_id
+                break
+
+            self._add_event(stack, end, logical_resource_id, resource_type, physical_resource_id,
+                            resource_action + '_COMPLETE')
+
+        def stack_event(seconds, status, reason=None):
+            self._add_event(stack, seconds, stack.name, 'AWS::CloudFormation::Stack', stack.stack_id, status, reason)
+
+        if failed is None:
+            if action == 'UPDATE':
+                stack_event(end, 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS')
+            stack_event(end, action + '_COMPLETE')
+        else:
+            reason = 'The following resource(s) failed to %s: [%s].' % (action.lower(), failed)
+            if action == 'CREATE' and stack.disable_rollback:
+                stack_event(end, 'CREATE_FAILED', reason)
+            elif action == 'CREATE':
+                stack_event(end, 'ROLLBACK_IN_PROGRESS', reason)
+                stack_event(end + self.resource_seconds, 'ROLLBACK_COMPLETE')
+            else:
+                stack_event(end, 'UPDATE_ROLLBACK_IN_PROGRESS', reason)
+                stack_event(end + self.resource_seconds, 'UPDATE_ROLLBACK_COMPLETE')
+
+    def _create_stack(self, region, params):
+        name = params['StackName']
+        existing = self.stacks.get((region, name))
+        if existing is not None and existing.status(self.clock) != 'DELETE_COMPLETE':
+            raise _SimulatedError('AlreadyExistsException', 'Stack [%s] already exists' % (name,))
+
+        stack = SimulatedStack(region, name, 'arn:aws:cloudformation:%s:123456789012:stack/%s/%s' %
+                               (region, name, self._next_id('stack')))
+        stack.disable_rollback = params.get('DisableRollback') == 'true'
+        self.stacks[(region, name)] = stack
+        self._deploy(stack, params, 'CREATE')
+
+        return ReplayResponse(200, json.dumps({'CreateStackResponse': {'CreateStackResult': {
+            'StackId': stack.stack_id}}}))
+
+    def _update_stack(self, region, params):
+        stack = self._get_stack(region, params['StackName'])
+        status = stack.status(self.clock)
+
+        if not status.endswith('_COMPLETE') and not status.endswith('_FAILED'):
+            raise _SimulatedError('ValidationError', 'Stack:%s is in %s state and can not be updated.' %
+                                  (stack.stack_id, status))
+
+        if json.loads(params.get('TemplateBody', 'null')) == stack.template and \
+                dict(self._list_params(params, 'Parameters', ('ParameterKey', 'ParameterValue'))) == \
+                stack.parameters and \
+                dict(self._list_params(params, 'Tags', ('Key', 'Value'))) == stack.tags:
+            raise _SimulatedError('ValidationError', 'No updates are to be performed.')
+
+        self._deploy(stack, params, 'UPDATE')
+
+        return ReplayResponse(200, json.dumps({'UpdateStackResponse': {'UpdateStackResult': {
+            'StackId': stack.stack_id}}}))
+
+    def _stack_xml(self, stack):
+        outputs = []
+        for key, output in sorted(stack.template.get('Outputs', {}).iteritems()):
+            value = output.get('Value')
+            if not isinstance(value, basestring):
+                value = '%s-%s' % (stack.name, key)
+            outputs.append(self._elements(OutputKey=key, OutputValue=value, Description=output.get('Description')))
+
+        return self._elements(StackName=stack.name, StackId=stack.stack_id, StackStatus=stack.status(self.clock),
+                              CreationTime=self._timestamp(stack.events[0]['time']),
+                              DisableRollback=str(stack.disable_rollback).lower()) + \
+            '<Parameters>%s</Parameters>' % (self._members(self._elements(ParameterKey=key, ParameterValue=value)
+                                                           for key, value in sorted(stack.parameters.iteritems())),) + \
+            '<Outputs>%s</Outputs>' % (self._members(outputs),) + \
+            '<Tags>%s</Tags>' % (self._members(self._elements(Key=key, Value=value)
+                                               for key, value in sorted(stack.tags.iteritems())),)
+
+    def _describe_stacks(self, region, params):
+        if 'StackName' in params:
+            stacks = [self._get_stack(region, params['StackName'])]
+        else:
+            stacks = [stack for (stack_region, _), stack in self.stacks.iteritems() if stack_region == region]
+
+        return self._xml('DescribeStacks', '<Stacks>%s</Stacks>' % (self._members(self._stack_xml(stack)
+                                                                                   for stack in stacks),))
+
+    def _list_stacks(self, region, params):
+        filters = set(value for key, value in params.iteritems() if key.startswith('StackStatusFilter.member.'))
+
+        summaries = []
+        for (stack_region, _), stack in self.stacks.iteritems():
+            status = stack.status(self.clock)
+            if stack_region == region and (not filters or status in filters):
+                summaries.append(self._elements(StackName=stack.name, StackId=stack.stack_id, StackStatus=status,
+                                                CreationTime=self._timestamp(stack.events[0]['time'])))
+
+        return self._xml('ListStacks', '<StackSummaries>%s</StackSummaries>' % (self._members(summaries),))
+
+    def _describe_stack_events(self, region, params):
+        stack = self._get_stack(region, params['StackName'])
+        events = stack.visible_events(self.clock)[::-1]
+
+        start = int(params.get('NextToken', 0))
+        page = events[start:start + self.page_size]
+        next_token = str(start + self.page_size) if start + self.page_size < len(events) else None
+
+        members = self._members(self._elements(EventId=event['event_id'], StackName=stack.name,
+                                               StackId=stack.stack_id,
+                                               LogicalResourceId=event['logical_resource_id'],
+                                               PhysicalResourceId=event['physical_resource_id'],
+                                               ResourceType=event['resource_type'],
+                                               ResourceStatus=event['resource_status'],
+                                               ResourceStatusReason=event['resource_status_reason'],
+                                               Timestamp=self._timestamp(event['time'])) for event in page)
+
+        return self._xml('DescribeStackEvents', '<StackEvents>%s</StackEvents>%s' %
+                         (members, self._elements(NextToken=next_token)))
+
+    def _describe_stack_resources(self, region, params):
+        stack = self._get_stack(region, params['StackName'])
+
+        members = self._members(self._elements(StackName=stack.name, StackId=stack.stack_id,
+                                               LogicalResourceId=logical_resource_id,
+                                               PhysicalResourceId=event['physical_resource_id'],
+                                               ResourceType=event['resource_type'],
+                                               ResourceStatus=event['resource_status'],
+                                               Timestamp=self._timestamp(event['time']))
+                                for logical_resource_id, event in stack.resource_statuses(self.clock).iteritems())
+
+        return self._xml('DescribeStackResources', '<StackResources>%s</StackResources>' % (members,))
+
+    def _list_stack_resources(self, region, params):
+        stack = self._get_stack(region, params['StackName'])
+        resources = sorted(stack.resource_statuses(self.clock).iteritems())
+
+        start = int(params.get('NextToken', 0))
+        page = resources[start:start + self.page_size]
+        next_token = str(start + self.page_size) if start + self.page_size < len(resources) else None
+
+        members = self._members(self._elements(LogicalResourceId=logical_resource_id,
+                                               PhysicalResourceId=event['physical_resource_id'],
+                                               ResourceType=event['resource_type'],
+                                               ResourceStatus=event['resource_status'],
+                                               LastUpdatedTimestamp=self._timestamp(event['time']))
+                                for logical_resource_id, event in page)
+
+        return self._xml('ListStackResources', '<StackResourceSummaries>%s</StackResourceSummaries>%s' %
+                         (members, self._elements(NextToken=next_token)))
+
+
+class ReplayConnection(CloudFormationConnection):
+    """
+    boto Cloudformation connection whose requests are answered by a Cassette or a StackSimulator instead of AWS.
+    Responses go through boto's regular parsing
+    """
+
+    def __init__(self, backend, region, calls):
+        """
+        :param backend: object answering requests
+        :type backend: Cassette or StackSimulator
+        :param region: AWS region
+        :type region: str
+        :param calls: per operation call counter to update
+        :type calls: CallCounter
+        """
+
+        super(ReplayConnection, self).__init__(aws_access_key_id='replay', aws_secret_access_key='replay',
+                                               region=RegionInfo(name=region,
+                                                                 endpoint='cloudformation.%s.amazonaws.com' %
+                                                                          (region,)))
+        self.backend = backend
+        self.calls = calls
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        self.calls.count(action)
+        return self.backend.respond(self.region.name, action, params)
+
+
+class CallCounter(Counter):
+    """
+    Thread safe counter of API calls per operation, i.e. calls['DescribeStackEvents']
+    """
+
+    def __init__(self):
+        super(CallCounter, self).__init__()
+        self._lock = threading.Lock()
+
+    def count(self, operation):
+        with self._lock:
+            self[operation] += 1
+
+    def reset(self):
+        with self._lock:
+            self.clear()
+
+
+class RecordingConnectionPool(CloudformationConnectionPool):
+    """
+    Connection pool recording every request made through its connections and their responses to a Cassette
+    """
+
+    def __init__(self, cassette, pool=None):
+        """
+        :type cassette: Cassette
+        :param pool: pool creating the connections to record. None means connecting to AWS
+        :type pool: CloudformationConnectionPool
+        """
+
+        super(RecordingConnectionPool, self).__init__()
+        self.cassette = cassette
+        self.pool = pool or CloudformationConnectionPool()
+        self.calls = CallCounter()
+
+    def _connect(self, region, **kw_params):
+        connection = self.pool._connect(region, **kw_params)
+        make_request = connection.make_request
+
+        def recording_make_request(action, params=None, path='/', verb='GET'):
+            self.calls.count(action)
+            response = make_request(action, params, path, verb)
+
+            # the body can only be read once, hand a copy to boto
+            replay_response = ReplayResponse(response.status, response.read(), response.reason)
+            self.cassette.record(region, action, params, replay_response)
+            return replay_response
+
+        connection.make_request = recording_make_request
+        return connection
+
+
+class ReplayConnectionPool(CloudformationConnectionPool):
+    """
+    Connection pool of ReplayConnection's. Install it as Cloudformation.connection_pool to run offline:
+
+        simulator = StackSimulator()
+        Cloudformation.connection_pool = ReplayConnectionPool(simulator)
+        ...
+        assert Cloudformation.connection_pool.calls['DescribeStackEvents'] <= 10
+    """
+
+    def __init__(self, backend):
+        """
+        :param backend: object answering requests
+        :type backend: Cassette or StackSimulator
+        """
+
+        super(ReplayConnectionPool, self).__init__()
+        self.backend = backend
+        self.calls = CallCounter()
+
+    def _connect(self, region, **kw_params):
+        return ReplayConnection(self.backend, region, self.calls)
@@ -0,0 +1,96 @@
+import hashlib
+import boto.s3
+import boto.exception
+from rainbow.profiler import instrument_connection
+
+__all__ = ['TemplateUploader', 'S3TemplateUploader', 'TemplateUploaderException']
+
+
+class TemplateUploaderException(Exception):
+    pass
+
+
+class TemplateUploader(object):
+    """
+    Stores serialized templates too big to be sent as a TemplateBody, so they can be passed as a TemplateURL instead
+    """
+
+    @staticmethod
+    def template_name(body):
+        """
+        :return: content addressed name for the template `body`
+        :rtype: str
+        """
+
+        return '%s.json' % (hashlib.sha1(body).hexdigest(),)
+
+    def upload(self, body):
+        """
+        Store a serialized template
+
+        :param body: serialized template
+        :type body: str
+        :return: template URL
+        :rtype: str
+        """
+
+        raise NotImplementedError()
+
+    def for_region(self, region):
+        """
+        :param region: region of the stack the template is uploaded for
+        :type region: str
+        :return: uploader of templates of stacks on `region`
+        :rtype: TemplateUploader
+        """
+
+        return self
+
+
+class S3TemplateUploader(TemplateUploader):
+    def __init__(self, bucket, prefix='', region=None, region_buckets=None):
+        """
+        :param bucket: S3 bucket name. None if only `region_buckets` are used
+        :type bucket: str
+        :param prefix: key prefix
+        :type prefix: str
+        :param region: bucket region. None means boto's default S3 endpoint
+        :type region: str
+        :param region_buckets: dictionary of region to the bucket (on that region) of templates of stacks on the region
+        :type region_buckets: dict
+        """
+
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region = region
+        self.region_buckets = region_buckets or {}
+
+    def for_region(self, region):
+        if region in self.region_buckets and (region, self.region_buckets[region]) != (self.region, self.bucket):
+            return S3TemplateUploader(self.region_buckets[region], self.prefix, region)
+        return self
+
+    def upload(self, body):
+        if not self.bucket:
+            raise TemplateUploaderException('no template bucket for region %s' % (self.region,))
+
+        try:
+            if self.region:
+                connection = boto.s3.connect_to_region(self.region)
+            else:
+                connection = boto.connect_s3()
+            instrument_connection(connection, 'S3:')
+
+            bucket = connection.get_bucket(self.bucket, validate=False)
+            key_name = self.prefix + self.template_name(body)
+
+            # the key name is the content hash, so an existing key already holds this exact template
+            key = bucket.get_key(key_name)
+            if key is None:
+                key = bucket.new_key(key_name)
+                key.set_contents_from_string(body, headers={'Content-Type': 'application/json'})
+
+            return key.generate_url(0, query_auth=False)
+        except boto.exception.BotoServerError, ex:
+            raise TemplateUploaderException('error occured while uploading template to s3://%s/%s: %s' %
+                                            (self.bucket, self.prefix, ex.message))
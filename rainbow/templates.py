@@ -24,6 +24,15 @@ def is_cfn_magic(d):
     return False
 
 
+def is_mergeable(d):
+    """
+    :return: true if `d` is a dictionary that should be deep merged (see `is_cfn_magic`)
+    :rtype: bool
+    """
+
+    return isinstance(d, dict) and not is_cfn_magic(d)
+
+
 def cfn_deep_merge(a, b):
     """
     Deep merge two CFN templates, treating CFN magics (see `is_cfn_magic` for more information) as non-mergeable
@@ -35,21 +44,41 @@ def cfn_deep_merge(a, b):
     :return: a new dictionary which is a merge of a and b
     """
 
-    # if a and b are dictionaries and both of them aren't cfn magic, merge them
-    if isinstance(a, dict) and isinstance(b, dict) and not (is_cfn_magic(a) or is_cfn_magic(b)):
-        # we're modifying and returning a, so start off with a copy
-        a = copy.deepcopy(a)
+    return cfn_deep_merge_all([a, b])
+
+
+def cfn_deep_merge_all(values):
+    """
+    Deep merge any number of CFN templates at once, with the same semantics as folding them with `cfn_deep_merge`
+    (later values override earlier ones), but walking all of them together and copying every leaf at most once.
+
+    :rtype: dict
+    :param values: non empty list of dictionaries to merge
+    :type values: list
+    :return: a new dictionary which is a merge of all values
+    """
+
+    # a non-mergeable value overrides everything that comes before it, so only the trailing run of mergeable
+    # dictionaries has any effect on the result
+    start = len(values)
+    while start > 0 and is_mergeable(values[start - 1]):
+        start -= 1
+
+    if start == len(values):
+        # the last value isn't mergeable, it overrides everything
+        return copy.deepcopy(values[-1])
+
+    dictionaries = values[start:]
+    if len(dictionaries) == 1:
+        return copy.deepcopy(dictionaries[0])
 
-        # merge two dictionaries
-        for k in b:
-            if k in a:
-                a[k] = cfn_deep_merge(a[k], b[k])
-            else:
-                a[k] = copy.deepcopy(b[k])
+    merged = {}
+    for d in dictionaries:
+        for k in d:
+            if k not in merged:
+                merged[k] = cfn_deep_merge_all([dd[k] for dd in dictionaries if k in dd])
 
-        return a
-    else:
-        return copy.deepcopy(b)
+    return merged
 
 
 class TemplateLoader(object):
@@ -64,9 +93,8 @@ class TemplateLoader(object):
         :rtype: dict
         """
 
-        template = {}
+        loaded = [{}]
         for template_path in templates:
-            with open(template_path) as f:
-                template = cfn_deep_merge(template, RainbowYamlLoader(f).get_data())
+            loaded.append(RainbowYamlLoader.load_file(template_path))
 
-        return template
+        return cfn_deep_merge_all(loaded)
@@ -0,0 +1,102 @@
+import os
+import hashlib
+import tempfile
+import cPickle
+import StringIO
+from rainbow.yaml_loader import RainbowYamlLoader
+
+__all__ = ['RainbowYamlCache']
+
+
+def file_hash(path):
+    """
+    :return: SHA1 hex digest of the file content, or None if it can't be read
+    :rtype: str or None
+    """
+
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except (IOError, OSError):
+        return None
+
+
+class RainbowYamlCache(object):
+    """
+    On-disk cache of parsed YAML files (templates and YAML data sources), keyed by the file content hash and the
+    loader version. Entries are pickled, which is a lot faster to load than parsing the YAML again.
+    Every entry records the files pulled in through !yaml, !file and !file64 along with their content hashes, and is
+    only used if none of them has changed.
+    """
+
+    def __init__(self, cache_dir):
+        """
+        :param cache_dir: directory holding the cache entries. Created if it doesn't exist
+        :type cache_dir: str
+        """
+
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, path):
+        """
+        Load and parse a YAML file, using a cached result if possible
+
+        :param path: path to YAML file
+        :type path: str
+        :return: (parsed YAML, list of all the files included by !file, !file64 and !yaml, recursively)
+        :rtype: tuple
+        """
+
+        with open(path, 'rb') as f:
+            content = f.read()
+
+        entry_path = os.path.join(self.cache_dir, '%s.pickle' % (
+            hashlib.sha1('%d\0%s' % (RainbowYamlLoader.version, content)).hexdigest(),))
+
+        entry = self._read_entry(entry_path)
+        if entry is not None:
+            includes, data = entry
+            if all(file_hash(include_path) == include_hash for include_path, include_hash in includes):
+                self.hits += 1
+                return data, [include_path for include_path, _ in includes]
+
+        self.misses += 1
+
+        stream = StringIO.StringIO(content)
+        stream.name = path  # for YAML error messages
+        data, included_files = RainbowYamlLoader.parse(stream)
+
+        self._write_entry(entry_path, ([(include_path, file_hash(include_path)) for include_path in included_files],
+                                       data))
+
+        return data, included_files
+
+    @staticmethod
+    def _read_entry(entry_path):
+        try:
+            with open(entry_path, 'rb') as f:
+                return cPickle.load(f)
+        except Exception:
+            # missing, unreadable or corrupted entry
+            return None
+
+    def _write_entry(self, entry_path, entry):
+        if not os.path.isdir(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # created by someone else in the meantime
+                if not os.path.isdir(self.cache_dir):
+                    raise
+
+        # write to a temporary file on the same directory, then rename it over the entry (atomic on POSIX)
+        fd, temp_path = tempfile.mkstemp(prefix='.%s.' % (os.path.basename(entry_path),), dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump(entry, f, cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp_path, entry_path)
+        except:
+            os.unlink(temp_path)
+            raise
@@ -1,9 +1,139 @@
-import yaml
+import os
 import re
-from rainbow.datasources.base import DataCollectionPointer
+import copy
+import threading
+import yaml
+
+__all__ = ['RainbowYamlLoader', 'PyRainbowYamlLoader', 'CRainbowYamlLoader', 'IncludeCache',
+           'YamlIncludeCycleException']
+
+
+class YamlIncludeCycleException(yaml.YAMLError):
+    pass
+
+
+class IncludeCache(object):
+    """
+    Run scoped, thread safe cache of loaded files, so a file included (or loaded) many times during a run is only read
+    and parsed once.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        """
+        :param key: cache key
+        :param load: function loading the value on a cache miss
+        :type load: callable
+        :return: the cached value. Callers shouldn't modify it
+        """
+
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                return self._entries[key]
+
+        value = load()
+
+        with self._lock:
+            self.misses += 1
+            return self._entries.setdefault(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __repr__(self):
+        return '<%s hits=%d misses=%d>' % (self.__class__.__name__, self.hits, self.misses)
+
+
+# absolute paths of the YAML files being loaded by the current thread, outermost first
+_loading = threading.local()
+
+
+class RainbowYamlLoaderMixin(object):
+    """
+    Rainbow's YAML tags (!file, !file64, !yaml, !pointer and the $ implicit pointer), on top of either the pure Python
+    loader (PyRainbowYamlLoader) or the libyaml based one (CRainbowYamlLoader).
+    Use RainbowYamlLoader, which is the fastest one available.
+    """
+
+    # bump whenever a change to the loader changes the data it produces (invalidates RainbowYamlCache entries)
+    version = 1
+
+    # optional rainbow.yaml_cache.RainbowYamlCache, set by main() when --template-cache-dir is given
+    cache = None
+
+    # optional IncludeCache, set by main() for the duration of the run
+    include_cache = None
+
+    @classmethod
+    def load_file(cls, path, included_files=None):
+        """
+        Load a YAML file, using the include cache and parsed YAML cache if configured
+
+        :param path: path to YAML file
+        :type path: str
+        :param included_files: if given, `path` and all the files it includes (recursively) are appended to it
+        :type included_files: list
+        :return: parsed YAML
+        """
+
+        absolute_path = os.path.abspath(path)
+
+        if not hasattr(_loading, 'paths'):
+            _loading.paths = []
+
+        loading = _loading.paths
+        if absolute_path in loading:
+            raise YamlIncludeCycleException('YAML include cycle: %s' % (' -> '.join(loading + [absolute_path]),))
 
+        loading.append(absolute_path)
+        try:
+            if cls.include_cache is not None:
+                data, includes = cls.include_cache.get(('yaml', absolute_path), lambda: cls._load_file(path))
+                data = copy.deepcopy(data)
+            else:
+                data, includes = cls._load_file(path)
+        finally:
+            loading.pop()
+
+        if included_files is not None:
+            included_files.append(path)
+            included_files.extend(includes)
+
+        return data
+
+    @classmethod
+    def _load_file(cls, path):
+        """
+        :return: (parsed YAML, list of all the files included by !file, !file64 and !yaml, recursively)
+        :rtype: tuple
+        """
+
+        if cls.cache:
+            return cls.cache.load(path)
+        else:
+            with open(path) as f:
+                return cls.parse(f)
+
+    @classmethod
+    def parse(cls, stream):
+        """
+        :param stream: YAML string or file
+        :return: (parsed YAML, list of all the files included by !file, !file64 and !yaml, recursively)
+        :rtype: tuple
+        """
+
+        loader = cls(stream)
+        return loader.get_data(), loader.included_files
 
-class RainbowYamlLoader(yaml.Loader):
     @staticmethod
     def yaml_pointer(loader, node):
         """
@@ -15,6 +145,9 @@ class RainbowYamlLoader(yaml.Loader):
         :return: File content as string
         """
 
+        # imported here, rainbow.datasources imports this module (through yaml_datasource)
+        from rainbow.datasources.base import DataCollectionPointer
+
         value = loader.construct_scalar(node)
 
         # remove implicit resolver character
@@ -35,8 +168,16 @@ class RainbowYamlLoader(yaml.Loader):
         """
 
         value = loader.construct_scalar(node)
-        with open(value) as f:
-            return f.read()
+        loader.included_files.append(value)
+
+        def read():
+            with open(value) as f:
+                return f.read()
+
+        if loader.include_cache is not None:
+            return loader.include_cache.get(('file', os.path.abspath(value)), read)
+        else:
+            return read()
 
     @classmethod
     def yaml_file64(cls, loader, node):
@@ -69,19 +210,46 @@ class RainbowYamlLoader(yaml.Loader):
             yaml_file = template_path
             key = None
 
-        with open(yaml_file) as f:
-            template = RainbowYamlLoader(f).get_data()
-            
+        template = loader.load_file(yaml_file, loader.included_files)
+
         if key:
             template = template[key]
         return template
 
 
+    @classmethod
+    def register(cls):
+        """
+        Register the Rainbow tags on a loader class. Done once per class, rather than on every instance, as
+        add_implicit_resolver() appends to a class wide list
+        """
+
+        cls.add_constructor('!file', cls.yaml_file)
+        cls.add_constructor('!file64', cls.yaml_file64)
+        cls.add_constructor('!yaml', cls.yaml_yaml)
+        cls.add_constructor('!pointer', cls.yaml_pointer)
+        cls.add_implicit_resolver('!pointer', re.compile(r'^\$\S+'), ['$'])
+
     def __init__(self, *args, **kwargs):
-        self.add_constructor('!file', self.__class__.yaml_file)
-        self.add_constructor('!file64', self.__class__.yaml_file64)
-        self.add_constructor('!yaml', self.__class__.yaml_yaml)
-        self.add_constructor('!pointer', self.__class__.yaml_pointer)
-        self.add_implicit_resolver('!pointer', re.compile(r'^\$\S+'), None)
+        self.included_files = []
+
+        super(RainbowYamlLoaderMixin, self).__init__(*args, **kwargs)
+
+
+class PyRainbowYamlLoader(RainbowYamlLoaderMixin, yaml.Loader):
+    pass
+
+
+PyRainbowYamlLoader.register()
+
+if yaml.__with_libyaml__:
+    class CRainbowYamlLoader(RainbowYamlLoaderMixin, yaml.CLoader):
+        pass
+
+    CRainbowYamlLoader.register()
+
+    RainbowYamlLoader = CRainbowYamlLoader
+else:
+    CRainbowYamlLoader = None
 
-        super(RainbowYamlLoader, self).__init__(*args, **kwargs)
+    RainbowYamlLoader = PyRainbowYamlLoader
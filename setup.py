@@ -8,6 +8,7 @@ setup(
     author_email='omrib@everything.me',
     url='http://github.com/EverythingMe/rainbow',
     packages=find_packages(),
+    package_data={'rainbow.preprocessor': ['instance_types.yaml']},
     install_requires=['boto', 'PyYAML'],
 
     extras_require={
@@ -16,7 +17,8 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'rainbow = rainbow.main:main'
+            'rainbow = rainbow.main:main',
+            'rainbow-orchestrate = rainbow.main:orchestrate'
         ]
     },
 
@@ -1,7 +1,14 @@
+import os
 import mock
+import time
+import shutil
+import tempfile
 import functools
 from unittest import TestCase
 from rainbow.datasources import DataSourceCollection
+from rainbow.datasources.cfn_datasource import CfnDataSourceBase, CfnResourcesDataSource
+from rainbow.datasources.datasource_cache import DataSourceCache
+from rainbow.datasources.datasource_exceptions import InvalidParameterException
 from rainbow.cloudformation import Cloudformation
 
 
@@ -20,7 +27,14 @@ class DotDict(dict):
         self[key] = value
 
 
+class MockResultSet(list):
+    next_token = None
+
+
 class MockCloudformationConnection(object):
+    # number of resources per ListStackResources page
+    page_size = 100
+
     def __init__(self, region, stacks):
         """
         :type region: str
@@ -29,25 +43,41 @@ class MockCloudformationConnection(object):
 
         self.region = region
         self.stacks = stacks
+        self.describe_stacks_calls = 0
+        self.list_stack_resources_calls = 0
 
     # noinspection PyUnusedLocal
     def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        self.describe_stacks_calls += 1
         if stack_name_or_id:
             return [self.stacks[self.region][stack_name_or_id]]
         else:
             return self.stacks[self.region].values()
 
+    def list_stack_resources(self, stack_name_or_id, next_token=None):
+        self.list_stack_resources_calls += 1
+        resources = sorted(self.stacks[self.region][stack_name_or_id].resources.iteritems())
+
+        start = int(next_token or 0)
+        page = MockResultSet(DotDict(logical_resource_id=key, physical_resource_id=value)
+                             for key, value in resources[start:start + self.page_size])
+        if start + self.page_size < len(resources):
+            page.next_token = str(start + self.page_size)
+
+        return page
+
+    # noinspection PyUnusedLocal
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        # the API methods above are mocked, nothing makes raw requests
+        raise NotImplementedError()
+
 
 class MockCloudformationStack(object):
     def __init__(self, resources={}, outputs={}, parameters={}):
-        self._resources = resources
+        self.resources = resources
         self._outputs = outputs
         self._parameters = parameters
 
-    def describe_resources(self):
-        return [DotDict(logical_resource_id=key, physical_resource_id=value)
-                for key, value in self._resources.iteritems()]
-
     @property
     def outputs(self):
         return [DotDict(key=key, value=value)
@@ -61,6 +91,8 @@ class MockCloudformationStack(object):
 class TestDataSources(TestCase):
     def setUp(self):
         Cloudformation.default_region = 'us-east-1'
+        Cloudformation.connection_pool.clear()
+        CfnDataSourceBase.stack_cache.clear()
 
         # c can override b, which can override a
         data_sources = ['cfn_resources:us-stack1',
@@ -104,3 +136,204 @@ class TestDataSources(TestCase):
 
     def test_cfn_parameters_explicit_region(self):
         self.assertEqual(self.datasource_collection.get_parameter_recursive('EuParameter1'), 'EU parameter')
+
+
+class TestStackDescriptionCache(TestCase):
+    def setUp(self):
+        Cloudformation.default_region = 'us-east-1'
+        Cloudformation.connection_pool.clear()
+        CfnDataSourceBase.stack_cache.clear()
+
+        self.stacks = {
+            'us-east-1': {
+                'us-stack1': MockCloudformationStack(resources={'UsResource1': 'us-stack1-UsResource1-ABCDEFGH'},
+                                                     outputs={'UsOutput1': 'US output'},
+                                                     parameters={'UsParameter1': 'US parameter'})
+            }
+        }
+
+    def test_describe_once(self):
+        data_sources = ['cfn_resources:us-stack1',
+                        'cfn_outputs:us-stack1',
+                        'cfn_parameters:us-east-1:us-stack1']
+
+        with mock.patch('boto.cloudformation.connect_to_region',
+                        functools.partial(mock_boto_cloudformation_connect_to_region, stacks=self.stacks)):
+            datasource_collection = DataSourceCollection(data_sources)
+            connection = Cloudformation('us-east-1').connection
+
+        self.assertEqual(datasource_collection.get_parameter_recursive('UsOutput1'), 'US output')
+        self.assertEqual(connection.describe_stacks_calls, 1)
+        self.assertEqual(CfnDataSourceBase.stack_cache.misses, 1)
+        # cfn_resources lists the stack resources rather than describing the stack
+        self.assertEqual(CfnDataSourceBase.stack_cache.hits, 1)
+        self.assertEqual(connection.list_stack_resources_calls, 1)
+
+
+class TestLazyCfnDataSources(TestCase):
+    def setUp(self):
+        Cloudformation.default_region = 'us-east-1'
+        Cloudformation.connection_pool.clear()
+        CfnDataSourceBase.stack_cache.clear()
+
+        stacks = {
+            'us-east-1': {
+                'us-stack1': MockCloudformationStack(outputs={'UsOutput1': 'US output'}),
+                'us-stack2': MockCloudformationStack(outputs={'UsOutput2': 'another US output'})
+            }
+        }
+
+        patcher = mock.patch('boto.cloudformation.connect_to_region',
+                             functools.partial(mock_boto_cloudformation_connect_to_region, stacks=stacks))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.datasource_collection = DataSourceCollection(['cfn_outputs:us-stack1', 'cfn_outputs:us-stack2'],
+                                                          lazy=True)
+        self.connection = Cloudformation('us-east-1').connection
+
+    def test_no_calls_until_lookup(self):
+        self.assertEqual(self.connection.describe_stacks_calls, 0)
+
+        self.assertEqual(self.datasource_collection.get_parameter_recursive('UsOutput1'), 'US output')
+        self.assertEqual(self.connection.describe_stacks_calls, 1)
+
+        self.assertEqual(self.datasource_collection.get_parameter_recursive('UsOutput2'), 'another US output')
+        self.assertEqual(self.connection.describe_stacks_calls, 2)
+
+    def test_load(self):
+        self.datasource_collection.load()
+
+        self.assertEqual(self.connection.describe_stacks_calls, 2)
+        self.assertTrue(all(datasource.loaded for datasource in self.datasource_collection))
+
+
+
+class TestCfnResourcesPaging(TestCase):
+    def setUp(self):
+        Cloudformation.default_region = 'us-east-1'
+        Cloudformation.connection_pool.clear()
+        CfnDataSourceBase.stack_cache.clear()
+
+        # 250 resources, 3 pages of up to 100
+        stacks = {
+            'us-east-1': {
+                'big-stack': MockCloudformationStack(resources={'Resource%03d' % (i,): 'big-stack-Resource%03d' % (i,)
+                                                                for i in xrange(250)}),
+                'small-stack': MockCloudformationStack(outputs={'Output': 'output'})
+            }
+        }
+
+        patcher = mock.patch('boto.cloudformation.connect_to_region',
+                             functools.partial(mock_boto_cloudformation_connect_to_region, stacks=stacks))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.connection = Cloudformation('us-east-1').connection
+
+    def test_stops_when_found(self):
+        datasource_collection = DataSourceCollection(['cfn_resources:big-stack'])
+        self.assertEqual(self.connection.list_stack_resources_calls, 1)
+
+        self.assertEqual(datasource_collection.get_parameter_recursive('Resource042'), 'big-stack-Resource042')
+        self.assertEqual(self.connection.list_stack_resources_calls, 1)
+
+        self.assertEqual(datasource_collection.get_parameter_recursive('Resource142'), 'big-stack-Resource142')
+        self.assertEqual(self.connection.list_stack_resources_calls, 2)
+
+    def test_all_pages(self):
+        datasource_collection = DataSourceCollection(['cfn_resources:big-stack'])
+
+        self.assertEqual(len(datasource_collection[0].keys()), 250)
+        self.assertEqual(self.connection.list_stack_resources_calls, 3)
+        self.assertTrue(datasource_collection[0].loaded)
+
+    def test_first_match(self):
+        datasource_collection = DataSourceCollection(['cfn_resources:big-stack', 'cfn_outputs:small-stack'])
+
+        self.assertEqual(datasource_collection.get_parameter_recursive('Resource249'), 'big-stack-Resource249')
+        self.assertEqual(datasource_collection.get_parameter_recursive('Output'), 'output')
+        self.assertRaises(InvalidParameterException, datasource_collection.get_parameter_recursive, 'Resource250')
+        self.assertEqual(self.connection.list_stack_resources_calls, 3)
+
+    def test_failing_page(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        CfnDataSourceBase.cache = DataSourceCache(cache_dir, ttl=60)
+        self.addCleanup(setattr, CfnDataSourceBase, 'cache', None)
+
+        datasource = CfnResourcesDataSource('big-stack')
+        list_stack_resources = self.connection.list_stack_resources
+
+        def failing_list_stack_resources(stack_name_or_id, next_token=None):
+            if next_token:
+                raise ValueError('second page failed')
+            return list_stack_resources(stack_name_or_id, next_token)
+
+        with mock.patch.object(self.connection, 'list_stack_resources', failing_list_stack_resources):
+            self.assertRaises(ValueError, datasource.__getitem__, 'Resource142')
+
+        # the partial listing is neither taken as the data nor cached
+        self.assertFalse(datasource.loaded)
+        self.assertIsNone(CfnDataSourceBase.cache.get('us-east-1', 'big-stack', 'cfn_resources'))
+
+        # the next lookup lists the resources from the start
+        self.assertEqual(datasource['Resource142'], 'big-stack-Resource142')
+        self.assertNotIn('Resource250', datasource)
+        self.assertTrue(datasource.loaded)
+        self.assertEqual(len(CfnDataSourceBase.cache.get('us-east-1', 'big-stack', 'cfn_resources')), 250)
+
+
+class TestDataSourceCache(TestCase):
+    def setUp(self):
+        Cloudformation.default_region = 'us-east-1'
+        Cloudformation.connection_pool.clear()
+        CfnDataSourceBase.stack_cache.clear()
+
+        self.cache_dir = tempfile.mkdtemp()
+        CfnDataSourceBase.cache = DataSourceCache(self.cache_dir, ttl=60)
+
+        self.stacks = {
+            'us-east-1': {
+                'us-stack1': MockCloudformationStack(outputs={'UsOutput1': 'US output'},
+                                                     parameters={'UsParameter1': 'US parameter'})
+            }
+        }
+
+    def tearDown(self):
+        CfnDataSourceBase.cache = None
+        shutil.rmtree(self.cache_dir)
+
+    def datasource_collection(self):
+        CfnDataSourceBase.stack_cache.clear()
+
+        with mock.patch('boto.cloudformation.connect_to_region',
+                        functools.partial(mock_boto_cloudformation_connect_to_region, stacks=self.stacks)):
+            return DataSourceCollection(['cfn_outputs:us-stack1', 'cfn_parameters:us-stack1'])
+
+    def test_cache_hit(self):
+        self.datasource_collection()
+        self.stacks['us-east-1']['us-stack1'] = MockCloudformationStack(outputs={'UsOutput1': 'changed'})
+
+        self.assertEqual(self.datasource_collection().get_parameter_recursive('UsOutput1'), 'US output')
+        self.assertEqual(CfnDataSourceBase.stack_cache.misses, 0)
+
+    def test_cache_expired(self):
+        self.datasource_collection()
+        self.stacks['us-east-1']['us-stack1'] = MockCloudformationStack(outputs={'UsOutput1': 'changed'})
+
+        path = os.path.join(self.cache_dir, 'us-east-1', 'us-stack1.cfn_outputs.json')
+        os.utime(path, (time.time() - 120, time.time() - 120))
+
+        self.assertEqual(self.datasource_collection().get_parameter_recursive('UsOutput1'), 'changed')
+
+    def test_refresh_cache(self):
+        self.datasource_collection()
+        self.stacks['us-east-1']['us-stack1'] = MockCloudformationStack(outputs={'UsOutput1': 'changed'})
+
+        with mock.patch('boto.cloudformation.connect_to_region',
+                        functools.partial(mock_boto_cloudformation_connect_to_region, stacks=self.stacks)):
+            CfnDataSourceBase.refresh_cache('us-east-1', 'us-stack1')
+
+        self.assertEqual(CfnDataSourceBase.cache.get('us-east-1', 'us-stack1', 'cfn_outputs'), {'UsOutput1': 'changed'})
+        self.assertEqual(CfnDataSourceBase.cache.get('us-east-1', 'us-stack1', 'cfn_parameters'), {})
@@ -1,19 +1,39 @@
 from unittest import TestCase
 from rainbow.yaml_loader import RainbowYamlLoader
-from rainbow.templates import cfn_deep_merge
+from rainbow.templates import cfn_deep_merge, cfn_deep_merge_all
 
 __author__ = 'omrib'
 
 
 class TestCfnDeepMerge(TestCase):
     def setUp(self):
-        with open('cfn_deep_merge/a.yaml') as a, \
-                open('cfn_deep_merge/b.yaml') as b, \
-                open('cfn_deep_merge/c.yaml') as c:
-            self.a = RainbowYamlLoader(a).get_data()
-            self.b = RainbowYamlLoader(b).get_data()
-            self.c = RainbowYamlLoader(c).get_data()
+        # c is a and b merged, a_b_d_e is a, b, d and e merged
+        self.a, self.b, self.c, self.d, self.e, self.a_b_d_e = [
+            RainbowYamlLoader.load_file('cfn_deep_merge/%s.yaml' % (name,))
+            for name in ('a', 'b', 'c', 'd', 'e', 'a_b_d_e')]
 
     def test_cfn_deep_merge(self):
         a_b_merged = cfn_deep_merge(self.a, self.b)
         self.assertDictEqual(self.c, a_b_merged)
+
+    def test_cfn_deep_merge_all(self):
+        self.assertDictEqual(self.c, cfn_deep_merge_all([self.a, self.b]))
+
+        # d overrides dictionaries with cfn magic and cfn magic with lists, e overrides cfn magic with dictionaries
+        merged = cfn_deep_merge_all([self.a, self.b, self.d, self.e])
+        self.assertDictEqual(self.a_b_d_e, merged)
+
+        # the result doesn't share anything with the inputs
+        merged['Resources']['LaunchConfig']['Properties']['KeyName']['Ref'] = 'Changed'
+        self.assertEqual(self.a['Resources']['LaunchConfig']['Properties']['KeyName']['Ref'], 'BootstrapKeyName')
+        self.assertEqual(self.e['Resources']['LaunchConfig']['Properties']['KeyName']['Ref'], 'BootstrapKeyName')
+
+    def test_cfn_deep_merge_all_magic(self):
+        magic = {'Resources': {'AutoScalingGroup': {'Properties': {'Ref': 'Magic'}}}}
+
+        # cfn magic replaces the properties merged so far, later properties replace the cfn magic
+        merged = cfn_deep_merge_all([self.a, self.b, magic])
+        self.assertDictEqual(merged['Resources']['AutoScalingGroup']['Properties'], {'Ref': 'Magic'})
+        self.assertDictEqual(merged['Resources']['LaunchConfig'], self.c['Resources']['LaunchConfig'])
+
+        self.assertDictEqual(self.c, cfn_deep_merge_all([self.a, self.b, magic, self.a, self.b]))
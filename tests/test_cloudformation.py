@@ -1,11 +1,18 @@
+import socket
+import boto.exception
+import mock
 from unittest import TestCase
 from rainbow.datasources import DataSourceCollection
+from rainbow.datasources.datasource_exceptions import InvalidParameterException
 from rainbow.preprocessor import Preprocessor
 from rainbow.preprocessor.preprocessor_exceptions import InvalidPreprocessorFunctionException
 from rainbow.preprocessor.instance_chooser import InvalidInstanceException
 from rainbow.yaml_loader import RainbowYamlLoader
-from rainbow.cloudformation import Cloudformation
+from rainbow.cloudformation import Cloudformation, CloudformationConnectionPool, CloudformationException, \
+    StackSuccessStatus, StackFailStatus, StackTimeoutStatus, PollingPolicy, MultiStackTailer, StackRegistry, \
+    RetryPolicy, TokenBucket, RateLimiter
 from rainbow.templates import TemplateLoader
+from rainbow.template_uploader import TemplateUploader, S3TemplateUploader
 
 __author__ = 'omrib'
 
@@ -35,3 +42,615 @@ class TestCloudformation(TestCase):
 
         self.assertEqual(parameters['DefaultString'], 'default string value')
         self.assertEqual(parameters['DefaultCommaDelimitedList'], 'default, comma, delimited, list')
+
+    def test_resolve_template_default_parameter_dangling_pointer(self):
+        datasource_collection = DataSourceCollection(['yaml:datasources/dangling.yaml', 'yaml:datasources/a.yaml'])
+        template = {'Parameters': {'Dangling': {'Type': 'String', 'Default': 'default'},
+                                   'DanglingList': {'Type': 'CommaDelimitedList', 'Default': 'a,b'},
+                                   'a_str': {'Type': 'String'}}}
+
+        # parameters pointing to a missing parameter fall back to their default
+        self.assertDictEqual(Cloudformation.resolve_template_parameters(template, datasource_collection),
+                             {'Dangling': 'default', 'DanglingList': 'a,b', 'a_str': 'foobar'})
+
+        del template['Parameters']['Dangling']['Default']
+        self.assertRaises(InvalidParameterException, Cloudformation.resolve_template_parameters, template,
+                          datasource_collection)
+
+
+class TestCloudformationConnectionPool(TestCase):
+    def setUp(self):
+        self.connection_pool = CloudformationConnectionPool()
+
+    def test_reuse(self):
+        with mock.patch('boto.cloudformation.connect_to_region',
+                        side_effect=lambda region, **kw: mock.Mock()) as connect:
+            us1 = self.connection_pool.get_connection('us-east-1')
+            us2 = self.connection_pool.get_connection('us-east-1')
+            eu = self.connection_pool.get_connection('eu-west-1')
+            us_other_credentials = self.connection_pool.get_connection('us-east-1', profile_name='other')
+
+        self.assertIs(us1, us2)
+        self.assertIsNot(us1, eu)
+        self.assertIsNot(us1, us_other_credentials)
+        self.assertEqual(connect.call_count, 3)
+
+    def test_invalid_region(self):
+        with mock.patch('boto.cloudformation.connect_to_region', return_value=None):
+            self.assertRaises(CloudformationException, self.connection_pool.get_connection, 'no-such-region-1')
+
+
+class MockResultSet(list):
+    next_token = None
+
+
+class MockStackEvent(object):
+    def __init__(self, event_id, resource_status='CREATE_COMPLETE'):
+        self.event_id = event_id
+        self.resource_type = 'AWS::Dummy::DummyResource'
+        self.logical_resource_id = 'Resource%d' % (event_id,)
+        self.physical_resource_id = None
+        self.resource_status = resource_status
+        self.resource_status_reason = None
+        self.timestamp = None
+
+
+class MockStack(object):
+    def __init__(self, stack_status, tags=None):
+        self.stack_status = stack_status
+        self.tags = tags or []
+
+
+class MockStackEventsConnection(object):
+    def __init__(self, events, page_size=10):
+        """
+        :param events: list of event ids, sorted from newest to oldest
+        :type events: list
+        """
+
+        self.events = [MockStackEvent(event_id) for event_id in events]
+        self.page_size = page_size
+        self.stack_status = 'UPDATE_IN_PROGRESS'
+        self.describe_stack_events_calls = 0
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        return [MockStack(self.stack_status)]
+
+    def describe_stack_events(self, stack_name_or_id=None, next_token=None):
+        self.describe_stack_events_calls += 1
+
+        start = int(next_token or 0)
+        page = MockResultSet(self.events[start:start + self.page_size])
+        if start + self.page_size < len(self.events):
+            page.next_token = str(start + self.page_size)
+
+        return page
+
+    def add_events(self, events):
+        self.events = [MockStackEvent(event_id) for event_id in events] + self.events
+
+
+class TestTailStackEvents(TestCase):
+    def setUp(self):
+        self.connection = MockStackEventsConnection(range(1000, 0, -1))
+        self.cloudformation = Cloudformation.__new__(Cloudformation)
+        self.cloudformation.region = 'us-east-1'
+        self.cloudformation.connection = self.connection
+
+    def test_describe_stack_events_since(self):
+        events = self.cloudformation.describe_stack_events_since('stack', 995)
+        self.assertListEqual([event.event_id for event in events], [1000, 999, 998, 997, 996])
+        self.assertEqual(self.connection.describe_stack_events_calls, 1)
+
+    def test_tail_stack_events(self):
+        with mock.patch('time.sleep'):
+            stack_events_iterator = self.cloudformation.tail_stack_events('stack')
+
+            self.connection.add_events([1002, 1001])
+            self.assertEqual(stack_events_iterator.next()['event_id'], 1001)
+            self.assertEqual(stack_events_iterator.next()['event_id'], 1002)
+
+            self.connection.add_events([1003])
+            self.connection.stack_status = 'UPDATE_COMPLETE'
+            self.assertEqual(stack_events_iterator.next()['event_id'], 1003)
+            self.assertIsInstance(stack_events_iterator.next(), StackSuccessStatus)
+
+        # one call to find the cursor, one call per poll
+        self.assertEqual(self.connection.describe_stack_events_calls, 3)
+
+    def test_tail_stack_events_cursor(self):
+        with mock.patch('time.sleep'):
+            self.connection.stack_status = 'UPDATE_COMPLETE'
+            events = list(self.cloudformation.tail_stack_events('stack', cursor=998))
+
+        self.assertListEqual([event['event_id'] for event in events[:-1]], [999, 1000])
+
+    def test_tail_stack_events_initial_entry(self):
+        self.connection.stack_status = 'UPDATE_COMPLETE'
+
+        events = list(self.cloudformation.tail_stack_events('stack', -3))
+        self.assertListEqual([event['event_id'] for event in events[:-1]], [998, 999, 1000])
+
+        events = list(self.cloudformation.tail_stack_events('stack', 997))
+        self.assertListEqual([event['event_id'] for event in events[:-1]], [998, 999, 1000])
+
+
+class TestPollingPolicy(TestCase):
+    def setUp(self):
+        self.connection = MockStackEventsConnection(range(10, 0, -1))
+        self.cloudformation = Cloudformation.__new__(Cloudformation)
+        self.cloudformation.region = 'us-east-1'
+        self.cloudformation.connection = self.connection
+
+    def test_next_interval(self):
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=5, multiplier=2)
+
+        self.assertEqual(polling_policy.next_interval(None, False), 2)
+        self.assertEqual(polling_policy.next_interval(2, False), 4)
+        self.assertEqual(polling_policy.next_interval(4, False), 5)
+        self.assertEqual(polling_policy.next_interval(5, True), 2)
+
+    def test_fail_fast(self):
+        polling_policy = PollingPolicy(fail_fast=True)
+
+        with mock.patch('time.sleep'):
+            stack_events_iterator = self.cloudformation.tail_stack_events('stack', polling_policy=polling_policy)
+            self.connection.events.insert(0, MockStackEvent(11, 'CREATE_FAILED'))
+
+            self.assertEqual(stack_events_iterator.next()['event_id'], 11)
+            status = stack_events_iterator.next()
+
+        self.assertIsInstance(status, StackFailStatus)
+        self.assertEqual(status, 'CREATE_FAILED')
+
+    def test_timeout(self):
+        polling_policy = PollingPolicy(initial_interval=10, max_interval=10, timeout=25)
+        now = [1000]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        with mock.patch('time.sleep', sleep), mock.patch('time.time', lambda: now[0]):
+            events = list(self.cloudformation.tail_stack_events('stack', polling_policy=polling_policy))
+
+        self.assertEqual(len(events), 1)
+        self.assertIsInstance(events[0], StackTimeoutStatus)
+        self.assertLessEqual(now[0], 1025)
+
+    def test_timeout_time(self):
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=20, jitter=0, timeout=30)
+        now = [1000]
+        polls = []
+
+        def describe_stacks(stack_name_or_id=None, next_token=None):
+            polls.append(now[0])
+            return [MockStack(self.connection.stack_status)]
+
+        def sleep(seconds):
+            now[0] += seconds
+
+        with mock.patch.object(self.connection, 'describe_stacks', describe_stacks), \
+                mock.patch('time.sleep', sleep), mock.patch('time.time', lambda: now[0]):
+            events = list(self.cloudformation.tail_stack_events('stack', polling_policy=polling_policy))
+
+        # the backed off interval (15.1875s) would pass the deadline, the last poll is cut short to happen right on it
+        self.assertIsInstance(events[-1], StackTimeoutStatus)
+        self.assertListEqual(polls, [1000, 1002, 1005, 1009.5, 1016.25, 1026.375, 1030])
+        self.assertEqual(now[0], 1030)
+
+    def test_timeout_last_poll(self):
+        polling_policy = PollingPolicy(initial_interval=10, max_interval=10, jitter=0, timeout=25)
+        now = [1000]
+
+        def sleep(seconds):
+            now[0] += seconds
+            if now[0] >= 1025:
+                self.connection.stack_status = 'UPDATE_COMPLETE'
+
+        with mock.patch('time.sleep', sleep), mock.patch('time.time', lambda: now[0]):
+            events = list(self.cloudformation.tail_stack_events('stack', polling_policy=polling_policy))
+
+        # the stack completes right at the deadline
+        self.assertListEqual(events, [StackSuccessStatus('UPDATE_COMPLETE')])
+        self.assertIsInstance(events[0], StackSuccessStatus)
+
+
+class MockStackSummary(object):
+    def __init__(self, stack_name, stack_status):
+        self.stack_name = stack_name
+        self.stack_status = stack_status
+
+
+class MockStackRegistryConnection(object):
+    def __init__(self, stacks):
+        """
+        :param stacks: dictionary of stack name to stack status
+        :type stacks: dict
+        """
+
+        self.stacks = stacks
+        self.describe_stacks_calls = 0
+        self.list_stacks_calls = 0
+
+    def describe_stacks(self, stack_name_or_id=None, next_token=None):
+        self.describe_stacks_calls += 1
+
+        if stack_name_or_id not in self.stacks:
+            raise boto.exception.BotoServerError(400, 'Bad Request', {
+                'Error': {'Code': 'ValidationError', 'Message': 'Stack with id %s does not exist' % (stack_name_or_id,)}
+            })
+
+        return [MockStack(self.stacks[stack_name_or_id])]
+
+    def list_stacks(self, stack_status_filters=None, next_token=None):
+        self.list_stacks_calls += 1
+
+        names = sorted(name for name, status in self.stacks.iteritems() if status in stack_status_filters)
+        start = int(next_token or 0)
+        page = MockResultSet(MockStackSummary(name, self.stacks[name]) for name in names[start:start + 2])
+        if start + 2 < len(names):
+            page.next_token = str(start + 2)
+
+        return page
+
+
+class TestStackRegistry(TestCase):
+    def setUp(self):
+        self.connection = MockStackRegistryConnection({'a': 'CREATE_COMPLETE', 'b': 'UPDATE_COMPLETE',
+                                                       'c': 'ROLLBACK_COMPLETE', 'd': 'DELETE_COMPLETE'})
+        self.cloudformation = Cloudformation.__new__(Cloudformation)
+        self.cloudformation.region = 'us-east-1'
+        self.cloudformation.connection = self.connection
+        self.stack_registry = StackRegistry()
+
+    def test_stack_exists(self):
+        self.assertTrue(self.stack_registry.stack_exists(self.cloudformation, 'a'))
+        self.assertTrue(self.stack_registry.stack_exists(self.cloudformation, 'a'))
+        self.assertFalse(self.stack_registry.stack_exists(self.cloudformation, 'd'))
+        self.assertFalse(self.stack_registry.stack_exists(self.cloudformation, 'no-such-stack'))
+        self.assertFalse(self.stack_registry.stack_exists(self.cloudformation, 'no-such-stack'))
+
+        self.assertEqual(self.connection.describe_stacks_calls, 3)
+        self.assertEqual(self.connection.list_stacks_calls, 0)
+
+    def test_snapshot(self):
+        self.stack_registry.snapshot(self.cloudformation)
+
+        self.assertTrue(self.stack_registry.stack_exists(self.cloudformation, 'a'))
+        self.assertTrue(self.stack_registry.stack_exists(self.cloudformation, 'c'))
+        self.assertFalse(self.stack_registry.stack_exists(self.cloudformation, 'd'))
+        self.assertFalse(self.stack_registry.stack_exists(self.cloudformation, 'no-such-stack'))
+
+        self.assertEqual(self.connection.describe_stacks_calls, 0)
+        self.assertEqual(self.connection.list_stacks_calls, 2)
+
+    def test_invalidate(self):
+        self.stack_registry.snapshot(self.cloudformation)
+        self.assertFalse(self.stack_registry.stack_exists(self.cloudformation, 'e'))
+
+        self.connection.stacks['e'] = 'CREATE_IN_PROGRESS'
+        self.stack_registry.invalidate('us-east-1', 'e')
+
+        self.assertTrue(self.stack_registry.stack_exists(self.cloudformation, 'e'))
+        self.assertEqual(self.connection.describe_stacks_calls, 1)
+
+    def test_unexpected_error(self):
+        self.connection.describe_stacks = mock.Mock(side_effect=boto.exception.BotoServerError(403, 'Forbidden'))
+        self.assertRaises(boto.exception.BotoServerError, self.stack_registry.stack_exists, self.cloudformation, 'a')
+
+
+class MockTemplateUploader(TemplateUploader):
+    def __init__(self):
+        self.templates = {}
+
+    def upload(self, body):
+        url = 'mock://templates/%s' % (self.template_name(body),)
+        self.templates[url] = body
+        return url
+
+
+class MockCreateStackConnection(object):
+    def __init__(self):
+        self.created = []
+
+    def create_stack(self, stack_name, template_body=None, template_url=None, **kwargs):
+        self.created.append((stack_name, template_body, template_url))
+
+
+class TestTemplateSerialization(TestCase):
+    def setUp(self):
+        self.connection = MockCreateStackConnection()
+        self.cloudformation = Cloudformation.__new__(Cloudformation)
+        self.cloudformation.region = 'us-east-1'
+        self.cloudformation.connection = self.connection
+        self.cloudformation.template_uploader = MockTemplateUploader()
+        self.cloudformation.max_template_body_size = 100
+
+    def test_template_body(self):
+        self.cloudformation.create_stack('stack', {'b': [1, 2], 'a': {'d': 'e', 'c': None}}, {})
+        self.assertListEqual(self.connection.created, [('stack', '{"a":{"c":null,"d":"e"},"b":[1,2]}', None)])
+
+    def test_template_url(self):
+        template = {'Resources': {'Resource%d' % (i,): {'Type': 'AWS::Dummy::DummyResource'} for i in range(10)}}
+        self.cloudformation.create_stack('stack', template, {})
+
+        _, template_body, template_url = self.connection.created[0]
+        self.assertIsNone(template_body)
+        self.assertEqual(self.cloudformation.template_uploader.templates[template_url],
+                         Cloudformation.serialize_template(template))
+
+    def test_no_uploader(self):
+        self.cloudformation.template_uploader = None
+        template = {'Resources': {'Resource%d' % (i,): {'Type': 'AWS::Dummy::DummyResource'} for i in range(10)}}
+
+        self.assertRaises(CloudformationException, self.cloudformation.create_stack, 'stack', template, {})
+
+    def test_region_buckets(self):
+        uploader = S3TemplateUploader('templates', 'rainbow/', 'us-east-1',
+                                      region_buckets={'eu-west-1': 'eu-templates'})
+
+        eu_uploader = uploader.for_region('eu-west-1')
+        self.assertEqual((eu_uploader.bucket, eu_uploader.prefix, eu_uploader.region),
+                         ('eu-templates', 'rainbow/', 'eu-west-1'))
+        self.assertIs(uploader.for_region('us-east-1'), uploader)
+        self.assertIs(uploader.for_region('us-west-2'), uploader)
+
+
+class TestContentHash(TestCase):
+    def setUp(self):
+        self.template = {'Resources': {'Resource': {'Type': 'AWS::Dummy::DummyResource'}}}
+        self.parameters = {'a': 'b'}
+        self.content_hash = Cloudformation.content_hash(self.template, self.parameters)
+
+        self.cloudformation = Cloudformation.__new__(Cloudformation)
+        self.cloudformation.describe_stack = lambda name: self.stack
+
+    def test_content_hash(self):
+        self.assertEqual(self.content_hash, Cloudformation.content_hash(dict(self.template), {'a': 'b'}))
+        self.assertNotEqual(self.content_hash, Cloudformation.content_hash(self.template, {'a': 'c'}))
+
+    def test_create(self):
+        tags, unchanged = self.cloudformation.content_hash_tags('stack', self.template, self.parameters, False)
+
+        self.assertFalse(unchanged)
+        self.assertDictEqual(tags, {Cloudformation.content_hash_tag: self.content_hash})
+
+    def test_update(self):
+        self.stack = MockStack('UPDATE_COMPLETE', {'owner': 'me', Cloudformation.content_hash_tag: 'outdated'})
+        tags, unchanged = self.cloudformation.content_hash_tags('stack', self.template, self.parameters, True)
+
+        self.assertFalse(unchanged)
+        self.assertDictEqual(tags, {'owner': 'me', Cloudformation.content_hash_tag: self.content_hash})
+
+    def test_unchanged(self):
+        self.stack = MockStack('UPDATE_COMPLETE', {Cloudformation.content_hash_tag: self.content_hash})
+        _, unchanged = self.cloudformation.content_hash_tags('stack', self.template, self.parameters, True)
+
+        self.assertTrue(unchanged)
+
+    def test_failed_unchanged(self):
+        # the stack failed to deploy the current content, it has to be deployed again
+        for stack_status in ('CREATE_FAILED', 'UPDATE_ROLLBACK_COMPLETE', 'ROLLBACK_COMPLETE'):
+            self.stack = MockStack(stack_status, {Cloudformation.content_hash_tag: self.content_hash})
+            _, unchanged = self.cloudformation.content_hash_tags('stack', self.template, self.parameters, True)
+
+            self.assertFalse(unchanged)
+
+
+class TestMultiStackTailer(TestCase):
+    def setUp(self):
+        self.now = [1000.0]
+        self.polls = []
+
+        test = self
+
+        class ClockedConnection(MockStackEventsConnection):
+            def __init__(self, region, events, complete_at):
+                super(ClockedConnection, self).__init__(events)
+                self.region = region
+                self.complete_at = complete_at
+
+            def describe_stacks(self, stack_name_or_id=None, next_token=None):
+                test.polls.append((test.now[0], self.region))
+                if test.now[0] >= self.complete_at:
+                    self.stack_status = 'UPDATE_COMPLETE'
+                return super(ClockedConnection, self).describe_stacks(stack_name_or_id, next_token)
+
+        self.connections = {'us-east-1': ClockedConnection('us-east-1', [1], 1000),
+                            'eu-west-1': ClockedConnection('eu-west-1', [1], 1030)}
+
+    def sleep(self, seconds):
+        self.now[0] += seconds
+
+    def test_tail(self):
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=8, multiplier=2, jitter=0)
+        tailer = MultiStackTailer([('us-east-1', 'stack1'), ('eu-west-1', 'stack2')], polls_per_second=0.5,
+                                  polling_policy=polling_policy,
+                                  cursors={('us-east-1', 'stack1'): 1, ('eu-west-1', 'stack2'): None})
+
+        with mock.patch.object(Cloudformation.connection_pool, 'get_connection',
+                               lambda region: self.connections[region]), \
+                mock.patch('time.sleep', self.sleep), mock.patch('time.time', lambda: self.now[0]):
+            self.connections['us-east-1'].add_events([2])
+            events = list(tailer.tail())
+
+        self.assertListEqual([(stack, event['event_id']) for stack, event in events if isinstance(event, dict)],
+                             [(('eu-west-1', 'stack2'), 1), (('us-east-1', 'stack1'), 2)])
+        self.assertListEqual([(stack, event) for stack, event in events if isinstance(event, StackSuccessStatus)],
+                             [(('us-east-1', 'stack1'), 'UPDATE_COMPLETE'),
+                              (('eu-west-1', 'stack2'), 'UPDATE_COMPLETE')])
+
+        # polls are at least 2 seconds apart, and the idle stack backs off
+        times = [poll_time for poll_time, _ in self.polls]
+        self.assertTrue(all(b - a >= 2 for a, b in zip(times, times[1:])))
+        self.assertListEqual(times, [1000, 1002, 1004, 1008, 1016, 1024, 1032])
+
+    def test_timeout(self):
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=2, jitter=0, timeout=10)
+        tailer = MultiStackTailer([('eu-west-1', 'stack2')], polling_policy=polling_policy)
+
+        with mock.patch.object(Cloudformation.connection_pool, 'get_connection',
+                               lambda region: self.connections[region]), \
+                mock.patch('time.sleep', self.sleep), mock.patch('time.time', lambda: self.now[0]):
+            events = list(tailer.tail())
+
+        self.assertIsInstance(events[-1][1], StackTimeoutStatus)
+        self.assertEqual(events[-1][1], 'UPDATE_IN_PROGRESS')
+
+    def test_timeout_time(self):
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=8, multiplier=2, jitter=0, timeout=10)
+        tailer = MultiStackTailer([('eu-west-1', 'stack2')], polling_policy=polling_policy)
+
+        with mock.patch.object(Cloudformation.connection_pool, 'get_connection',
+                               lambda region: self.connections[region]), \
+                mock.patch('time.sleep', self.sleep), mock.patch('time.time', lambda: self.now[0]):
+            events = list(tailer.tail())
+
+        # the backed off poll at 1014 is brought forward to the deadline, and only then the stack times out
+        self.assertListEqual([poll_time for poll_time, _ in self.polls], [1000, 1002, 1006, 1010])
+        self.assertIsInstance(events[-1][1], StackTimeoutStatus)
+        self.assertEqual(self.now[0], 1010)
+
+    def test_timeout_last_poll(self):
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=8, multiplier=2, jitter=0, timeout=28)
+        tailer = MultiStackTailer([('eu-west-1', 'stack2')], polling_policy=polling_policy)
+        self.connections['eu-west-1'].complete_at = 1028
+
+        with mock.patch.object(Cloudformation.connection_pool, 'get_connection',
+                               lambda region: self.connections[region]), \
+                mock.patch('time.sleep', self.sleep), mock.patch('time.time', lambda: self.now[0]):
+            events = list(tailer.tail())
+
+        # the stack completes on the poll at the deadline
+        self.assertEqual(self.polls[-1][0], 1028)
+        self.assertEqual(events[-1], (('eu-west-1', 'stack2'), StackSuccessStatus('UPDATE_COMPLETE')))
+        self.assertIsInstance(events[-1][1], StackSuccessStatus)
+
+    def test_follow(self):
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=8, multiplier=2, jitter=0)
+        tailer = MultiStackTailer(polls_per_second=0.5, polling_policy=polling_policy, follow=True)
+
+        with mock.patch.object(Cloudformation.connection_pool, 'get_connection',
+                               lambda region: self.connections[region]), \
+                mock.patch('time.sleep', self.sleep), mock.patch('time.time', lambda: self.now[0]):
+            tailer.add(('us-east-1', 'stack1'), 1)
+            events = tailer.tail()
+            self.assertEqual(next(events), (('us-east-1', 'stack1'), StackSuccessStatus('UPDATE_COMPLETE')))
+            self.assertEqual(tailer.wait(('us-east-1', 'stack1')), 'UPDATE_COMPLETE')
+
+            # stacks can be added while tailing, and tailing goes on until closed
+            tailer.add(('eu-west-1', 'stack2'))
+            tailer.close()
+            events = list(events)
+
+        self.assertListEqual([event['event_id'] for _, event in events if isinstance(event, dict)], [1])
+        self.assertEqual(events[-1], (('eu-west-1', 'stack2'), StackSuccessStatus('UPDATE_COMPLETE')))
+        self.assertEqual(tailer.wait(('eu-west-1', 'stack2')), 'UPDATE_COMPLETE')
+
+    def test_follow_poll_error(self):
+        tailer = MultiStackTailer(follow=True)
+        connection = mock.Mock()
+        connection.describe_stacks.side_effect = ValueError('boom')
+
+        with mock.patch.object(Cloudformation.connection_pool, 'get_connection', lambda region: connection):
+            tailer.add(('us-east-1', 'stack1'))
+            tailer.close()
+            events = list(tailer.tail())
+
+        self.assertListEqual(events, [(('us-east-1', 'stack1'), StackFailStatus('RAINBOW_ERROR'))])
+        self.assertRaises(ValueError, tailer.wait, ('us-east-1', 'stack1'))
+
+
+def boto_server_error(status, code, message='error'):
+    return boto.exception.BotoServerError(status, 'error', '<ErrorResponse><Error><Code>%s</Code><Message>%s</Message>'
+                                                           '</Error></ErrorResponse>' % (code, message))
+
+
+class TestRetryPolicy(TestCase):
+    def setUp(self):
+        self.cloudformation = Cloudformation.__new__(Cloudformation)
+        self.cloudformation.region = 'us-east-1'
+        self.cloudformation.retry_policy = RetryPolicy(max_attempts=4)
+
+        sleep_patcher = mock.patch('time.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_throttling(self):
+        func = mock.Mock(side_effect=[boto_server_error(400, 'Throttling', 'Rate exceeded')] * 2 + ['result'])
+
+        self.assertEqual(self.cloudformation.call(func, 'stack', next_token='token'), 'result')
+        self.assertEqual(func.call_count, 3)
+        func.assert_called_with('stack', next_token='token')
+        self.assertEqual(self.sleep.call_count, 2)
+
+    def test_max_attempts(self):
+        func = mock.Mock(side_effect=boto_server_error(400, 'Throttling', 'Rate exceeded'))
+
+        self.assertRaises(boto.exception.BotoServerError, self.cloudformation.call, func)
+        self.assertEqual(func.call_count, 4)
+
+    def test_not_retryable(self):
+        func = mock.Mock(side_effect=boto_server_error(400, 'ValidationError'))
+
+        self.assertRaises(boto.exception.BotoServerError, self.cloudformation.call, func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_transient(self):
+        func = mock.Mock(side_effect=[boto_server_error(503, 'ServiceUnavailable'), socket.error(), 'result'])
+        self.assertEqual(self.cloudformation.call(func), 'result')
+
+        # the outcome of a failed create/update is unknown, only throttled calls are repeated
+        func = mock.Mock(side_effect=[boto_server_error(400, 'Throttling'), boto_server_error(503, 'InternalFailure')])
+        self.assertRaises(boto.exception.BotoServerError, self.cloudformation.call_once, func)
+        self.assertEqual(func.call_count, 2)
+
+    def test_create_stack_throttled(self):
+        self.cloudformation.connection = mock.Mock()
+        self.cloudformation.connection.create_stack.side_effect = [boto_server_error(400, 'Throttling'), None]
+
+        self.cloudformation.create_stack('stack', {}, {})
+        self.assertEqual(self.cloudformation.connection.create_stack.call_count, 2)
+
+    def test_delay(self):
+        policy = RetryPolicy(base_delay=0.5, max_delay=4)
+
+        for attempt, cap in ((1, 0.5), (2, 1), (3, 2), (4, 4), (10, 4)):
+            delays = [policy.delay(attempt) for _ in xrange(100)]
+            self.assertTrue(all(0 <= delay <= cap for delay in delays))
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        self.now = 1000.0
+
+        time_patcher = mock.patch('time.time', lambda: self.now)
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+
+        sleep_patcher = mock.patch('time.sleep')
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(2, burst=2)
+
+        for _ in xrange(4):
+            bucket.acquire()
+
+        # the burst is free, the rest wait for their turn
+        self.assertListEqual([args[0] for args, _ in self.sleep.call_args_list], [0.5, 1.0])
+
+        self.now += 10
+        self.sleep.reset_mock()
+        bucket.acquire()
+        self.assertFalse(self.sleep.called)
+
+    def test_region_rates(self):
+        rate_limiter = RateLimiter(region_rates={'eu-west-1': 1})
+
+        for _ in xrange(3):
+            rate_limiter.acquire('us-east-1')
+            rate_limiter.acquire('eu-west-1')
+
+        self.assertListEqual([args[0] for args, _ in self.sleep.call_args_list], [1.0, 2.0])
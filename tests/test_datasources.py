@@ -74,3 +74,81 @@ class TestDataSources(TestCase):
             self.datasource_collection.get_parameter_recursive('shared'),
             'from c'
         )
+
+    def test_pointer_cycle(self):
+        datasource_collection = DataSourceCollection(['yaml:datasources/cycle.yaml'])
+        self.assertRaises(PointerCycleException, datasource_collection.get_parameter_recursive, 'cycle_a')
+
+    def test_memoized_list(self):
+        a_list = self.datasource_collection.get_parameter_recursive('a_list')
+        a_list.append('modified')
+
+        self.assertListEqual(
+            self.datasource_collection.get_parameter_recursive('a_list'),
+            ['item1', 'item2', 'item3', 'item4']
+        )
+
+    def test_get_parameters_recursive(self):
+        self.assertDictEqual(
+            self.datasource_collection.get_parameters_recursive(['b_ptr', 'shared', 'test']),
+            {'b_ptr': ['item1', 'item2', 'item3', 'item4'], 'shared': 'from c'}
+        )
+
+
+class TestConcurrentDataSources(TestCase):
+    data_sources = ['file64:e_str:datasources/e.file64',
+                    'file:d_str:datasources/d.file',
+                    'yaml:c:datasources/nested.yaml',
+                    'yaml:datasources/b.yaml',
+                    'yaml:datasources/a.yaml']
+
+    def test_order(self):
+        serial = DataSourceCollection(self.data_sources)
+        concurrent = DataSourceCollection(self.data_sources, concurrency=3)
+
+        self.assertListEqual([d.data for d in serial], [d.data for d in concurrent])
+        self.assertEqual(concurrent.get_parameter_recursive('shared'), 'from c')
+
+    def test_errors(self):
+        data_sources = self.data_sources + ['yaml:datasources/nonexistent1.yaml', 'yaml:datasources/nonexistent2.yaml']
+
+        with self.assertRaises(DataSourceConstructionException) as cm:
+            DataSourceCollection(data_sources, concurrency=3)
+
+        self.assertListEqual([datasource for datasource, _ in cm.exception.errors], data_sources[-2:])
+
+
+class TestLazyDataSources(TestCase):
+    data_sources = ['file:d_str:datasources/d.file',
+                    'yaml:c:datasources/nested.yaml',
+                    'yaml:datasources/b.yaml',
+                    'yaml:datasources/nonexistent.yaml']
+
+    def setUp(self):
+        self.datasource_collection = DataSourceCollection(self.data_sources, lazy=True)
+
+    def loaded(self):
+        return [datasource.loaded for datasource in self.datasource_collection]
+
+    def test_lazy(self):
+        self.assertListEqual(self.loaded(), [False, False, False, False])
+
+        # the first data source containing the parameter is the last one loaded
+        self.assertEqual(self.datasource_collection.get_parameter_recursive('shared'), 'from c')
+        self.assertListEqual(self.loaded(), [True, True, False, False])
+
+        self.assertEqual(self.datasource_collection.get_parameter_recursive('b_str'), 'a B string')
+        self.assertListEqual(self.loaded(), [True, True, True, False])
+
+    def test_fall_through(self):
+        # lookups that aren't satisfied by any data source reach (and load) all of them
+        self.assertRaises(IOError, self.datasource_collection.get_parameter_recursive, 'test')
+
+    def test_load(self):
+        self.assertRaises(DataSourceConstructionException, self.datasource_collection.load, 2)
+        self.assertListEqual(self.loaded(), [True, True, True, False])
+
+    def test_invalid_format(self):
+        # the data source argument is still parsed up front
+        self.assertRaises(InvalidDataSourceFormatException, DataSourceCollection, ['file:datasources/d.file'],
+                          lazy=True)
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from rainbow.datasources import DataSourceCollection
+from rainbow.preprocessor import Preprocessor
+from rainbow.preprocessor.instance_catalog import InstanceCatalog, InvalidInstanceCatalogException
+from rainbow.preprocessor.instance_chooser import InvalidInstanceException
+
+__author__ = 'omrib'
+
+
+class TestInstanceCatalog(TestCase):
+    def setUp(self):
+        self.catalog = InstanceCatalog('preprocessor/instance_catalog.yaml')
+
+    def test_bundled_catalog(self):
+        catalog = InstanceCatalog()
+
+        self.assertIn('sa-east-1', catalog.regions())
+        self.assertTrue(catalog.is_available('us-east-1', 'c3.large'))
+        self.assertFalse(catalog.is_available('sa-east-1', 'c3.large'))
+        self.assertEqual(catalog.instance_type('c3.2xlarge').vcpus, 8)
+
+        # every instance type available on a region has a spec
+        for region in catalog.regions():
+            for name in catalog.available_instance_types(region):
+                self.assertIsNotNone(catalog.instance_type(name))
+
+    def test_lazy_load(self):
+        catalog = InstanceCatalog('no/such/catalog.yaml')
+        self.assertRaises(IOError, catalog.is_available, 'us-east-1', 'c9.large')
+
+    def test_instance_type(self):
+        instance_type = self.catalog.instance_type('m9.xlarge')
+
+        self.assertEqual((instance_type.family, instance_type.size), ('m9', 'xlarge'))
+        self.assertEqual((instance_type.vcpus, instance_type.memory), (4, 16.0))
+        self.assertIsNone(self.catalog.instance_type('nosuchinstance'))
+
+    def test_choose(self):
+        self.assertEqual(self.catalog.choose('us-east-1', min_vcpus=2), 'c9.large')
+        self.assertEqual(self.catalog.choose('us-east-1', min_memory=5), 'm9.large')
+        self.assertEqual(self.catalog.choose('us-east-1', min_vcpus=4, min_memory=8), 'c9.xlarge')
+        self.assertEqual(self.catalog.choose('us-east-1', min_vcpus=2, families=['m9', 'c9']), 'm9.large')
+        self.assertIsNone(self.catalog.choose('us-east-1', min_vcpus=64))
+
+        # preferred families without a large enough instance type fall back to any family
+        self.assertEqual(self.catalog.choose('us-east-1', min_memory=16, families=['c9']), 'm9.xlarge')
+        self.assertEqual(self.catalog.choose('sa-east-1', min_vcpus=4, families=['c9', 'm9']), 'm9.xlarge')
+
+    def test_unknown_region(self):
+        self.assertRaises(InvalidInstanceCatalogException, self.catalog.is_available, 'mars-north-1', 'c9.large')
+
+    def test_invalid_catalog(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+
+        path = os.path.join(directory, 'catalog.yaml')
+        with open(path, 'w') as f:
+            f.write('instance_types: {}\nregions: {us-east-1: [c9.large]}\n')
+
+        self.assertRaises(InvalidInstanceCatalogException, InstanceCatalog(path).regions)
+
+
+class TestInstanceChooserConstraints(TestCase):
+    def setUp(self):
+        original_catalog = Preprocessor.instance_catalog
+        self.addCleanup(setattr, Preprocessor, 'instance_catalog', original_catalog)
+        Preprocessor.instance_catalog = InstanceCatalog('preprocessor/instance_catalog.yaml')
+
+        datasource_collection = DataSourceCollection(['yaml:datasources/a.yaml'])
+        self.preprocessor = Preprocessor(datasource_collection, 'us-east-1')
+        self.sa_preprocessor = Preprocessor(datasource_collection, 'sa-east-1')
+
+    def choose(self, preprocessor, instance_types):
+        return preprocessor.process({'Rb::InstanceChooser': instance_types})
+
+    def test_constraints(self):
+        constraints = {'MinVcpus': 4, 'Families': ['c9', 'm9']}
+
+        self.assertEqual(self.choose(self.preprocessor, constraints), 'c9.xlarge')
+        self.assertEqual(self.choose(self.sa_preprocessor, constraints), 'm9.xlarge')
+
+    def test_constraints_fallback(self):
+        instance_types = ['c9.large', {'MinVcpus': 4}, 'm9.large']
+
+        self.assertEqual(self.choose(self.preprocessor, instance_types), 'c9.large')
+        self.assertEqual(self.choose(self.sa_preprocessor, instance_types), 'm9.xlarge')
+        self.assertRaises(InvalidInstanceException, self.choose, self.sa_preprocessor,
+                          ['c9.large', {'MinVcpus': 64}])
+
+    def test_invalid_constraints(self):
+        self.assertRaises(InvalidInstanceException, self.choose, self.preprocessor, {'MinCores': 4})
+        # a single family has to be given as a list too, rather than be iterated character by character
+        self.assertRaises(InvalidInstanceException, self.choose, self.preprocessor, {'MinVcpus': 4, 'Families': 'c9'})
+        self.assertRaises(InvalidInstanceException, self.choose,
+                          Preprocessor(self.preprocessor.datasource_collection, 'mars-north-1'), ['c9.large'])
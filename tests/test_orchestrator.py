@@ -0,0 +1,85 @@
+import mock
+import threading
+from unittest import TestCase
+from rainbow.cloudformation import Cloudformation, StackSuccessStatus, StackFailStatus
+from rainbow.orchestrator import StackDefinition, Orchestrator, OrchestratorException, StackSkippedStatus
+from rainbow.templates import TemplateLoader
+
+__author__ = 'omrib'
+
+
+class TestOrchestrator(TestCase):
+    def setUp(self):
+        Cloudformation.default_region = 'us-east-1'
+
+        snapshot_patcher = mock.patch.object(Cloudformation.stack_registry, 'snapshot')
+        self.snapshot = snapshot_patcher.start()
+        self.addCleanup(snapshot_patcher.stop)
+
+        connection_patcher = mock.patch.object(Cloudformation.connection_pool, 'get_connection')
+        connection_patcher.start()
+        self.addCleanup(connection_patcher.stop)
+
+        self.stack_definitions = [
+            StackDefinition('web', ['web.yaml'], ['cfn_outputs:vpc', 'cfn_resources:eu-west-1:db', 'yaml:web.yaml']),
+            StackDefinition('vpc', ['vpc.yaml'], ['yaml:vpc.yaml']),
+            StackDefinition('db', ['db.yaml'], ['cfn_outputs:us-east-1:vpc', 'cfn_outputs:external'], 'eu-west-1'),
+            StackDefinition('monitoring', ['monitoring.yaml'])
+        ]
+
+    def test_dependencies(self):
+        orchestrator = Orchestrator(self.stack_definitions)
+
+        self.assertSetEqual(orchestrator.dependencies[('us-east-1', 'web')],
+                            {('us-east-1', 'vpc'), ('eu-west-1', 'db')})
+        self.assertSetEqual(orchestrator.dependencies[('eu-west-1', 'db')], {('us-east-1', 'vpc')})
+        self.assertSetEqual(orchestrator.dependencies[('us-east-1', 'vpc')], set())
+
+        self.assertListEqual([stack_definition.name for stack_definition in orchestrator.deploy_order()],
+                             ['vpc', 'db', 'monitoring', 'web'])
+
+    def test_cycle(self):
+        self.stack_definitions.append(StackDefinition('a', ['a.yaml'], ['cfn_outputs:b']))
+        self.stack_definitions.append(StackDefinition('b', ['b.yaml'], ['cfn_outputs:a']))
+
+        self.assertRaises(OrchestratorException, Orchestrator, self.stack_definitions)
+
+    def test_deploy(self):
+        deployed = []
+        lock = threading.Lock()
+
+        def deploy(stack_definition, polling_policy=None, skip_unchanged=False, tailer=None):
+            with lock:
+                deployed.append(stack_definition.name)
+            return StackSuccessStatus('CREATE_COMPLETE')
+
+        with mock.patch.object(StackDefinition, 'deploy', deploy):
+            statuses = Orchestrator(self.stack_definitions, parallelism=2).deploy()
+
+        self.assertTrue(all(isinstance(status, StackSuccessStatus) for status in statuses.itervalues()))
+        self.assertEqual(self.snapshot.call_count, 2)
+        self.assertLess(deployed.index('vpc'), deployed.index('db'))
+        self.assertLess(deployed.index('db'), deployed.index('web'))
+
+    def test_deploy_failure(self):
+        def deploy(stack_definition, polling_policy=None, skip_unchanged=False, tailer=None):
+            if stack_definition.name == 'db':
+                return StackFailStatus('CREATE_FAILED')
+            return StackSuccessStatus('CREATE_COMPLETE')
+
+        with mock.patch.object(StackDefinition, 'deploy', deploy):
+            statuses = Orchestrator(self.stack_definitions).deploy()
+
+        self.assertIsInstance(statuses[('us-east-1', 'vpc')], StackSuccessStatus)
+        self.assertIsInstance(statuses[('us-east-1', 'monitoring')], StackSuccessStatus)
+        self.assertIsInstance(statuses[('eu-west-1', 'db')], StackFailStatus)
+        self.assertIsInstance(statuses[('us-east-1', 'web')], StackSkippedStatus)
+
+    def test_load_templates(self):
+        stack_definitions = [StackDefinition('simple', ['templates/simpletemplate.yaml']),
+                             StackDefinition('merged', ['cfn_deep_merge/a.yaml', 'cfn_deep_merge/b.yaml'])]
+
+        Orchestrator(stack_definitions).load_templates(2)
+
+        for stack_definition in stack_definitions:
+            self.assertDictEqual(stack_definition.template, TemplateLoader.load_templates(stack_definition.templates))
@@ -39,5 +39,14 @@ class TestPreprocessor(TestCase):
         processed4 = self.preprocessor.process(template4)
         self.assertEqual(processed4['Resources']['Properties']['InstanceType'], 'c3.large')
 
+    def test_process_copies_template(self):
+        template = {'Resources': {'Properties': {'InstanceType': {'Rb::InstanceChooser': ['c3.large']},
+                                                 'Tags': [{'Key': 'Name', 'Value': 'instance'}]}}}
+        processed = self.preprocessor.process(template)
+
+        self.assertEqual(processed['Resources']['Properties']['InstanceType'], 'c3.large')
+        self.assertDictEqual(template['Resources']['Properties']['InstanceType'], {'Rb::InstanceChooser': ['c3.large']})
+        self.assertIsNot(processed['Resources']['Properties']['Tags'], template['Resources']['Properties']['Tags'])
+
     def test_invalid_function(self):
         self.assertRaises(InvalidPreprocessorFunctionException, self.preprocessor.process, {'Rb::NoSuchFunction': ''})
@@ -0,0 +1,78 @@
+import json
+import mock
+from unittest import TestCase
+from rainbow.profiler import Profiler, phase, instrument_connection
+
+__author__ = 'omrib'
+
+
+class MockResponse(object):
+    def __init__(self, status):
+        self.status = status
+
+
+class MockConnection(object):
+    def __init__(self):
+        self.requests = []
+
+    def make_request(self, action, params=None, path='/', verb='GET'):
+        self.requests.append(action)
+        return MockResponse(400 if action == 'Fail' else 200)
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.profiler = Profiler().install()
+        self.addCleanup(self.profiler.uninstall)
+
+    def test_phases(self):
+        with mock.patch('time.time', side_effect=[10, 11, 15, 20, 22, 24]):
+            with phase('outer'):
+                with phase('inner'):
+                    pass
+            with phase('inner'):
+                pass
+
+        self.assertListEqual(self.profiler.phases.keys(), ['outer', 'inner'])
+        self.assertDictEqual(self.profiler.phases['outer'], {'count': 1, 'seconds': 10.0})
+        self.assertDictEqual(self.profiler.phases['inner'], {'count': 2, 'seconds': 6.0})
+
+    def test_inactive(self):
+        self.profiler.uninstall()
+
+        with phase('phase'):
+            pass
+        instrument_connection(MockConnection()).make_request('DescribeStacks')
+
+        self.assertDictEqual(self.profiler.phases, {})
+        self.assertDictEqual(self.profiler.calls, {})
+
+    def test_instrument_connection(self):
+        connection = MockConnection()
+        instrument_connection(connection)
+
+        connection.make_request('DescribeStacks')
+        connection.make_request('DescribeStacks', {'StackName': 'stack'})
+        connection.make_request('Fail')
+
+        self.assertListEqual(connection.requests, ['DescribeStacks', 'DescribeStacks', 'Fail'])
+        self.assertEqual(self.profiler.calls['DescribeStacks']['count'], 2)
+        self.assertEqual(self.profiler.calls['DescribeStacks']['errors'], 0)
+        self.assertEqual(self.profiler.calls['Fail']['errors'], 1)
+
+    def test_reports(self):
+        self.profiler.record_call('DescribeStacks', 0.5)
+        self.profiler.record_call('DescribeStacks', 1.5)
+        with phase('load_templates'):
+            pass
+
+        report = json.loads(self.profiler.to_json())
+        self.assertDictEqual(report['aws_calls']['DescribeStacks'],
+                             {'count': 2, 'errors': 0, 'seconds': 2.0, 'max_seconds': 1.5})
+        self.assertEqual(report['phases']['load_templates']['count'], 1)
+
+        lines = self.profiler.to_prometheus().splitlines()
+        self.assertIn('# TYPE rainbow_aws_calls_total counter', lines)
+        self.assertIn('rainbow_aws_calls_total{operation="DescribeStacks"} 2', lines)
+        self.assertIn('rainbow_aws_call_max_seconds{operation="DescribeStacks"} 1.5', lines)
+        self.assertIn('rainbow_phase_count{phase="load_templates"} 1', lines)
@@ -0,0 +1,215 @@
+import os
+import mock
+import shutil
+import tempfile
+from unittest import TestCase
+from rainbow.cloudformation import Cloudformation, CloudformationException, PollingPolicy, \
+    StackSuccessStatus, StackFailStatus
+from rainbow.orchestrator import StackDefinition, Orchestrator
+from rainbow.replay import Cassette, StackSimulator, RecordingConnectionPool, ReplayConnectionPool, ReplayException
+
+__author__ = 'omrib'
+
+
+def generate_template(resources):
+    return {'Resources': {'Topic%d' % (i,): {'Type': 'AWS::SNS::Topic'} for i in xrange(resources)},
+            'Outputs': {'Name': {'Value': 'topics'}}}
+
+
+class ReplayTestCase(TestCase):
+    def setUp(self):
+        Cloudformation.stack_registry.clear()
+
+        original_pool = Cloudformation.connection_pool
+        self.addCleanup(setattr, Cloudformation, 'connection_pool', original_pool)
+
+    def use_pool(self, pool):
+        Cloudformation.connection_pool = pool
+        return Cloudformation('us-east-1')
+
+    def deploy(self, cloudformation, simulator, name, template, update=False):
+        """
+        Create/update a stack and tail its events like --block does, with simulated time
+
+        :return: list of the stack events' resource statuses, and the final stack status
+        """
+
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=20, jitter=0)
+        events = cloudformation.tail_stack_events(name, None if update else 0, polling_policy=polling_policy)
+
+        if update:
+            cloudformation.update_stack(name, template, {'Size': 'large'})
+        else:
+            cloudformation.create_stack(name, template, {'Size': 'small'})
+
+        with mock.patch('time.sleep', simulator.advance):
+            events = list(events)
+
+        return [event['resource_status'] for event in events[:-1]], events[-1]
+
+
+class TestStackSimulator(ReplayTestCase):
+    def setUp(self):
+        super(TestStackSimulator, self).setUp()
+        self.simulator = StackSimulator(resource_seconds=5)
+        self.pool = ReplayConnectionPool(self.simulator)
+        self.cloudformation = self.use_pool(self.pool)
+
+    def test_create(self):
+        self.assertFalse(self.cloudformation.stack_exists('stack'))
+
+        statuses, status = self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(3))
+
+        self.assertListEqual(statuses, ['CREATE_IN_PROGRESS'] + ['CREATE_IN_PROGRESS', 'CREATE_COMPLETE'] * 3 +
+                             ['CREATE_COMPLETE'])
+        self.assertIsInstance(status, StackSuccessStatus)
+
+        stack = self.cloudformation.describe_stack('stack')
+        self.assertDictEqual({output.key: output.value for output in stack.outputs}, {'Name': 'topics'})
+        self.assertDictEqual({parameter.key: parameter.value for parameter in stack.parameters}, {'Size': 'small'})
+        self.assertEqual(len(stack.describe_resources()), 3)
+        self.assertTrue(self.cloudformation.stack_exists('stack'))
+
+    def test_list_stack_resources(self):
+        self.simulator.page_size = 2
+        self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(5))
+
+        pages = list(self.cloudformation.iter_stack_resources('stack'))
+
+        self.assertListEqual([len(page) for page in pages], [2, 2, 1])
+        self.assertListEqual(sorted(logical_resource_id for page in pages for logical_resource_id, _ in page),
+                             ['Topic%d' % (i,) for i in xrange(5)])
+        self.assertEqual(self.pool.calls['ListStackResources'], 3)
+
+    def test_in_progress(self):
+        self.cloudformation.create_stack('stack', generate_template(3), {})
+        self.simulator.advance(7)
+
+        self.assertEqual(self.cloudformation.describe_stack('stack').stack_status, 'CREATE_IN_PROGRESS')
+        self.assertRaises(CloudformationException, self.cloudformation.update_stack, 'stack', generate_template(4),
+                          {})
+        self.assertRaises(CloudformationException, self.cloudformation.create_stack, 'stack', generate_template(3),
+                          {})
+
+    def test_create_failure(self):
+        self.simulator.failing_resources.add('Topic1')
+
+        statuses, status = self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(3))
+
+        # rainbow creates stacks with rollback disabled
+        self.assertEqual(statuses[-2], 'CREATE_FAILED')
+        self.assertIsInstance(status, StackFailStatus)
+        self.assertEqual(status, 'CREATE_FAILED')
+
+    def test_update(self):
+        self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(2))
+        statuses, status = self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(3), True)
+
+        self.assertListEqual(statuses, ['UPDATE_IN_PROGRESS', 'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE',
+                                        'UPDATE_IN_PROGRESS', 'UPDATE_COMPLETE', 'CREATE_IN_PROGRESS',
+                                        'CREATE_COMPLETE', 'UPDATE_COMPLETE_CLEANUP_IN_PROGRESS', 'UPDATE_COMPLETE'])
+        self.assertIsInstance(status, StackSuccessStatus)
+        self.assertFalse(self.cloudformation.update_stack('stack', generate_template(3), {'Size': 'large'}))
+
+    def test_update_rollback(self):
+        self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(2))
+        self.simulator.failing_resources.add('Topic2')
+
+        _, status = self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(3), True)
+
+        self.assertIsInstance(status, StackFailStatus)
+        self.assertEqual(status, 'UPDATE_ROLLBACK_COMPLETE')
+
+    def test_skip_unchanged_failed(self):
+        self.simulator.failing_resources.add('Topic1')
+
+        stack_definition = StackDefinition('stack', [], region='us-east-1')
+        stack_definition.template = generate_template(3)
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=20, jitter=0)
+
+        with mock.patch('time.sleep', self.simulator.advance):
+            status = stack_definition.deploy(polling_policy, skip_unchanged=True)
+            self.assertIsInstance(status, StackFailStatus)
+            self.assertEqual(status, 'CREATE_FAILED')
+
+            # the stack carries the hash of its template, yet it has to be deployed again rather than skipped
+            status = stack_definition.deploy(polling_policy, skip_unchanged=True)
+            self.assertIsInstance(status, StackFailStatus)
+            self.assertEqual(self.pool.calls['UpdateStack'], 1)
+
+    def test_no_updates_failed(self):
+        self.simulator.failing_resources.add('Topic2')
+        self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(2))
+        self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(3), True)
+
+        # the simulator keeps the template of the rolled back update, so repeating it has nothing to update
+        self.assertFalse(self.cloudformation.update_stack('stack', generate_template(3), {'Size': 'large'}))
+        status = self.cloudformation.current_status('stack')
+        self.assertIsInstance(status, StackFailStatus)
+        self.assertEqual(status, 'UPDATE_ROLLBACK_COMPLETE')
+
+    def test_orchestrate(self):
+        stack_definitions = [StackDefinition('stack%d' % (i,), [], region='us-east-1') for i in xrange(3)]
+        stack_definitions.append(StackDefinition('dependent', [], ['cfn_outputs:stack0'], region='us-east-1'))
+        for stack_definition in stack_definitions:
+            stack_definition.template = generate_template(3)
+
+        polling_policy = PollingPolicy(initial_interval=2, max_interval=20, jitter=0)
+        orchestrator = Orchestrator(stack_definitions, parallelism=3, polling_policy=polling_policy,
+                                    polls_per_second=0.5)
+
+        # only the tailer's clock is simulated, the thread pool sleeps on its own too
+        clock = mock.Mock(sleep=self.simulator.advance, time=lambda: self.simulator.clock)
+        with mock.patch('rainbow.cloudformation.time', clock):
+            statuses = orchestrator.deploy()
+
+        self.assertTrue(all(status == 'CREATE_COMPLETE' for status in statuses.itervalues()))
+
+        # the concurrently deploying stacks are polled by a single tailer, within its shared budget
+        self.assertEqual(self.pool.calls['CreateStack'], 4)
+        self.assertLessEqual(self.pool.calls['DescribeStackEvents'], self.simulator.clock * 0.5 + 1)
+
+    def test_describe_stack_events_budget(self):
+        # 20 resources, 30 seconds each. Polling restarts at 2 seconds whenever there are new events, and backs off
+        # (x1.5) until the next resource completes
+        self.simulator.resource_seconds = 30
+        self.simulator.page_size = 10
+        self.deploy(self.cloudformation, self.simulator, 'stack', generate_template(20))
+
+        self.assertEqual(self.pool.calls['CreateStack'], 1)
+        self.assertLessEqual(self.pool.calls['DescribeStackEvents'], 6 * 20)
+
+        # there are 42 events, but every poll reads only the first page, holding the new ones
+        self.assertEqual(self.pool.calls['DescribeStackEvents'], self.pool.calls['DescribeStacks'])
+
+
+class TestCassette(ReplayTestCase):
+    def setUp(self):
+        super(TestCassette, self).setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_record_replay(self):
+        simulator = StackSimulator()
+        cassette = Cassette()
+        recording_pool = RecordingConnectionPool(cassette, ReplayConnectionPool(simulator))
+
+        recorded = self.deploy(self.use_pool(recording_pool), simulator, 'stack', generate_template(3))
+        self.assertFalse(self.use_pool(recording_pool).stack_exists('no-such-stack'))
+
+        path = os.path.join(self.directory, 'cassette.json')
+        cassette.save(path)
+
+        Cloudformation.stack_registry.clear()
+        replay_pool = ReplayConnectionPool(Cassette.load(path))
+
+        # the replay doesn't need any simulated time to pass
+        replayed = self.deploy(self.use_pool(replay_pool), StackSimulator(), 'stack', generate_template(3))
+        self.assertFalse(self.use_pool(replay_pool).stack_exists('no-such-stack'))
+
+        self.assertEqual(recorded, replayed)
+        self.assertEqual(replay_pool.calls, recording_pool.calls)
+
+    def test_not_recorded(self):
+        cloudformation = self.use_pool(ReplayConnectionPool(Cassette()))
+        self.assertRaises(ReplayException, cloudformation.describe_stack, 'stack')
@@ -0,0 +1,51 @@
+import os
+import glob
+import unittest
+from unittest import TestCase
+from rainbow.yaml_loader import RainbowYamlLoader, PyRainbowYamlLoader, CRainbowYamlLoader, \
+    YamlIncludeCycleException
+
+__author__ = 'omrib'
+
+
+def typed(data):
+    """
+    Convert data to a structure comparing types as well as values (DataCollectionPointer != str)
+    """
+
+    if isinstance(data, dict):
+        return {typed(k): typed(v) for k, v in data.iteritems()}
+    elif isinstance(data, list):
+        return [typed(v) for v in data]
+    else:
+        return type(data).__name__, data
+
+
+@unittest.skipIf(CRainbowYamlLoader is None, 'libyaml is not available')
+class TestYamlLoaderParity(TestCase):
+    def assertParity(self, directory, patterns):
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            paths = sum((glob.glob(pattern) for pattern in patterns), [])
+            self.assertTrue(paths)
+
+            for path in paths:
+                try:
+                    expected = typed(PyRainbowYamlLoader.load_file(path))
+                except YamlIncludeCycleException:
+                    self.assertRaises(YamlIncludeCycleException, CRainbowYamlLoader.load_file, path)
+                else:
+                    self.assertEqual(expected, typed(CRainbowYamlLoader.load_file(path)), path)
+        finally:
+            os.chdir(cwd)
+
+    def test_default_loader(self):
+        self.assertIs(RainbowYamlLoader, CRainbowYamlLoader)
+
+    def test_fixtures(self):
+        self.assertParity('.', ['*/*.yaml'])
+
+    def test_examples(self):
+        for example in glob.glob('../examples/*'):
+            self.assertParity(example, ['*.yaml', '*/*.yaml', '*/*/*.yaml'])
@@ -1,5 +1,10 @@
+import os
+import shutil
+import tempfile
 from unittest import TestCase
-from rainbow.yaml_loader import RainbowYamlLoader
+from rainbow.datasources.base import DataCollectionPointer
+from rainbow.yaml_loader import RainbowYamlLoader, IncludeCache, YamlIncludeCycleException
+from rainbow.yaml_cache import RainbowYamlCache
 
 __author__ = 'omrib'
 
@@ -29,3 +34,77 @@ class TestPreprocessor(TestCase):
                 self.yamlfile['included_yaml'],
                 RainbowYamlLoader(f).get_data()
             )
+
+
+class TestRainbowYamlCache(TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = RainbowYamlCache(os.path.join(self.temp_dir, 'cache'))
+
+        self.include_path = os.path.join(self.temp_dir, 'include.file')
+        with open(self.include_path, 'w') as f:
+            f.write('included')
+
+        self.yaml_path = os.path.join(self.temp_dir, 'base.yaml')
+        with open(self.yaml_path, 'w') as f:
+            f.write('pointer: $something\nincluded: !file %s\nnested: !yaml yamlfile/includeme.yaml\n' %
+                    (self.include_path,))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_cache_hit(self):
+        data, includes = self.cache.load(self.yaml_path)
+        cached_data, cached_includes = self.cache.load(self.yaml_path)
+
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertDictEqual(data, cached_data)
+        self.assertListEqual(includes, cached_includes)
+        self.assertIsInstance(cached_data['pointer'], DataCollectionPointer)
+
+    def test_include_changed(self):
+        self.cache.load(self.yaml_path)
+
+        with open(self.include_path, 'w') as f:
+            f.write('changed')
+
+        data, _ = self.cache.load(self.yaml_path)
+        self.assertEqual(data['included'], 'changed')
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_load_file(self):
+        RainbowYamlLoader.cache = self.cache
+        try:
+            RainbowYamlLoader.load_file('yamlfile/base.yaml')
+            included_files = []
+            data = RainbowYamlLoader.load_file('yamlfile/base.yaml', included_files)
+        finally:
+            RainbowYamlLoader.cache = None
+
+        self.assertEqual(self.cache.hits, 1)
+        self.assertListEqual(included_files, ['yamlfile/base.yaml', 'yamlfile/includeme.file',
+                                              'yamlfile/includeme.file64', 'yamlfile/includeme.yaml'])
+        with open('yamlfile/includeme.file') as f:
+            self.assertEqual(data['included_file'], f.read())
+
+
+class TestIncludeCache(TestCase):
+    def setUp(self):
+        RainbowYamlLoader.include_cache = IncludeCache()
+
+    def tearDown(self):
+        RainbowYamlLoader.include_cache = None
+
+    def test_include_cache(self):
+        first = RainbowYamlLoader.load_file('yamlfile/base.yaml')
+        second = RainbowYamlLoader.load_file('yamlfile/base.yaml')
+
+        self.assertDictEqual(first, second)
+        self.assertEqual(RainbowYamlLoader.include_cache.hits, 1)
+
+        # every caller gets its own copy
+        first['included_yaml']['changed'] = True
+        self.assertNotIn('changed', RainbowYamlLoader.load_file('yamlfile/base.yaml')['included_yaml'])
+
+    def test_include_cycle(self):
+        self.assertRaises(YamlIncludeCycleException, RainbowYamlLoader.load_file, 'yamlfile/cycle1.yaml')